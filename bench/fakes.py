@@ -0,0 +1,572 @@
+"""
+In-process stand-ins for the services maxime.py talks to, so that it can be
+benchmarked and soak tested on a box without Bluetooth or audio hardware.
+
+* FakePulseServer keeps sinks, sources, cards and sink inputs, and hands out
+  FakePulse connections that implement the parts of the pulsectl.Pulse API
+  we use, including event subscription.
+* PrivateBus runs a throwaway dbus-daemon and points both the system and
+  session bus of this process at it.
+* FakeBluez exports org.bluez devices and an ObjectManager on that bus, and
+  FakeNotifications answers org.freedesktop.Notifications.
+
+pulsectl (for its exceptions), dbus-python and gi still have to be installed.
+"""
+import collections
+import copy
+import itertools
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import dbus
+import dbus.service
+from pulsectl import PulseIndexError, PulseLoopStop
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BLUEZ_SERVICE = "org.bluez"
+BLUEZ_INTERFACE_DEVICE = "org.bluez.Device1"
+INTERFACE_PROPERTIES = "org.freedesktop.DBus.Properties"
+INTERFACE_OBJECTMANAGER = "org.freedesktop.DBus.ObjectManager"
+
+LADSPA_SINK_DESCRIPTION = "LADSPA Plugin Multiband EQ"
+LADSPA_STREAM_NAME = "LADSPA Stream"
+# The output port of a bluez card, which latency offsets are set on.
+BLUETOOTH_PORT_NAME = "headphone-output"
+
+
+class FakeObject:
+    """A Pulse object. Attributes are whatever pulsectl would have given us."""
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return "<%s #%s %s>" % (self.__class__.__name__, self.index, self.name)
+
+
+class FakeEvent:
+    """A pulsectl.PulseEventInfo."""
+    def __init__(self, facility, t, index):
+        self.facility = facility
+        self.t = t
+        self.index = index
+
+
+class FakePulseServer:
+    """
+    The state of a fake Pulse server. Changes are announced to every
+    connection that subscribed to the facility, like the real thing.
+    """
+    FACILITIES = ("sink", "source", "card", "sink_input")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.objects = dict((facility, collections.OrderedDict()) for facility in self.FACILITIES)
+        self.connections = []
+        self.default_source = None
+        # The LADSPA EQ sink, once populated.
+        self.eq_sink = None
+        self.calls = collections.Counter()
+        # Called with the stream and sink index whenever a client moves a stream.
+        self.move_hooks = []
+        self._indexes = itertools.count(1)
+
+    def connect(self, client_name):
+        """
+        Open a connection. Has the same signature as PulseAudio.open_connection.
+        :return: FakePulse
+        """
+        conn = FakePulse(self, client_name)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def disconnect(self, conn):
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+
+    def _announce(self, facility, t, obj):
+        event = FakeEvent(facility, t, obj.index)
+        for conn in list(self.connections):
+            conn.deliver(event)
+
+    def add(self, facility, **attributes):
+        """
+        Add an object.
+        :return: The new object.
+        """
+        with self.lock:
+            obj = FakeObject(index=next(self._indexes), **attributes)
+            obj.__dict__.setdefault("proplist", {})
+            self.objects[facility][obj.index] = obj
+        self._announce(facility, "new", obj)
+        return obj
+
+    def change(self, facility, index, **attributes):
+        """
+        Change attributes of an object.
+        :return: The object.
+        """
+        with self.lock:
+            obj = self.objects[facility][index]
+            obj.__dict__.update(attributes)
+        self._announce(facility, "change", obj)
+        return obj
+
+    def remove(self, facility, index):
+        """
+        Remove an object.
+        :return: None
+        """
+        with self.lock:
+            obj = self.objects[facility].pop(index, None)
+        if obj is not None:
+            self._announce(facility, "remove", obj)
+
+    def find(self, facility, **attributes):
+        """
+        Return the first object whose attributes match.
+        :return: FakeObject or None
+        """
+        with self.lock:
+            for obj in self.objects[facility].values():
+                if all(getattr(obj, k, None) == v for k, v in attributes.items()):
+                    return obj
+        return None
+
+    def add_sink(self, name, description, **attributes):
+        """Add a sink and its monitor source."""
+        sink = self.add("sink", name=name, description=description, latency=0, configured_latency=0,
+                        state="idle", **attributes)
+        self.add("source", name=name + ".monitor", description="Monitor of " + description,
+                 monitor_of_sink=sink.index)
+        return sink
+
+    def remove_sink(self, index):
+        """Remove a sink and its monitor source, moving its streams elsewhere like Pulse does."""
+        monitor = self.find("source", monitor_of_sink=index)
+        if monitor is not None:
+            self.remove("source", monitor.index)
+        fallback = next((s for s in self.objects["sink"].values() if s.index != index), None)
+        for stream in list(self.objects["sink_input"].values()):
+            if stream.sink == index and fallback is not None:
+                self.change("sink_input", stream.index, sink=fallback.index)
+        self.remove("sink", index)
+
+    def populate(self, sink_count, config):
+        """
+        Set up a desk with a lot of sinks, the configured speakers and
+        headset, the LADSPA EQ and its stream.
+        :param sink_count: How many sinks in total.
+        :param config: configparser object of the maxime config.
+        :return: None
+        """
+        speakers = self.add_sink("alsa_output.speakers", config.get("speakers", "output_device"))
+        headset = self.add_sink("alsa_output.headset", config.get("headset", "output_device"))
+        self.add("source", name="alsa_input.speakers", description=config.get("speakers", "input_device"))
+        self.add("source", name="alsa_input.headset", description=config.get("headset", "input_device"))
+        for number in range(max(sink_count - 3, 0)):
+            self.add_sink("alsa_output.filler_%s" % number, "Filler Output %s" % number)
+
+        eq = self.add_sink("ladspa_output.mbeq", "%s on %s" % (LADSPA_SINK_DESCRIPTION, speakers.description))
+        self.add("sink_input", name=LADSPA_STREAM_NAME, sink=speakers.index, mute=False,
+                 proplist={"media.name": LADSPA_STREAM_NAME})
+        for number in range(3):
+            self.add("sink_input", name="Playback %s" % number, sink=eq.index, mute=False,
+                     proplist={"application.process.binary": "player%s" % number})
+        self.eq_sink = eq
+
+    # Bluetooth cards
+
+    def add_bluetooth_card(self, mac, description, profile="a2dp_sink"):
+        """
+        Add a bluez card with one output port and, for A2DP, its sink.
+        :return: The card.
+        """
+        normal_mac = mac.replace(":", "_")
+        profiles = [FakeObject(index=0, name="a2dp_sink"), FakeObject(index=1, name="headset_head_unit"),
+                    FakeObject(index=2, name="off")]
+        ports = [FakeObject(index=0, name=BLUETOOTH_PORT_NAME, latency_offset=0)]
+        card = self.add("card", name="bluez_card.%s" % normal_mac, description=description,
+                        profile_list=profiles, profile_active=profiles[0], port_list=ports)
+        card.mac = normal_mac
+        card.sink_description = description
+        self._add_profile_sink(card, profile)
+        return card
+
+    def remove_bluetooth_card(self, mac):
+        card = self.find("card", name="bluez_card.%s" % mac.replace(":", "_"))
+        if card is None:
+            return
+        self._remove_profile_sinks(card)
+        self.remove("card", card.index)
+
+    def _add_profile_sink(self, card, profile):
+        if profile == "off":
+            return
+        port = next((port for port in card.port_list if port.name == BLUETOOTH_PORT_NAME), None)
+        self.add_sink("bluez_sink.%s.%s" % (card.mac, profile), card.sink_description, card=card.index,
+                      port_active=port)
+
+    def _remove_profile_sinks(self, card):
+        for sink in list(self.objects["sink"].values()):
+            if getattr(sink, "card", None) == card.index:
+                self.remove_sink(sink.index)
+
+    def set_card_profile(self, card_index, profile):
+        with self.lock:
+            card = self.objects["card"][card_index]
+            active = next(p for p in card.profile_list if p.name == profile)
+        self._remove_profile_sinks(card)
+        self.change("card", card_index, profile_active=active)
+        self._add_profile_sink(card, profile)
+
+    def set_port_latency_offset(self, card_name, port_name, offset):
+        """
+        Set the latency offset of a card port. Has the same signature as
+        PulseAudio.set_port_latency_offset, and fails like pactl does for a
+        card or port that is not there.
+        :return: None
+        """
+        self.calls["set_port_latency_offset"] += 1
+        card = self.find("card", name=card_name)
+        port = None
+        if card is not None:
+            port = next((port for port in card.port_list if port.name == port_name), None)
+        if port is None:
+            raise RuntimeError("Failure: No such entity")
+        with self.lock:
+            port.latency_offset = offset
+        self._announce("card", "change", card)
+
+    # Streams
+
+    def move_sink_input(self, index, sink_index):
+        with self.lock:
+            if index not in self.objects["sink_input"] or sink_index not in self.objects["sink"]:
+                raise PulseIndexError(index)
+        stream = self.change("sink_input", index, sink=sink_index)
+        for hook in list(self.move_hooks):
+            hook(stream, sink_index)
+        # The EQ sink describes itself by its master.
+        if stream.name == LADSPA_STREAM_NAME and self.eq_sink is not None:
+            master = self.objects["sink"][sink_index]
+            self.change("sink", self.eq_sink.index,
+                        description="%s on %s" % (LADSPA_SINK_DESCRIPTION, master.description))
+
+
+class FakePulse:
+    """A pulsectl.Pulse connection to a FakePulseServer."""
+    def __init__(self, server, client_name):
+        self.server = server
+        self.name = client_name
+        self.event_types = set()
+        self.event_callback = None
+        self._events = collections.deque()
+        self._events_changed = threading.Condition()
+
+    def close(self):
+        self.server.disconnect(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Lists and info
+
+    def _list(self, facility):
+        self.server.calls[facility + "_list"] += 1
+        with self.server.lock:
+            return [copy.copy(obj) for obj in self.server.objects[facility].values()]
+
+    def _info(self, facility, index):
+        self.server.calls[facility + "_info"] += 1
+        with self.server.lock:
+            try:
+                return copy.copy(self.server.objects[facility][index])
+            except KeyError:
+                raise PulseIndexError(index)
+
+    def sink_list(self):
+        return self._list("sink")
+
+    def source_list(self):
+        return self._list("source")
+
+    def card_list(self):
+        return self._list("card")
+
+    def sink_input_list(self):
+        return self._list("sink_input")
+
+    def sink_info(self, index):
+        return self._info("sink", index)
+
+    def source_info(self, index):
+        return self._info("source", index)
+
+    def card_info(self, index):
+        return self._info("card", index)
+
+    def sink_input_info(self, index):
+        return self._info("sink_input", index)
+
+    # Commands
+
+    def sink_input_move(self, index, sink_index):
+        self.server.calls["sink_input_move"] += 1
+        self.server.move_sink_input(index, sink_index)
+
+    def sink_input_mute(self, index, mute):
+        self.server.calls["sink_input_mute"] += 1
+        self.server.change("sink_input", index, mute=bool(mute))
+
+    def card_profile_set(self, card, profile):
+        self.server.calls["card_profile_set"] += 1
+        self.server.set_card_profile(card.index, getattr(profile, "name", profile))
+
+    def sink_suspend(self, index, suspend):
+        self.server.calls["sink_suspend"] += 1
+        self.server.change("sink", index, state="suspended" if suspend else "idle")
+
+    def source_default_set(self, name):
+        self.server.calls["source_default_set"] += 1
+        self.server.default_source = name
+
+    # Events
+
+    def event_mask_set(self, *masks):
+        self.event_types = set(str(mask) for mask in masks)
+
+    def event_callback_set(self, callback):
+        self.event_callback = callback
+
+    def deliver(self, event):
+        if event.facility not in self.event_types or self.event_callback is None:
+            return
+        with self._events_changed:
+            self._events.append(event)
+            self._events_changed.notify_all()
+
+    def event_listen(self, timeout=None, raise_on_disconnect=True):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._events_changed:
+                while not self._events:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    self._events_changed.wait(remaining)
+                event = self._events.popleft()
+            try:
+                self.event_callback(event)
+            except PulseLoopStop:
+                return
+
+
+class PrivateBus:
+    """
+    A dbus-daemon of our own. Both the system and session bus of this
+    process (and its children) point at it while it runs.
+    """
+    CONFIG = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:tmpdir=%s</listen>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+    def __init__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="maxime-bus-")
+        config_path = os.path.join(self.tmpdir, "bus.conf")
+        with open(config_path, "w") as f:
+            f.write(self.CONFIG % self.tmpdir)
+
+        self.process = subprocess.Popen(["dbus-daemon", "--config-file", config_path, "--nofork",
+                                         "--print-address=1"],
+                                        stdout=subprocess.PIPE, universal_newlines=True)
+        self.address = self.process.stdout.readline().strip()
+        os.environ["DBUS_SESSION_BUS_ADDRESS"] = self.address
+        os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = self.address
+        os.environ["XDG_RUNTIME_DIR"] = self.tmpdir
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class FakeBluezDevice(dbus.service.Object):
+    """An org.bluez.Device1 whose connection we control."""
+    def __init__(self, bus, path, mac):
+        self.path = path
+        self.mac = mac
+        self.connected = False
+        dbus.service.Object.__init__(self, bus, path)
+
+    def properties(self):
+        return {"Address": dbus.String(self.mac), "Connected": dbus.Boolean(self.connected)}
+
+    def set_connected(self, connected):
+        """Change the connection state and announce it like BlueZ does."""
+        self.connected = connected
+        self.PropertiesChanged(BLUEZ_INTERFACE_DEVICE, {"Connected": dbus.Boolean(connected)}, [])
+        self.PropertiesChanged(BLUEZ_INTERFACE_DEVICE, {"ServicesResolved": dbus.Boolean(connected)}, [])
+
+    @dbus.service.method(BLUEZ_INTERFACE_DEVICE)
+    def Connect(self):
+        self.set_connected(True)
+
+    @dbus.service.method(BLUEZ_INTERFACE_DEVICE)
+    def Disconnect(self):
+        self.set_connected(False)
+
+    @dbus.service.method(INTERFACE_PROPERTIES, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        return self.properties()[name]
+
+    @dbus.service.method(INTERFACE_PROPERTIES, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        return self.properties()
+
+    @dbus.service.signal(INTERFACE_PROPERTIES, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+class FakeBluez(dbus.service.Object):
+    """org.bluez with an ObjectManager at / and devices under /org/bluez/hci0."""
+    def __init__(self, bus):
+        self.bus = bus
+        self.bus_name = dbus.service.BusName(BLUEZ_SERVICE, bus=bus)
+        self.devices = {}
+        dbus.service.Object.__init__(self, bus, "/")
+
+    def add_device(self, mac, adapter="hci0"):
+        path = "/org/bluez/%s/dev_%s" % (adapter, mac.replace(":", "_"))
+        device = FakeBluezDevice(self.bus, path, mac)
+        self.devices[mac] = device
+        self.InterfacesAdded(path, {BLUEZ_INTERFACE_DEVICE: device.properties()})
+        return device
+
+    @dbus.service.method(INTERFACE_OBJECTMANAGER, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return dict((device.path, {BLUEZ_INTERFACE_DEVICE: device.properties()})
+                    for device in self.devices.values())
+
+    @dbus.service.signal(INTERFACE_OBJECTMANAGER, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(INTERFACE_OBJECTMANAGER, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+
+class FakeNotifications(dbus.service.Object):
+    """org.freedesktop.Notifications that counts what it is sent."""
+    SERVICE = "org.freedesktop.Notifications"
+    PATH = "/org/freedesktop/Notifications"
+
+    def __init__(self, bus):
+        self.bus_name = dbus.service.BusName(self.SERVICE, bus=bus)
+        self.received = 0
+        self._ids = itertools.count(1)
+        dbus.service.Object.__init__(self, bus, self.PATH)
+
+    @dbus.service.method(SERVICE, in_signature="susssasa{sv}i", out_signature="u")
+    def Notify(self, app_name, replaces_id, icon, summary, body, actions, hints, timeout):
+        self.received += 1
+        return replaces_id or next(self._ids)
+
+
+class FakeServices:
+    """
+    FakeBluez and FakeNotifications served from a child process with its own
+    main loop. dbus-python cannot answer calls that it makes to itself while
+    it blocks, so the services cannot share a connection with maxime.
+    """
+    READY_TIMEOUT = 10
+
+    def __init__(self, macs):
+        """
+        Constructor. Start a PrivateBus first.
+        :param macs: MAC addresses of the devices BlueZ knows.
+        """
+        self.macs = list(macs)
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=self._serve, args=(ready,), daemon=True)
+        self.process.start()
+        if ready.wait(self.READY_TIMEOUT) is False:
+            raise RuntimeError("Fake BlueZ did not start within %s seconds" % self.READY_TIMEOUT)
+
+    def _serve(self, ready):
+        from dbus.mainloop.glib import DBusGMainLoop
+        from gi.repository import GLib
+        DBusGMainLoop(set_as_default=True)
+        bluez = FakeBluez(dbus.SystemBus())
+        for mac in self.macs:
+            bluez.add_device(mac)
+        FakeNotifications(dbus.SessionBus())
+        ready.set()
+        GLib.MainLoop().run()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class BluezClient:
+    """Drives the fake devices over a bus connection of its own."""
+    def __init__(self, adapter="hci0"):
+        self.bus = dbus.SystemBus(private=True)
+        self.adapter = adapter
+
+    def _device(self, mac):
+        path = "/org/bluez/%s/dev_%s" % (self.adapter, mac.replace(":", "_"))
+        return dbus.Interface(self.bus.get_object(BLUEZ_SERVICE, path), BLUEZ_INTERFACE_DEVICE)
+
+    def connect(self, mac):
+        self._device(mac).Connect()
+
+    def disconnect(self, mac):
+        self._device(mac).Disconnect()
+
+    def close(self):
+        self.bus.close()
+
+
+def write_config(directory, bluetooth_options=None, **daemon_options):
+    """
+    Write a maxime config for the fakes to a directory.
+    :param directory: Where to put it.
+    :param bluetooth_options: Dictionary of extra [bluetooth] options.
+    :param daemon_options: Extra [daemon] options.
+    :return: Path of the config file.
+    """
+    path = os.path.join(directory, "maxime.ini")
+    lines = ["[bluetooth]", "device_mac=DE:AD:BE:EF:CA:FE", "adapter=hci0",
+             "output_device=Bose QuietComfort 35", "sink_timeout=5"]
+    lines += ["%s=%s" % item for item in sorted((bluetooth_options or {}).items())]
+    lines += ["",
+              "[headset]", "output_device=Built-in Audio Analog Stereo",
+              "input_device=Built-in Audio Analog Stereo", "",
+              "[speakers]", "output_device=SB X-Fi Surround 5.1 Pro Digital Stereo (IEC958)",
+              "input_device=SB X-Fi Surround 5.1 Pro Analog Stereo", "",
+              "[daemon]"]
+    lines += ["%s=%s" % item for item in sorted(daemon_options.items())]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+"""
+Replay a trace recorded with ``maxime.py --record`` through the daemon.
+
+The daemon runs in-process against the same fakes as routing.py (see
+fakes.py). The trace's config is used, its first Pulse and BlueZ listings
+set up the fakes, and then every record is fed in at the time it was
+recorded:
+
+* BlueZ connection changes of our devices go through the fake BlueZ, like
+  a real link would. Other BlueZ signals are handed to the listener.
+* Pulse objects and events are applied to the fake Pulse server. Recorded
+  objects are matched to the ones the daemon made itself during the replay
+  (say by switching a card profile) by name. Streams only take their sink
+  from the trace when they show up, since moving them is what the daemon
+  decides.
+* Commands are run through the control service.
+
+The replay records a trace of its own, and every time the daemon moved
+streams is a decision. Its latency is from what set it off: the last
+connection change or command, or a new stream for one that followed the
+target. Decisions in the recorded trace are worked out the same way, so
+the two can be compared.
+
+--fast replays as fast as the debounce windows allow: gaps between records
+are cut down to just over the longest window, so that the same events
+still settle together. Results can be saved with --json and compared
+against an earlier replay with --baseline, which fails if the decisions
+changed or got slower than the tolerance allows.
+"""
+import argparse
+import configparser
+import difflib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakes  # noqa: E402
+import routing  # noqa: E402
+from maxime import BluetoothDevice, PulseCache, TraceRecorder  # noqa: E402
+
+# Seconds on top of the longest debounce window, for --fast and at the end.
+SETTLE_MARGIN = 0.1
+
+
+def read_trace(path, session=-1):
+    """
+    Read a recording session from a trace. The daemon appends a session
+    every time it starts.
+    :param path: Path of the trace file.
+    :param session: Which session, counted from 0. Negative counts from the end.
+    :return: List of records.
+    """
+    sessions = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The daemon died in the middle of a line.
+                continue
+            if record[1] == TraceRecorder.KIND_START:
+                sessions.append([])
+            if sessions:
+                sessions[-1].append(record)
+    if not sessions:
+        raise ValueError("\"%s\" has no recording in it" % path)
+    return sessions[session]
+
+
+def connection_change(member, args):
+    """
+    Tell whether a BlueZ signal says that a device (dis)connected.
+    :param member: Signal name.
+    :param args: Signal arguments.
+    :return: Boolean of whether it connected, or None if it says neither.
+    """
+    if member != "PropertiesChanged" or args[0] != BluetoothDevice.DBUS_INTERFACE_DEVICE:
+        return None
+    if "Connected" not in args[1]:
+        return None
+    return bool(args[1]["Connected"])
+
+
+def find_decisions(records):
+    """
+    Pair every time streams were moved with what set it off. A move that
+    followed a new stream is down to that stream. Any other is down to the
+    last connection change or command, unless an earlier move already was.
+    :param records: Records of a trace.
+    :return: List of decision dictionaries.
+    """
+    decisions = []
+    cause = None
+    new_stream = None
+    for record in records:
+        when, kind, fields = record[0], record[1], record[2:]
+        if kind == TraceRecorder.KIND_BLUEZ:
+            member, path, args = fields
+            connected = connection_change(member, args)
+            if connected is not None:
+                cause = (when, "%s %s" % ("connect" if connected else "disconnect",
+                                          BluetoothDevice.get_mac_from_object_path(path)))
+        elif kind == TraceRecorder.KIND_COMMAND:
+            cause = (when, " ".join(["command", fields[0]] + fields[1]))
+        elif kind == TraceRecorder.KIND_PULSE:
+            facility, event_type, _, obj = fields
+            if facility == PulseCache.FACILITY_SINK_INPUT and event_type == PulseCache.EVENT_NEW and obj:
+                new_stream = (when, "new stream %s" % obj["name"])
+        elif kind == TraceRecorder.KIND_ROUTE:
+            sink, output, streams, reason = fields
+            if reason == TraceRecorder.REASON_FOLLOW:
+                trigger = new_stream
+            else:
+                trigger, cause = cause, None
+            decisions.append({
+                "time": when,
+                "cause": trigger[1] if trigger is not None else None,
+                "output": output,
+                "sink": sink,
+                "streams": streams,
+                "reason": reason,
+                "latency_ms": round((when - trigger[0]) * 1000, 3) if trigger is not None else None,
+            })
+    return decisions
+
+
+def describe(decision):
+    """What was decided, without when or how fast."""
+    return "%s -> %s (%s)" % (decision["cause"], decision["output"], ", ".join(decision["streams"]))
+
+
+def summarize(decisions):
+    """
+    Latency percentiles of decisions that had a cause.
+    :return: Dictionary
+    """
+    samples = sorted(d["latency_ms"] for d in decisions if d["latency_ms"] is not None)
+    return {
+        "decisions": len(decisions),
+        "p50_ms": routing.percentile(samples, 0.50),
+        "p95_ms": routing.percentile(samples, 0.95),
+        "max_ms": samples[-1] if samples else None,
+    }
+
+
+def compare(decisions, previous, tolerance):
+    """
+    Compare decisions against those of an earlier replay.
+    :param decisions: List of decision dictionaries.
+    :param previous: List of decision dictionaries of the earlier replay.
+    :param tolerance: Allowed latency slowdown, as a fraction.
+    :return: List of strings describing differences.
+    """
+    differences = ["decision %s" % line for line in difflib.unified_diff(
+        [describe(d) for d in previous], [describe(d) for d in decisions], lineterm="", n=0)
+        if line[:1] in "+-" and line[:3] not in ("+++", "---")]
+
+    now, before = summarize(decisions), summarize(previous)
+    for key in ("p50_ms", "p95_ms"):
+        if now[key] is not None and before[key] is not None and now[key] > before[key] * (1 + tolerance):
+            differences.append("%s went from %.1f to %.1f ms" % (key, before[key], now[key]))
+    return differences
+
+
+class PulseMirror:
+    """
+    Applies recorded Pulse objects and events to a FakePulseServer, whose
+    objects get indexes of their own.
+    """
+    # Attributes that hold the index of another object, and its facility.
+    REFERENCES = {"card": PulseCache.FACILITY_CARD, "monitor_of_sink": PulseCache.FACILITY_SINK,
+                  "sink": PulseCache.FACILITY_SINK}
+    # Facilities in the order that they refer to each other.
+    LOAD_ORDER = (PulseCache.FACILITY_CARD, PulseCache.FACILITY_SINK, PulseCache.FACILITY_SOURCE,
+                  PulseCache.FACILITY_SINK_INPUT)
+    BT_CARD_PREFIX = "bluez_card."
+
+    def __init__(self, server):
+        self.server = server
+        # (facility, recorded index) to server index, and back.
+        self.indexes = {}
+        self.recorded = {}
+        # References to objects we have not seen yet, as (facility, recorded
+        # index, attribute, referenced facility, referenced recorded index).
+        self.unresolved = set()
+
+    def _attributes(self, facility, fields):
+        """
+        Turn recorded attributes into ones for the fake server.
+        :return: Dictionary
+        """
+        attributes = dict(fields)
+        del attributes["index"]
+        for key, target in self.REFERENCES.items():
+            if key in attributes:
+                index = self.indexes.get((target, attributes[key]))
+                if index is None and attributes[key] is not None:
+                    self.unresolved.add((facility, fields["index"], key, target, attributes[key]))
+                attributes[key] = index
+
+        if facility == PulseCache.FACILITY_CARD:
+            profiles = [fakes.FakeObject(index=number, name=name)
+                        for number, name in enumerate(attributes.get("profile_list") or [])]
+            attributes["profile_list"] = profiles
+            attributes["profile_active"] = next((p for p in profiles if p.name == attributes.get("profile_active")),
+                                                None)
+            attributes["port_list"] = [fakes.FakeObject(index=number, name=name, latency_offset=0)
+                                       for number, name in enumerate(attributes.get("port_list") or [])]
+            # What the fake needs to make sinks for profiles the daemon switches to.
+            name = attributes.get("name") or ""
+            if name.startswith(self.BT_CARD_PREFIX):
+                attributes["mac"] = name[len(self.BT_CARD_PREFIX):]
+            attributes["sink_description"] = attributes.get("description")
+        elif facility == PulseCache.FACILITY_SINK:
+            if attributes.get("port_active") is not None:
+                attributes["port_active"] = fakes.FakeObject(name=attributes["port_active"])
+            attributes.setdefault("latency", 0)
+            attributes.setdefault("configured_latency", 0)
+        return attributes
+
+    def _map(self, facility, recorded_index, index):
+        self.indexes[(facility, recorded_index)] = index
+        self.recorded[(facility, index)] = recorded_index
+        for reference in list(self.unresolved):
+            referrer, referrer_index, key, target, target_index = reference
+            if (target, target_index) != (facility, recorded_index):
+                continue
+            self.unresolved.discard(reference)
+            index_now = self.indexes.get((referrer, referrer_index))
+            if index_now is not None and index_now in self.server.objects[referrer]:
+                self.server.change(referrer, index_now, **{key: index})
+
+    def _unmap(self, facility, recorded_index):
+        index = self.indexes.pop((facility, recorded_index), None)
+        if index is not None:
+            self.recorded.pop((facility, index), None)
+        return index
+
+    def _find_unmapped(self, facility, name):
+        for obj in list(self.server.objects[facility].values()):
+            if obj.name == name and (facility, obj.index) not in self.recorded:
+                return obj
+        return None
+
+    def load(self, facility, objects):
+        """
+        Make a facility look like a recorded listing.
+        :param facility: One of the PulseCache.FACILITY_* constants.
+        :param objects: Recorded objects.
+        :return: None
+        """
+        listed = set(fields["index"] for fields in objects)
+        for facility_of, recorded_index in list(self.indexes):
+            if facility_of == facility and recorded_index not in listed:
+                self.remove(facility, recorded_index)
+        for fields in objects:
+            self.new(facility, fields)
+
+    def new(self, facility, fields):
+        """
+        Add a recorded object, or update the one we have for it.
+        :return: None
+        """
+        index = self.indexes.get((facility, fields["index"]))
+        if index is not None and index in self.server.objects[facility]:
+            self.change(facility, fields)
+            return
+
+        attributes = self._attributes(facility, fields)
+        if facility != PulseCache.FACILITY_SINK_INPUT:
+            existing = self._find_unmapped(facility, fields["name"])
+            if existing is not None:
+                self._map(facility, fields["index"], existing.index)
+                self.server.change(facility, existing.index, **attributes)
+                return
+        self._map(facility, fields["index"], self.server.add(facility, **attributes).index)
+
+    def change(self, facility, fields):
+        """
+        Update an object. Ones we never saw are added, ones that are gone
+        (the daemon may have been quicker to remove them) are left alone.
+        :return: None
+        """
+        index = self.indexes.get((facility, fields["index"]))
+        if index is None:
+            self.new(facility, fields)
+            return
+        if index not in self.server.objects[facility]:
+            return
+        attributes = self._attributes(facility, fields)
+        if facility == PulseCache.FACILITY_SINK_INPUT:
+            attributes.pop("sink", None)
+        self.server.change(facility, index, **attributes)
+
+    def remove(self, facility, recorded_index):
+        """
+        Remove an object. Streams on a sink that goes away are moved like Pulse does.
+        :return: None
+        """
+        index = self._unmap(facility, recorded_index)
+        if index is None or index not in self.server.objects[facility]:
+            return
+        if facility == PulseCache.FACILITY_SINK:
+            self.server.remove_sink(index)
+        else:
+            self.server.remove(facility, index)
+
+    def apply(self, facility, event_type, recorded_index, fields):
+        """
+        Apply a recorded event.
+        :return: None
+        """
+        if event_type == PulseCache.EVENT_REMOVE or fields is None:
+            self.remove(facility, recorded_index)
+        elif event_type == PulseCache.EVENT_NEW:
+            self.new(facility, fields)
+        else:
+            self.change(facility, fields)
+
+
+class Replay:
+    """Runs the daemon against fakes and feeds it a recorded session."""
+    def __init__(self, records, speed, output):
+        """
+        Constructor
+        :param records: Records of one session.
+        :param speed: How many times as fast as recorded, or None for --fast.
+        :param output: Path to record the replay's own trace to.
+        """
+        self.records = records
+        self.speed = speed
+        self.skipped = 0
+        self.tmpdir = tempfile.mkdtemp(prefix="maxime-replay-")
+        self.bus = fakes.PrivateBus()
+
+        config_path = self._write_config(records[0][4])
+        sys.argv = ["maxime.py", "-c", config_path, "-l", os.path.join(self.tmpdir, "maxime.log")]
+        import maxime
+        self.maxime = maxime
+        self.app = maxime.Maxime()
+        self.config = self.app.config
+        TraceRecorder.shared().open(output, self.config)
+
+        # The fakes start out with the first listings, which are not fed again.
+        self.server = fakes.FakePulseServer()
+        self.mirror = PulseMirror(self.server)
+        self.initial = set()
+        listings = {}
+        bluez_objects = None
+        for number, record in enumerate(records):
+            if record[1] == TraceRecorder.KIND_PULSE_OBJECTS and record[2] not in listings:
+                listings[record[2]] = record[3]
+            elif record[1] == TraceRecorder.KIND_BLUEZ_OBJECTS and bluez_objects is None:
+                bluez_objects = record[2]
+            else:
+                continue
+            self.initial.add(number)
+        for facility in PulseMirror.LOAD_ORDER:
+            self.mirror.load(facility, listings.get(facility, []))
+
+        bt_devices = maxime.BluetoothDevice.get_devices(self.config)
+        self.bt_device = bt_devices[0]
+        self.devices = dict((device.mac, device) for device in bt_devices)
+        self.services = fakes.FakeServices(list(self.devices))
+        self.client = fakes.BluezClient()
+        for path, interfaces in (bluez_objects or {}).items():
+            properties = interfaces.get(BluetoothDevice.DBUS_INTERFACE_DEVICE, {})
+            if properties.get("Connected") and str(properties.get("Address", "")).upper() in self.devices:
+                self.client.connect(properties["Address"].upper())
+
+        maxime.PulseAudio.open_connection = staticmethod(self.server.connect)
+        maxime.PulseAudio.set_port_latency_offset = staticmethod(self.server.set_port_latency_offset)
+        self.worker = maxime.RoutingWorker(self.config)
+        self.connection_worker = maxime.RoutingWorker(self.config, name="connection")
+        self.pulse = maxime.PulseAudio(self.config, self.bt_device,
+                                       maxime.GenericAudioDevice(self.config, 'speakers'),
+                                       maxime.GenericAudioDevice(self.config, 'headset'))
+        self.pulse.schedule = lambda function: self.worker.submit(function, key=maxime.PulseAudio.JOB_RECOVER)
+        self.pulse.watch()
+        self.listener = maxime.DBusListener(bt_devices, self.pulse, self.config, self.worker)
+        self.app.connections.attach(self.listener)
+        self.control = maxime.ControlService(self.app, self.bt_device, self.pulse, self.worker,
+                                             self.connection_worker)
+
+        debouncer = self.listener.debouncer
+        self.settle_time = max(debouncer.connect_window, debouncer.disconnect_window) + SETTLE_MARGIN
+
+    def _write_config(self, sections):
+        """
+        Write the recorded config, pointed at the fakes.
+        :param sections: Dictionary of sections to their options.
+        :return: Path of the config file.
+        """
+        config = configparser.RawConfigParser()
+        for section, options in sections.items():
+            config[section] = options
+            if section == "bluetooth" or section.startswith("bluetooth:"):
+                # The fake BlueZ has every device on hci0.
+                config[section]["backend"] = "dbus"
+                config[section]["adapter"] = "hci0"
+        # Neither would see anything real, and they would act on their own.
+        for section in ("metrics", "monitor"):
+            if config.has_section(section):
+                config[section]["enabled"] = "false"
+                config[section]["textfile"] = ""
+        path = os.path.join(self.tmpdir, "maxime.ini")
+        with open(path, "w") as f:
+            config.write(f)
+        return path
+
+    def _device_path(self, path):
+        """
+        Move the object path of one of our devices onto the fake's adapter.
+        :param path: Recorded object path.
+        :return: Object path.
+        """
+        device = self.devices.get(BluetoothDevice.get_mac_from_object_path(path))
+        return device.dbus_object_path if device is not None else path
+
+    @staticmethod
+    def _on_main_loop(function, *args, **kwargs):
+        """Call a function once from the main loop."""
+        from gi.repository import GLib
+
+        def call():
+            function(*args, **kwargs)
+            return False
+        GLib.idle_add(call)
+
+    def _feed_bluez(self, member, path, args):
+        mac = BluetoothDevice.get_mac_from_object_path(path)
+        connected = connection_change(member, args)
+        if connected is not None and mac in self.devices:
+            if connected is True:
+                self.client.connect(mac)
+            else:
+                self.client.disconnect(mac)
+            return
+
+        if member in (self.listener.SIGNAL_INTERFACESADDED, self.listener.SIGNAL_INTERFACESREMOVED):
+            args = [self._device_path(args[0])] + list(args[1:])
+        else:
+            path = self._device_path(path)
+        self._on_main_loop(self.listener._bluez_signal_handler, *args, path=path, member=member)
+
+    def _feed_command(self, name, args):
+        def reply(*result):
+            pass
+
+        def error(e):
+            pass
+
+        function = getattr(self.app, name, None)
+        if name in ("connect", "disconnect", "reconnect"):
+            self._on_main_loop(self.control.run_connection, function, reply, error)
+        elif name in ("status", "route", "toggle", "resync"):
+            self._on_main_loop(self.control.run, function, tuple([self.pulse] + args), reply, error)
+        else:
+            self.skipped += 1
+
+    def _feed(self, record):
+        kind, fields = record[1], record[2:]
+        if kind == TraceRecorder.KIND_BLUEZ:
+            self._feed_bluez(*fields)
+        elif kind == TraceRecorder.KIND_PULSE:
+            self.mirror.apply(*fields)
+        elif kind == TraceRecorder.KIND_PULSE_OBJECTS:
+            self.mirror.load(*fields)
+        elif kind == TraceRecorder.KIND_COMMAND:
+            self._feed_command(*fields)
+        elif kind not in (TraceRecorder.KIND_START, TraceRecorder.KIND_ROUTE):
+            self.skipped += 1
+
+    def _settle(self):
+        """Wait until the debouncer, the main loop and both workers have nothing left to do."""
+        from gi.repository import GLib
+        time.sleep(self.settle_time)
+        for _ in range(2):
+            idle = threading.Event()
+            GLib.idle_add(lambda: idle.set() or False)
+            idle.wait()
+            for worker in (self.connection_worker, self.worker):
+                drained = threading.Event()
+                worker.submit(drained.set)
+                drained.wait()
+
+    def run_records(self):
+        started = time.monotonic()
+        elapsed = 0
+        previous = self.records[0][0]
+        for number, record in enumerate(self.records):
+            gap = record[0] - previous
+            previous = record[0]
+            elapsed += min(gap, self.settle_time) if self.speed is None else gap / self.speed
+            delay = started + elapsed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if number not in self.initial:
+                self._feed(record)
+        self._settle()
+
+    def run(self):
+        """
+        Replay from a thread while the main loop dispatches signals.
+        :return: Records of the replay's own trace.
+        """
+        from gi.repository import GLib
+        loop = GLib.MainLoop()
+        failure = []
+
+        def drive():
+            try:
+                self.run_records()
+            except Exception as e:
+                failure.append(e)
+            finally:
+                GLib.idle_add(loop.quit)
+
+        threading.Thread(target=drive, daemon=True).start()
+        loop.run()
+        recorder = TraceRecorder.shared()
+        recorder.close()
+        self.client.close()
+        self.services.stop()
+        self.bus.stop()
+        if failure:
+            raise failure[0]
+        return read_trace(recorder.path)
+
+
+def format_ms(value):
+    return "%9.2f" % value if value is not None else "%9s" % "-"
+
+
+def print_summary(label, summary):
+    print("%-9s %4d decision(s), p50 %s ms, p95 %s ms, max %s ms"
+          % (label, summary["decisions"], format_ms(summary["p50_ms"]).strip(),
+             format_ms(summary["p95_ms"]).strip(), format_ms(summary["max_ms"]).strip()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a trace recorded with maxime.py --record against fakes "
+                                                 "and report each routing decision and its latency.")
+    parser.add_argument("trace",
+                        help="trace file to replay")
+    parser.add_argument("--session", type=int, default=-1,
+                        help="which recording in the trace to replay, from 0 (default the last one)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times as fast as recorded (default 1)")
+    parser.add_argument("--fast", default=False, action="store_true",
+                        help="replay as fast as the debounce windows allow")
+    parser.add_argument("--output", default=None,
+                        help="keep the trace of the replay in this file")
+    parser.add_argument("--json", default=None,
+                        help="write results to this file")
+    parser.add_argument("--baseline", default=None,
+                        help="results of an earlier replay to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (default 0.25)")
+    args = parser.parse_args()
+
+    records = read_trace(args.trace, args.session)
+    output = args.output or os.path.join(tempfile.mkdtemp(prefix="maxime-replay-"), "replay.trace")
+    replay = Replay(records, None if args.fast else args.speed, output)
+    decisions = find_decisions(replay.run())
+    recorded = find_decisions(records)
+
+    print("%9s %9s  %-32s %s" % ("time", "latency", "cause", "decision"))
+    for decision in decisions:
+        print("%9.3f %s  %-32s %s (%s)%s"
+              % (decision["time"], format_ms(decision["latency_ms"]), decision["cause"] or "-",
+                 decision["output"], ", ".join(decision["streams"]),
+                 " [follow]" if decision["reason"] == TraceRecorder.REASON_FOLLOW else ""))
+    print()
+    print_summary("replayed", summarize(decisions))
+    print_summary("recorded", summarize(recorded))
+    differences = compare(decisions, recorded, float("inf"))
+    print("%s decision(s) differ from the recording." % len(differences))
+    if replay.skipped:
+        print("%s record(s) could not be replayed." % replay.skipped)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"trace": os.path.abspath(args.trace), "speed": "fast" if args.fast else args.speed,
+                       "decisions": decisions, "recorded": recorded}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            differences = compare(decisions, json.load(f)["decisions"], args.tolerance)
+        for difference in differences:
+            print("REGRESSION %s" % difference)
+        if differences:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Routing latency benchmark for the maxime.py daemon.
+
+The daemon runs in-process against fakes (see fakes.py): a Pulse server with
+a configurable number of sinks, and a private dbus-daemon where a child
+process plays BlueZ and the notification daemon. Nothing touches real audio
+or Bluetooth, so the numbers only show maxime's own overhead and how it
+scales with the number of Pulse objects.
+
+Scenarios, each timed per run:
+
+* connect-reroute: BlueZ Connect call until the EQ stream is moved to the
+  headphones.
+* disconnect-reroute: BlueZ Disconnect call until it is moved to the speakers.
+* toggle, status, resync: the one-shot mode's work, called on the daemon's
+  Pulse connection.
+
+Each sink count runs in a fresh worker process. Results are p50/p95/p99 in
+milliseconds, and can be saved with --json.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakes  # noqa: E402
+
+SCENARIOS = ("connect-reroute", "disconnect-reroute", "toggle", "status", "resync")
+SINK_COUNTS = (5, 50, 500)
+REROUTE_TIMEOUT = 10
+
+
+def percentile(samples, fraction):
+    """
+    Nearest-rank percentile.
+    :param samples: Sorted list of numbers.
+    :param fraction: 0 to 1.
+    :return: The percentile, or None without samples.
+    """
+    if not samples:
+        return None
+    rank = max(int(round(fraction * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def summarize(sink_count, scenario, samples, failures):
+    samples = sorted(samples)
+    return {
+        "sinks": sink_count,
+        "scenario": scenario,
+        "runs": len(samples),
+        "failures": failures,
+        "p50_ms": percentile(samples, 0.50),
+        "p95_ms": percentile(samples, 0.95),
+        "p99_ms": percentile(samples, 0.99),
+        "max_ms": samples[-1] if samples else None,
+    }
+
+
+class Worker:
+    """Runs every scenario against one fake desk."""
+    def __init__(self, sink_count, runs, resync_runs):
+        self.sink_count = sink_count
+        self.runs = runs
+        self.resync_runs = resync_runs
+        self.tmpdir = tempfile.mkdtemp(prefix="maxime-bench-")
+        self.bus = fakes.PrivateBus()
+
+        config_path = fakes.write_config(self.tmpdir, debounce_connect=0, debounce_disconnect=0)
+        sys.argv = ["maxime.py", "-c", config_path, "-l", os.path.join(self.tmpdir, "maxime.log")]
+        import maxime
+        self.maxime = maxime
+        self.app = maxime.Maxime()
+        self.config = self.app.config
+
+        self.server = fakes.FakePulseServer()
+        self.server.populate(sink_count, self.config)
+        self.server.move_hooks.append(self._stream_moved)
+        self._moved = threading.Event()
+        self._moved_at = None
+        self._moved_to = None
+
+        bt_devices = maxime.BluetoothDevice.get_devices(self.config)
+        self.bt_device = bt_devices[0]
+        self.services = fakes.FakeServices([device.mac for device in bt_devices])
+        self.client = fakes.BluezClient()
+
+        maxime.PulseAudio.open_connection = staticmethod(self.server.connect)
+        maxime.PulseAudio.set_port_latency_offset = staticmethod(self.server.set_port_latency_offset)
+        self.pulse = maxime.PulseAudio(self.config, self.bt_device,
+                                       maxime.GenericAudioDevice(self.config, 'speakers'),
+                                       maxime.GenericAudioDevice(self.config, 'headset'))
+        self.pulse.watch()
+        self.worker = maxime.RoutingWorker(self.config)
+        self.listener = maxime.DBusListener(bt_devices, self.pulse, self.config, self.worker)
+        self.results = []
+
+    def _stream_moved(self, stream, sink_index):
+        if stream.name != fakes.LADSPA_STREAM_NAME:
+            return
+        self._moved_at = time.perf_counter()
+        self._moved_to = self.server.objects["sink"][sink_index].description
+        self._moved.set()
+
+    def _wait_for_move(self, description):
+        """
+        Wait for the EQ stream to be moved to a sink.
+        :return: perf_counter of the move, or None if it did not happen.
+        """
+        deadline = time.monotonic() + REROUTE_TIMEOUT
+        while self._moved.wait(max(deadline - time.monotonic(), 0)):
+            self._moved.clear()
+            if self._moved_to == description:
+                return self._moved_at
+        return None
+
+    def _settle(self):
+        """Wait until the main loop and the routing worker have nothing left to do."""
+        from gi.repository import GLib
+        idle = threading.Event()
+        GLib.idle_add(lambda: idle.set() or False)
+        idle.wait()
+        drained = threading.Event()
+        self.worker.submit(drained.set)
+        drained.wait()
+
+    def _reroute(self, connect):
+        self._moved.clear()
+        if connect is True:
+            started = time.perf_counter()
+            self.client.connect(self.bt_device.mac)
+            self.server.add_bluetooth_card(self.bt_device.mac, self.bt_device.output_device)
+            moved_at = self._wait_for_move(self.bt_device.output_device)
+        else:
+            # Pulse drops the card as the link goes down.
+            self.server.remove_bluetooth_card(self.bt_device.mac)
+            started = time.perf_counter()
+            self.client.disconnect(self.bt_device.mac)
+            moved_at = self._wait_for_move(self.config.get("speakers", "output_device"))
+        self._settle()
+        if moved_at is None:
+            return None
+        return (moved_at - started) * 1000
+
+    def _timed(self, function, *args):
+        started = time.perf_counter()
+        try:
+            function(*args)
+        except Exception:
+            return None
+        return (time.perf_counter() - started) * 1000
+
+    def _collect(self, scenario, measurements):
+        samples = [m for m in measurements if m is not None]
+        self.results.append(summarize(self.sink_count, scenario, samples, len(measurements) - len(samples)))
+
+    def run_scenarios(self):
+        connects, disconnects = [], []
+        for _ in range(self.runs):
+            connects.append(self._reroute(True))
+            disconnects.append(self._reroute(False))
+        self._collect("connect-reroute", connects)
+        self._collect("disconnect-reroute", disconnects)
+
+        # The rest want the headphones around.
+        self._reroute(True)
+        self._collect("toggle", [self._timed(self.app.toggle, self.pulse) for _ in range(self.runs)])
+        self._collect("status", [self._timed(self.app.status, self.pulse) for _ in range(self.runs)])
+        self._collect("resync", [self._timed(self.app.resync, self.pulse) for _ in range(self.resync_runs)])
+
+    def run(self):
+        """
+        Run the scenarios from a thread while the main loop dispatches signals.
+        :return: List of result dictionaries.
+        """
+        from gi.repository import GLib
+        loop = GLib.MainLoop()
+        failure = []
+
+        def drive():
+            try:
+                self.run_scenarios()
+            except Exception as e:
+                failure.append(e)
+            finally:
+                GLib.idle_add(loop.quit)
+
+        threading.Thread(target=drive, daemon=True).start()
+        loop.run()
+        self.client.close()
+        self.services.stop()
+        self.bus.stop()
+        if failure:
+            raise failure[0]
+        return self.results
+
+
+def run_worker(sink_count, runs, resync_runs):
+    """
+    Benchmark one sink count in a fresh process.
+    :return: List of result dictionaries.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--worker", str(sink_count),
+               "-n", str(runs), "--resync-runs", str(resync_runs)]
+    proc = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return json.loads(proc.stdout)
+
+
+def format_ms(value):
+    return "%8.2f" % value if value is not None else "%8s" % "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure routing latency of the maxime.py daemon against fakes.")
+    parser.add_argument("-s", "--sinks", default=",".join(str(count) for count in SINK_COUNTS),
+                        help="comma separated sink counts to run (default %s)"
+                             % ",".join(str(count) for count in SINK_COUNTS))
+    parser.add_argument("-n", "--runs", type=int, default=50,
+                        help="runs per scenario (default 50)")
+    parser.add_argument("--resync-runs", type=int, default=20,
+                        help="runs of resync (default 20)")
+    parser.add_argument("--json", default=None,
+                        help="write results to this file")
+    parser.add_argument("--worker", type=int, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        json.dump(Worker(args.worker, args.runs, args.resync_runs).run(), sys.stdout)
+        return
+
+    results = []
+    print("%6s %-19s %5s %5s %8s %8s %8s %8s" % ("sinks", "scenario", "runs", "fail", "p50", "p95", "p99", "max"))
+    for sink_count in (int(count) for count in args.sinks.split(",")):
+        for result in run_worker(sink_count, args.runs, args.resync_runs):
+            results.append(result)
+            print("%6d %-19s %5d %5d %s %s %s %s"
+                  % (result["sinks"], result["scenario"], result["runs"], result["failures"],
+                     format_ms(result["p50_ms"]), format_ms(result["p95_ms"]), format_ms(result["p99_ms"]),
+                     format_ms(result["max_ms"])))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Soak test for the maxime.py daemon.
+
+The daemon runs for a whole session, so anything it leaks per event adds
+up. This drives it with many connect/disconnect events and route, toggle
+and resync commands against the same fakes as routing.py (see fakes.py),
+and samples the process as it goes:
+
+* RSS, from /proc/self/status.
+* open file descriptors.
+* threads.
+* child processes (the private dbus-daemon and the fake services are
+  expected, nothing else).
+
+After a warmup, the last part of the run is compared to the part right
+after the warmup. A resource that went up by more than its tolerance
+keeps growing, and the run fails. It also fails if any reroute or command
+did.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import routing  # noqa: E402
+
+RESOURCES = ("rss_kib", "fds", "threads", "children")
+# How much each resource may grow between the two windows. RSS moves around
+# with the allocator, the counts should not move at all.
+DEFAULT_RSS_TOLERANCE_KIB = 4096
+WARMUP_FRACTION = 0.2
+WINDOW_FRACTION = 0.2
+
+
+def read_rss_kib():
+    """
+    Resident set size of this process.
+    :return: Kibibytes, or None if /proc does not say.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return None
+
+
+def count_children():
+    """
+    Number of processes whose parent is this one.
+    :return: Integer
+    """
+    pid = str(os.getpid())
+    count = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may contain spaces.
+        if stat[stat.rindex(")") + 2:].split()[1] == pid:
+            count += 1
+    return count
+
+
+def sample(events):
+    """
+    Take a sample of the resources.
+    :param events: Events fed in so far.
+    :return: Dictionary
+    """
+    gc.collect()
+    return {
+        "events": events,
+        "time": time.monotonic(),
+        "rss_kib": read_rss_kib(),
+        "fds": len(os.listdir("/proc/self/fd")),
+        "threads": threading.active_count(),
+        "children": count_children(),
+    }
+
+
+def find_growth(samples, tolerances):
+    """
+    Compare the end of the run to the start of it, after the warmup.
+    :param samples: List of sample dictionaries.
+    :param tolerances: Dictionary of resource to how much it may grow.
+    :return: List of (resource, early, late, grew) tuples.
+    """
+    start = int(len(samples) * WARMUP_FRACTION)
+    width = max(int(len(samples) * WINDOW_FRACTION), 1)
+    early = samples[start:start + width]
+    late = samples[-width:]
+
+    results = []
+    for resource in RESOURCES:
+        early_max = max(s[resource] for s in early)
+        late_max = max(s[resource] for s in late)
+        results.append((resource, early_max, late_max, late_max - early_max > tolerances[resource]))
+    return results
+
+
+class Soak(routing.Worker):
+    """Feeds events and commands to the daemon and watches its resources."""
+    COMMANDS = ("route", "toggle", "resync")
+
+    def __init__(self, sink_count, events, command_every, sample_every):
+        routing.Worker.__init__(self, sink_count, 0, 0)
+        self.events = events
+        self.command_every = command_every
+        self.sample_every = sample_every
+        self.samples = []
+        self.failures = 0
+        self.pulse.publish_state(os.path.join(self.tmpdir, self.maxime.RouteState.FILE_NAME))
+
+    def _command(self, number):
+        """
+        Run a command on the routing worker, like the control interface does.
+        :param number: Picks the command.
+        :return: None
+        """
+        command = self.COMMANDS[number % len(self.COMMANDS)]
+        if command == "route":
+            function, args = self.app.route, (self.pulse, "speakers")
+        elif command == "toggle":
+            function, args = self.app.toggle, (self.pulse,)
+        else:
+            function, args = self.app.resync, (self.pulse,)
+
+        done = threading.Event()
+        errors = []
+        self.worker.submit(function, *args, callback=lambda result, error: errors.append(error) or done.set())
+        done.wait()
+        if errors[0] is not None:
+            self.failures += 1
+
+    def run_scenarios(self):
+        self.samples.append(sample(0))
+        fed = 0
+        cycle = 0
+        while fed < self.events:
+            for connect in (True, False):
+                if self._reroute(connect) is None:
+                    self.failures += 1
+                fed += 1
+                if fed % self.sample_every == 0:
+                    self.samples.append(sample(fed))
+                    self._print_sample(self.samples[-1])
+            cycle += 1
+            if self.command_every > 0 and cycle % self.command_every == 0:
+                # Commands want the headphones around.
+                if self._reroute(True) is None:
+                    self.failures += 1
+                self._command(cycle // self.command_every)
+                if self._reroute(False) is None:
+                    self.failures += 1
+
+    def _print_sample(self, s):
+        print("%8d %8.1fs %10d %6d %8d %9d" % (s["events"], s["time"] - self.samples[0]["time"], s["rss_kib"],
+                                              s["fds"], s["threads"], s["children"]), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Feed the maxime.py daemon events against fakes and fail if "
+                                                 "memory, fds, threads or child processes keep growing.")
+    parser.add_argument("-e", "--events", type=int, default=20000,
+                        help="connect and disconnect events to feed (default 20000)")
+    parser.add_argument("-s", "--sinks", type=int, default=50,
+                        help="sinks on the fake Pulse server (default 50)")
+    parser.add_argument("--command-every", type=int, default=10,
+                        help="run a route, toggle or resync every this many connect/disconnect pairs "
+                             "(default 10, 0 for none)")
+    parser.add_argument("--sample-every", type=int, default=500,
+                        help="events between samples (default 500)")
+    parser.add_argument("--rss-tolerance", type=int, default=DEFAULT_RSS_TOLERANCE_KIB,
+                        help="KiB that RSS may grow by (default %s)" % DEFAULT_RSS_TOLERANCE_KIB)
+    parser.add_argument("--json", default=None,
+                        help="write samples to this file")
+    args = parser.parse_args()
+
+    print("%8s %9s %10s %6s %8s %9s" % ("events", "elapsed", "rss KiB", "fds", "threads", "children"),
+          file=sys.stderr)
+    soak = Soak(args.sinks, args.events, args.command_every, args.sample_every)
+    soak.run()
+    samples = soak.samples
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"samples": samples, "failures": soak.failures}, f, indent=2)
+
+    if len(samples) < 3:
+        print("Not enough samples to tell. Feed more events or sample more often.")
+        sys.exit(1)
+
+    tolerances = {"rss_kib": args.rss_tolerance, "fds": 0, "threads": 0, "children": 0}
+    grew = False
+    print("%-9s %10s %10s" % ("resource", "early max", "late max"))
+    for resource, early, late, growing in find_growth(samples, tolerances):
+        print("%-9s %10d %10d %s" % (resource, early, late, "GROWING" if growing else "ok"))
+        grew = grew or growing
+    if soak.failures:
+        print("%s event(s) or command(s) failed." % soak.failures)
+
+    # Routing that fails throughout allocates nothing, so it would not grow either.
+    if grew or soak.failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
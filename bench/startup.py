@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Startup benchmark for the one-shot modes of maxime.py.
+
+Hotkeys and desktop launchers start a new maxime.py every time, so how long
+that takes before any real work happens is what the user feels. This
+reports, for each mode:
+
+* import time of the modules the mode pulled in, from python -X importtime,
+  for a cold start (an empty bytecode cache) and a warm one.
+* wall-clock time of the whole process, over a number of warm runs.
+
+Modes run against the same fakes as routing.py (see fakes.py), never the
+user's own Pulse, BlueZ or daemon: a private dbus-daemon where a child
+process plays BlueZ and the notification daemon, and a fake Pulse server
+made inside each maxime.py process when it first connects. Loading fakes.py
+is left out of the import times. Before each run of connect, disconnect and
+reconnect the fake headphones are put in the state the mode changes, and
+only one connect attempt is allowed, so these time one connection change
+and never a retry.
+
+Bytecode caches go to temporary directories (PYTHONPYCACHEPREFIX), so the
+repository's own __pycache__ is left alone.
+
+Results can be saved with --json and compared against an earlier run with
+--baseline, which fails if a mode got slower than the tolerance allows.
+"""
+import argparse
+import configparser
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fakes  # noqa: E402
+
+MODES = {
+    "help": ["--help"],
+    "status": ["--status"],
+    "toggle": ["--toggle"],
+    "route": ["--route", "speakers"],
+    "resync": ["--resync"],
+    "connect": ["--connect"],
+    "disconnect": ["--disconnect"],
+    "reconnect": ["--reconnect"],
+}
+# Whether the fake headphones are connected before each run of a mode.
+CONNECTED_BEFORE = {
+    "connect": False,
+    "disconnect": True,
+    "reconnect": True,
+}
+DEFAULT_SINK_COUNT = 5
+
+# Runs maxime.py with its Pulse connections going to a fake server. fakes.py
+# is only imported once a mode opens one, so Bluetooth-only modes never load it.
+CHILD = """
+import sys
+sys.path[:0] = [%(bench_dir)r, %(repo_dir)r]
+import maxime
+
+def open_connection(client_name, _servers=[]):
+    if not _servers:
+        import configparser
+        import fakes
+        config = configparser.ConfigParser()
+        config.read(%(config)r)
+        server = fakes.FakePulseServer()
+        server.populate(%(sinks)d, config)
+        server.add_bluetooth_card(config.get("bluetooth", "device_mac"), config.get("bluetooth", "output_device"))
+        maxime.PulseAudio.set_port_latency_offset = staticmethod(server.set_port_latency_offset)
+        _servers.append(server)
+    return _servers[0].connect(client_name)
+
+maxime.PulseAudio.open_connection = staticmethod(open_connection)
+sys.argv[0] = maxime.__file__
+maxime.main()
+"""
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+# Imports of the benchmark itself, which are left out along with everything they pulled in.
+EXCLUDED_IMPORTS = ("fakes",)
+
+
+def parse_importtime(stderr):
+    """
+    Sum up python -X importtime output, leaving out EXCLUDED_IMPORTS.
+    :param stderr: stderr of the process.
+    :return: Tuple of total microseconds and a list of (cumulative us, module) for top level imports.
+    """
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match is not None:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((int(self_us), int(cumulative_us), len(indent), module))
+
+    total = 0
+    top_level = []
+    excluded_depth = None
+    # A module is listed after everything it imported, so going backwards
+    # an excluded module comes before the imports it is to blame for.
+    for self_us, cumulative_us, depth, module in reversed(entries):
+        if excluded_depth is not None:
+            if depth > excluded_depth:
+                continue
+            excluded_depth = None
+        if module in EXCLUDED_IMPORTS:
+            excluded_depth = depth
+            continue
+        total += self_us
+        # Top level imports are indented by exactly one space.
+        if depth == 1:
+            top_level.append((cumulative_us, module))
+    top_level.sort(reverse=True)
+    return total, top_level
+
+
+class Bench:
+    """Runs maxime.py against the fakes."""
+    def __init__(self, sink_count):
+        self.tmpdir = tempfile.mkdtemp(prefix="maxime-bench-")
+        self.config = fakes.write_config(self.tmpdir, bluetooth_options={"connect_attempts": 1})
+        parser = configparser.ConfigParser()
+        parser.read(self.config)
+        self.mac = parser.get("bluetooth", "device_mac")
+        self.child = CHILD % {"bench_dir": BENCH_DIR, "repo_dir": REPO_DIR, "config": self.config,
+                              "sinks": sink_count}
+        # Warm runs share a bytecode cache, cold runs get an empty one each.
+        self.warm_cache = os.path.join(self.tmpdir, "pycache")
+
+        self.bus = fakes.PrivateBus()
+        self.services = fakes.FakeServices([self.mac])
+        self.client = fakes.BluezClient()
+
+    def stop(self):
+        self.client.close()
+        self.services.stop()
+        self.bus.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def run_mode(self, name, importtime=False, cold=False):
+        """
+        Run maxime.py once.
+        :return: Tuple of wall-clock seconds, exit status and stderr.
+        """
+        connected = CONNECTED_BEFORE.get(name)
+        if connected is True:
+            self.client.connect(self.mac)
+        elif connected is False:
+            self.client.disconnect(self.mac)
+
+        env = dict(os.environ)
+        command = [sys.executable]
+        if importtime:
+            command += ["-X", "importtime"]
+        cache = tempfile.mkdtemp(prefix="pycache-", dir=self.tmpdir) if cold else self.warm_cache
+        env["PYTHONPYCACHEPREFIX"] = cache
+        command += ["-c", self.child, "-c", self.config] + MODES[name]
+
+        started = time.perf_counter()
+        proc = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        elapsed = time.perf_counter() - started
+        if cold:
+            shutil.rmtree(cache, ignore_errors=True)
+        return elapsed, proc.returncode, proc.stderr
+
+    def bench_mode(self, name, runs):
+        """
+        Benchmark one mode.
+        :return: Dictionary of results.
+        """
+        failures = 0
+        _, status, stderr = self.run_mode(name, importtime=True, cold=True)
+        failures += status != 0
+        cold_import_us, _ = parse_importtime(stderr)
+        # Fill the warm cache.
+        self.run_mode(name)
+        _, status, stderr = self.run_mode(name, importtime=True)
+        failures += status != 0
+        warm_import_us, top_level = parse_importtime(stderr)
+
+        wall = []
+        for _ in range(runs):
+            elapsed, status, stderr = self.run_mode(name)
+            failures += status != 0
+            wall.append(elapsed)
+        if failures:
+            print("%s failed %s time(s), last said:\n%s" % (name, failures, stderr.strip()), file=sys.stderr)
+        wall.sort()
+        return {
+            "mode": name,
+            "failures": failures,
+            "cold_import_ms": cold_import_us / 1000.0,
+            "warm_import_ms": warm_import_us / 1000.0,
+            "wall_p50_ms": statistics.median(wall) * 1000,
+            "wall_min_ms": wall[0] * 1000,
+            "wall_max_ms": wall[-1] * 1000,
+            "top_imports": [module for _, module in top_level[:5]],
+        }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results to a baseline run.
+    :return: List of regression messages.
+    """
+    previous = dict((result["mode"], result) for result in baseline)
+    regressions = []
+    for result in results:
+        before = previous.get(result["mode"])
+        if before is None:
+            continue
+        for key in ("warm_import_ms", "wall_p50_ms"):
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append("%s: %s went from %.1f to %.1f ms"
+                                   % (result["mode"], key, before[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup time of maxime.py one-shot modes against fakes.")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+                        help="warm wall-clock runs per mode")
+    parser.add_argument("-m", "--modes", default=",".join(MODES),
+                        help="comma separated modes to run (%s)" % ",".join(MODES))
+    parser.add_argument("-s", "--sinks", type=int, default=DEFAULT_SINK_COUNT,
+                        help="sinks on the fake Pulse server (default %s)" % DEFAULT_SINK_COUNT)
+    parser.add_argument("--json", default=None,
+                        help="write results to this file")
+    parser.add_argument("--baseline", default=None,
+                        help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (default 0.25)")
+    args = parser.parse_args()
+
+    bench = Bench(args.sinks)
+    results = []
+    try:
+        print("%-11s %12s %12s %10s %10s %10s %5s  %s" % ("mode", "cold import", "warm import", "p50", "min", "max",
+                                                          "fail", "heaviest imports"))
+        for name in args.modes.split(","):
+            result = bench.bench_mode(name, args.runs)
+            results.append(result)
+            print("%-11s %10.1fms %10.1fms %8.1fms %8.1fms %8.1fms %5s  %s"
+                  % (name, result["cold_import_ms"], result["warm_import_ms"], result["wall_p50_ms"],
+                     result["wall_min_ms"], result["wall_max_ms"], result["failures"],
+                     ", ".join(result["top_imports"])))
+    finally:
+        bench.stop()
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = any(result["failures"] for result in results)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
-import dbus
 import configparser
 import os
 import argparse
+import atexit
+import collections
+import fcntl
 import logging
+import re
+import sys
+import threading
 import time
-import pexpect
-from dbus.mainloop.glib import DBusGMainLoop
-from gi.repository import GLib
-from pulsectl import Pulse as PulseLib
+
+# dbus, pexpect, gi and pulsectl are imported by the code that needs them.
+# Importing them up front costs more than most one-shot modes take to run.
 
 # @TODO
 # Comments
@@ -36,55 +40,266 @@ class BluetoothctlError(Exception):
 
 
 class Bluetoothctl:
-    """A wrapper for bluetoothctl utility."""
+    """
+    A wrapper for bluetoothctl utility. One child process is kept alive and
+    its output is parsed as it streams in, so commands finish as soon as the
+    matching event shows up. The child is restarted if it dies.
+    """
+    # Seconds a command gets before we give up on it.
+    COMMAND_TIMEOUT = 30
+    # Seconds to wait before restarting a dead child.
+    RESTART_DELAY = 1
 
-    def __init__(self):
-        self.child = pexpect.spawn("bluetoothctl", echo=False)
+    PROMPT_RE = re.compile(r"^\[[^\]]*\][#>] ?")
+    ANSI_RE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]|\x01|\x02")
+    CHG_RE = re.compile(r"^\[CHG\] Device (?P<mac>[0-9A-Fa-f:]{17}) (?P<key>\w+): (?P<value>.*)$")
+    INFO_HEADER_RE = re.compile(r"^Device (?P<mac>[0-9A-Fa-f:]{17})")
+    INFO_FIELD_RE = re.compile(r"^\s+(?P<key>\w+): (?P<value>.*)$")
+    NOT_AVAILABLE_RE = re.compile(r"^Device (?P<mac>[0-9A-Fa-f:]{17}) not available")
 
-    def get_output(self, command, pause=0, prompt="bluetooth"):
-        """Run a command in bluetoothctl prompt, return output as a list of lines."""
-        self.child.send(command + "\n")
-        time.sleep(pause)
-        start_failed = self.child.expect([prompt, pexpect.EOF])
+    RESULT_CONNECT = "connect"
+    RESULT_DISCONNECT = "disconnect"
+    RESULT_NOT_AVAILABLE = "not available"
+    RESULT_DIED = "died"
+    RESULT_LINES = {
+        "Connection successful": (RESULT_CONNECT, True),
+        "Failed to connect": (RESULT_CONNECT, False),
+        "Successful disconnected": (RESULT_DISCONNECT, True),
+        "Failed to disconnect": (RESULT_DISCONNECT, False),
+    }
 
-        if start_failed:
-            raise BluetoothctlError("Bluetoothctl failed after running " + command)
+    _shared = None
+    _shared_lock = threading.Lock()
 
-        return self.child.before.split(b"\r\n")
+    def __init__(self):
+        self.child = None
+        self._changed = threading.Condition()
+        self._command_lock = threading.Lock()
+        # Every line we parse bumps the sequence, so a command can tell which
+        # results came in after it was sent.
+        self._seq = 0
+        self._properties = {}
+        # Sequence at which each (mac, key) property was last reported.
+        self._property_seq = {}
+        self._info_seq = {}
+        self._results = collections.deque(maxlen=32)
+        self._info_mac = None
+
+        self._spawn()
+        self._reader = threading.Thread(target=self._read_loop,
+                                        name="maxime-bluetoothctl",
+                                        daemon=True)
+        self._reader.start()
+
+    @classmethod
+    def shared(cls):
+        """
+        Return the bluetoothctl coprocess for this process, starting it if needed.
+        :return: Bluetoothctl
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
 
-    def get_device_info(self, mac_address):
-        """Get device info by mac address."""
+    def _spawn(self):
+        """Start the bluetoothctl child."""
+        import pexpect
         try:
-            out = self.get_output("info " + mac_address)
-        except BluetoothctlError as e:
-            print(e)
+            self.child = pexpect.spawn("bluetoothctl", echo=False, timeout=None)
+        except pexpect.ExceptionPexpect as e:
+            raise BluetoothctlError("Bluetoothctl failed to start: %s" % e)
+        logging.debug("Started bluetoothctl (pid %s)", self.child.pid)
+
+    def _restart(self):
+        """Replace a dead child with a new one."""
+        logging.warning("bluetoothctl exited. Restarting it in %s second(s).", self.RESTART_DELAY)
+        self.child.close()
+        with self._changed:
+            # Nothing in flight is going to get an answer from the old child.
+            self._seq += 1
+            self._results.append((self._seq, self.RESULT_DIED, None, None))
+            self._info_mac = None
+            # The new child may see the devices differently, and we may have
+            # missed changes while it was down.
+            self._properties.clear()
+            self._property_seq.clear()
+            self._info_seq.clear()
+            self._changed.notify_all()
+        time.sleep(self.RESTART_DELAY)
+        while True:
+            try:
+                self._spawn()
+                return
+            except BluetoothctlError as e:
+                logging.error(e)
+                time.sleep(self.RESTART_DELAY)
+
+    def _read_loop(self):
+        """Read and parse output from the child forever."""
+        import pexpect
+        while True:
+            try:
+                line = self.child.readline()
+            except pexpect.EOF:
+                line = b""
+
+            if not line:
+                if not self.child.isalive():
+                    self._restart()
+                continue
+
+            self._parse_line(line.decode("utf-8", "replace"))
+
+    def _parse_line(self, line):
+        """
+        Update our view of the world from one line of output.
+        :param line: Line of text from bluetoothctl.
+        :return: None
+        """
+        line = self.ANSI_RE.sub("", line).replace("\r", "").rstrip("\n")
+        while self.PROMPT_RE.match(line):
+            line = self.PROMPT_RE.sub("", line, count=1)
+        if not line.strip():
+            return
+
+        with self._changed:
+            self._seq += 1
+
+            match = self.CHG_RE.match(line)
+            if match:
+                self._set_property(match.group("mac"), match.group("key"), match.group("value"))
+                self._info_mac = None
+                self._changed.notify_all()
+                return
+
+            match = self.INFO_FIELD_RE.match(line)
+            if match and self._info_mac is not None:
+                self._set_property(self._info_mac, match.group("key"), match.group("value"))
+                self._info_seq[self._info_mac] = self._seq
+                self._changed.notify_all()
+                return
+
+            match = self.NOT_AVAILABLE_RE.match(line)
+            if match:
+                self._results.append((self._seq, self.RESULT_NOT_AVAILABLE, match.group("mac").upper(), None))
+                self._changed.notify_all()
+                return
+
+            match = self.INFO_HEADER_RE.match(line)
+            if match:
+                self._info_mac = match.group("mac").upper()
+                return
+
+            self._info_mac = None
+            for prefix, (kind, success) in self.RESULT_LINES.items():
+                if line.startswith(prefix):
+                    self._results.append((self._seq, kind, None, success))
+                    self._changed.notify_all()
+                    return
+
+    def _set_property(self, mac, key, value):
+        self._properties.setdefault(mac.upper(), {})[key] = value.strip()
+        self._property_seq[(mac.upper(), key)] = self._seq
+
+    def _property(self, mac, key):
+        return self._properties.get(mac.upper(), {}).get(key)
+
+    def _property_since(self, mac, key, seq):
+        """
+        Return a property if it was reported after seq.
+        :return: String, or None if it was not.
+        """
+        if self._property_seq.get((mac.upper(), key), 0) <= seq:
             return None
-        else:
-            return out
+        return self._property(mac, key)
 
-    def connect(self, mac_address):
-        """Try to connect to a device by mac address."""
-        try:
-            out = self.get_output("connect " + mac_address, 2)
-        except BluetoothctlError as e:
-            print(e)
+    def _result_since(self, seq, kind, mac):
+        """
+        Return the newest result of a kind that arrived after seq.
+        :return: Boolean of success, or None when nothing matched.
+        """
+        for result_seq, result_kind, result_mac, success in reversed(self._results):
+            if result_seq <= seq:
+                break
+            if result_kind == self.RESULT_DIED:
+                return False
+            if result_kind == self.RESULT_NOT_AVAILABLE and result_mac == mac.upper():
+                return False
+            if result_kind == kind:
+                return success
+        return None
+
+    def _run(self, command, predicate, timeout):
+        """
+        Send a command and wait until predicate has an answer for it.
+        :param command: Command to send.
+        :param predicate: Callable taking the sequence number at send time,
+                          returning None until the command is done.
+        :param timeout: Seconds to wait.
+        :return: Whatever predicate returned, or None on timeout.
+        """
+        with Metrics.shared().span("bluetoothctl_" + command.split()[0]), self._command_lock:
+            with self._changed:
+                seq = self._seq
+            self.child.send(command + "\n")
+
+            deadline = time.monotonic() + timeout
+            with self._changed:
+                while True:
+                    result = predicate(seq)
+                    if result is not None:
+                        return result
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        logging.error("bluetoothctl did not answer \"%s\" within %s seconds.", command, timeout)
+                        return None
+                    self._changed.wait(remaining)
+
+    def is_connected(self, mac_address, timeout=COMMAND_TIMEOUT):
+        """
+        Ask bluetoothctl whether a device is connected.
+        :return: Boolean, or None if we could not tell.
+        """
+        def answered(seq):
+            if self._info_seq.get(mac_address.upper(), 0) > seq:
+                connected = self._property(mac_address, "Connected")
+                if connected is not None:
+                    return connected == "yes"
+            if self._result_since(seq, self.RESULT_NOT_AVAILABLE, mac_address) is False:
+                return False
             return None
-        else:
-            res = self.child.expect(["Failed to connect", "Connection successful", pexpect.EOF])
-            success = True if res == 1 else False
-            return success
 
-    def disconnect(self, mac_address, prompt):
-        """Try to disconnect to a device by mac address."""
-        try:
-            out = self.get_output("disconnect " + mac_address, 2, prompt=prompt)
-        except BluetoothctlError as e:
-            print(e)
+        result = self._run("info " + mac_address, answered, timeout)
+        if result is False and self._property(mac_address, "Connected") is None:
             return None
-        else:
-            res = self.child.expect(["Failed to disconnect", "Successful disconnected", pexpect.EOF])
-            success = True if res == 1 else False
-            return success
+        return result
+
+    def connect(self, mac_address, timeout=COMMAND_TIMEOUT):
+        """
+        Try to connect to a device by mac address. Finishes when the device
+        reports, after we asked, that it is connected.
+        :return: Boolean of success, or None on timeout.
+        """
+        def answered(seq):
+            if self._property_since(mac_address, "Connected", seq) == "yes":
+                return True
+            return self._result_since(seq, self.RESULT_CONNECT, mac_address)
+
+        return self._run("connect " + mac_address, answered, timeout)
+
+    def disconnect(self, mac_address, timeout=COMMAND_TIMEOUT):
+        """
+        Try to disconnect a device by mac address. Finishes when the device
+        reports, after we asked, that it is no longer connected.
+        :return: Boolean of success, or None on timeout.
+        """
+        def answered(seq):
+            if self._property_since(mac_address, "Connected", seq) == "no":
+                return True
+            return self._result_since(seq, self.RESULT_DISCONNECT, mac_address)
+
+        return self._run("disconnect " + mac_address, answered, timeout)
 
 class Maxime:
     """
@@ -99,10 +314,41 @@ class Maxime:
     MODE_STATUS = "status"
     MODE_RESYNC = "resync"
     MODE_RECONNECT = "reconnect"
+    MODE_STATS = "stats"
 
     ROUTE_SPEAKERS = "speakers"
     ROUTE_HEADSET = "headset"
     ROUTE_WIRELESS = "wireless"
+    ROUTES = (ROUTE_SPEAKERS, ROUTE_HEADSET, ROUTE_WIRELESS)
+
+    # What runs the daemon. See AsyncEngine.
+    ENGINE_GLIB = "glib"
+    ENGINE_ASYNCIO = "asyncio"
+
+    # Modes that a running daemon can do for us.
+    DAEMON_METHODS = {
+        MODE_STATUS: "Status",
+        MODE_ROUTE: "Route",
+        MODE_TOGGLE: "Toggle",
+        MODE_CONNECT: "Connect",
+        MODE_DISCONNECT: "Disconnect",
+        MODE_RESYNC: "Resync",
+        MODE_RECONNECT: "Reconnect",
+        MODE_STATS: "Stats",
+    }
+
+    # Modes that only talk to the Bluetooth device.
+    BLUETOOTH_MODES = (MODE_CONNECT, MODE_DISCONNECT, MODE_RECONNECT)
+
+    LOCK_FILE_NAME = "maxime.lock"
+
+    LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+    LOG_DATE_FORMAT = '%m/%d/%Y %H:%M:%S'
+    # How the daemon rotates its log file. See _setup_queued_logging().
+    LOG_ROTATE_SIZE = "size"
+    LOG_ROTATE_DAILY = "daily"
+    LOG_MAX_BYTES = 5 * 1024 * 1024
+    LOG_BACKUP_COUNT = 3
 
     def __init__(self):
         """
@@ -119,6 +365,9 @@ class Maxime:
         # Logging
         self._setup_logging(self)
 
+        # Connects and disconnects, with retries
+        self.connections = ConnectionScheduler(self.config)
+
         # Program mode
         # This cannot run until we have setup logging!
         self.mode = None
@@ -195,6 +444,22 @@ class Maxime:
                             action='store_true',
                             help='show the current output device')
 
+        parser.add_argument('--stats',
+                            default=False,
+                            action='store_true',
+                            help='show latency stats of the running daemon')
+
+        parser.add_argument('--profile',
+                            default=False,
+                            action='store_true',
+                            help='write a CPU profile of a one-shot mode to the runtime directory')
+
+        parser.add_argument('--record', type=str,
+                            default=None,
+                            metavar='TRACE',
+                            help='append what the daemon receives and does to a trace file, '
+                                 'for bench/replay.py')
+
         return parser.parse_args()
 
     @staticmethod
@@ -238,14 +503,55 @@ class Maxime:
         if self.args.debug is True:
             log_level = logging.DEBUG
 
-        # You can only call this once, or others will be a noop.
-        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
-                            datefmt='%m/%d/%Y %H:%M:%S',
-                            filename=self.args.logfile,
-                            level=log_level)
+        one_shot = (self.args.route is not None or self.args.connect or self.args.disconnect or self.args.toggle
+                    or self.args.resync or self.args.reconnect or self.args.status or self.args.stats)
+        if one_shot:
+            # You can only call this once, or others will be a noop.
+            logging.basicConfig(format=self.LOG_FORMAT,
+                                datefmt=self.LOG_DATE_FORMAT,
+                                filename=self.args.logfile,
+                                level=log_level)
+        else:
+            self._setup_queued_logging(self, log_level)
 
         logging.debug("Starting logging facility")
 
+    @staticmethod
+    def _setup_queued_logging(self, log_level):
+        """
+        Setup logging for the daemon. Records are handed to a queue and
+        written by a background thread, so logging never does I/O on the
+        routing path. A log file is rotated by size (or daily with
+        rotate=daily in [logging]) and only backup_count old ones are kept.
+        :param log_level: Level to log at.
+        :return: None
+        """
+        import logging.handlers
+        import queue
+
+        if self.args.logfile is None:
+            handler = logging.StreamHandler()
+        elif self.config.get('logging', 'rotate', fallback=self.LOG_ROTATE_SIZE) == self.LOG_ROTATE_DAILY:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                self.args.logfile, when='midnight',
+                backupCount=self.config.getint('logging', 'backup_count', fallback=self.LOG_BACKUP_COUNT))
+        else:
+            handler = logging.handlers.RotatingFileHandler(
+                self.args.logfile,
+                maxBytes=self.config.getint('logging', 'max_bytes', fallback=self.LOG_MAX_BYTES),
+                backupCount=self.config.getint('logging', 'backup_count', fallback=self.LOG_BACKUP_COUNT))
+        handler.setFormatter(logging.Formatter(self.LOG_FORMAT, datefmt=self.LOG_DATE_FORMAT))
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        # Write out whatever is still queued when we exit.
+        atexit.register(listener.stop)
+        # QueueHandler merges the arguments into the message (and formats any
+        # traceback) before queueing, so records show the objects they were
+        # logged with, not what those became by the time they are written.
+        logging.basicConfig(handlers=[logging.handlers.QueueHandler(log_queue)], level=log_level)
+
     @staticmethod
     def exit_err(message):
         """
@@ -263,6 +569,14 @@ class Maxime:
         :return: 
         """
         # Determine what we're going to do
+        if self.args.stats is True:
+            if (self.args.status is True or self.args.route is not None or self.args.connect is True
+                    or self.args.disconnect is True or self.args.toggle is True or self.args.resync is True
+                    or self.args.reconnect is True or self.args.listen is True):
+                self.exit_err("You cannot specify --stats with anything else")
+            self._set_mode(Maxime.MODE_STATS)
+            return
+
         if self.args.status is True:
             if self.args.connect is True or self.args.disconnect is True or self.args.resync is True or self.args.reconnect is True:
                 self.exit_err("You cannot specify --status and --connect/--disconnect/--resync/--reconnect")
@@ -335,15 +649,67 @@ class Maxime:
         Set the run mode of the program.
         :return: 
         """
-        logging.debug("Setting mode to %s" % mode)
+        logging.debug("Setting mode to %s", mode)
         self.mode = mode
 
-    def route(self, pulse):
+    @staticmethod
+    def get_runtime_path(name):
+        """
+        Return the path of a file in our per-user runtime directory.
+        :param name: Name of the file.
+        :return: String of the path.
+        """
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        if runtime_dir is None:
+            runtime_dir = "/tmp/maxime-%s" % os.getuid()
+            os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+        return os.path.join(runtime_dir, name)
+
+    def lock_commands(self):
+        """
+        Take an exclusive lock so that one-shot commands run in-process one
+        at a time. The lock goes away with the process.
+        :return: The open lock file.
+        """
+        lock_file = open(self.get_runtime_path(self.LOCK_FILE_NAME), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def forward_to_daemon(self):
+        """
+        Hand the current mode to a running daemon, if there is one.
+        :return: Boolean of whether a daemon did the work.
+        """
+        import dbus
+        method = self.DAEMON_METHODS[self.mode]
+        args = []
+        if self.mode == self.MODE_ROUTE:
+            destination = self.args.route.lower()
+            if destination not in self.ROUTES:
+                self.exit_err("Routing destination must be speakers|wireless|headset")
+            args.append(destination)
+
+        try:
+            handled, result = ControlClient.call(method, *args)
+        except dbus.exceptions.DBusException as e:
+            self.exit_err("Daemon failed to %s: %s" % (self.mode, e.get_dbus_message()))
+
+        if handled is True and result:
+            if self.mode == self.MODE_STATS:
+                print(result)
+            else:
+                logging.info(result)
+        return handled
+
+    def route(self, pulse, destination=None):
         """
         Route audio stream.
+        :param destination: One of ROUTES. Defaults to the --route argument.
         :return: 
         """
-        destination = self.args.route.lower()
+        if destination is None:
+            destination = self.args.route
+        destination = destination.lower()
         if destination == self.ROUTE_WIRELESS:
             pulse.activate_wireless(conn_event=False)
         elif destination == self.ROUTE_HEADSET:
@@ -359,74 +725,127 @@ class Maxime:
         :param pulse: 
         :return: 
         """
-        ladspa_device = pulse._lookup_sink_output_device("LADSPA Plugin Multiband EQ")
-        logging.debug("LADSPA device is \"%s\"" % ladspa_device.description)
-        if pulse.bt_device.output_device in ladspa_device.description:
+        # The daemon knows where it routed to. Otherwise ask Pulse.
+        if pulse.state.get('output') is not None:
+            is_wireless = pulse.state.get('route') == self.ROUTE_WIRELESS
+        else:
+            ladspa_device = pulse._lookup_sink_output_device("LADSPA Plugin Multiband EQ")
+            logging.debug("LADSPA device is \"%s\"", ladspa_device.description)
+            is_wireless = pulse.bt_device.output_device in ladspa_device.description
+        if is_wireless:
             logging.info("Current output is wireless. Switching to speakers.")
             pulse.activate_speakers(conn_event=False)
+            return self.ROUTE_SPEAKERS
         else:
             logging.info("Current output is not wireless. Switching to wireless.")
             pulse.activate_wireless(conn_event=False)
+            return self.ROUTE_WIRELESS
 
-    def status(self, pulse):
+    def status(self, pulse, snapshot=None):
         """
         Show the current output device.
-        :param pulse: 
+        :param pulse: PulseAudio, or None when answering from a snapshot.
+        :param snapshot: Route state published by the daemon.
         :return: 
         """
-        ladspa_device = pulse._lookup_sink_output_device("LADSPA Plugin Multiband EQ")
-        logging.debug("LADSPA device is \"%s\"" % ladspa_device.description)
-        output_string = ladspa_device.description.replace("LADSPA Plugin Multiband EQ on ", "")
-        DBusHelper.send_notification("Current output is \"%s\"" % output_string)
+        if snapshot is None and pulse is not None:
+            snapshot = pulse.state.snapshot()
+        output_string = (snapshot or {}).get('output')
+        if output_string is None:
+            ladspa_device = pulse._lookup_sink_output_device("LADSPA Plugin Multiband EQ")
+            logging.debug("LADSPA device is \"%s\"", ladspa_device.description)
+            output_string = ladspa_device.description.replace("LADSPA Plugin Multiband EQ on ", "")
+        DBusHelper.send_notification("Current output is \"%s\"" % output_string, tag=DBusHelper.TAG_STATUS)
+        return output_string
 
-    def connect(self, bt_device):
+    def connect(self, bt_device, generation=None):
         """
         Connect to a Bluetooth device
         :param bt_device: 
-        :return: 
+        :param generation: ConnectionScheduler generation, if the command
+                           began when it came in rather than now.
+        :return: ConnectionScheduler outcome.
         """
-        logging.debug("Connecting to \"%s\" at \"%s\"" % (bt_device.output_device, bt_device.mac))
-        bluez = Bluetoothctl()
-        device_info = bluez.get_device_info(bt_device.mac)
+        logging.debug("Connecting to \"%s\" at \"%s\"", bt_device.output_device, bt_device.mac)
+        bluez = self._get_bluetooth_backend(bt_device)
+        if generation is None:
+            generation = self.connections.begin()
+        outcome = self.connections.change(bt_device, bluez, True, generation)
+        self._report_connection(bt_device, True, outcome)
+        return outcome
 
-        # Figure out if we're already connected to the device.
-        prefix = b"Connected: "
-        raw_is_connected = None
-        for line in device_info:
-            if prefix in line:
-                raw_is_connected = line.strip().replace(prefix, b"").upper()
-                break
+    def disconnect(self, bt_device, generation=None):
+        """
+        Disconnect to a Bluetooth device
+        :param bt_device: 
+        :param generation: ConnectionScheduler generation, if the command
+                           began when it came in rather than now.
+        :return: ConnectionScheduler outcome.
+        """
+        logging.debug("Disconnecting \"%s\" at \"%s\"", bt_device.output_device, bt_device.mac)
+        bluez = self._get_bluetooth_backend(bt_device)
+        if generation is None:
+            generation = self.connections.begin()
+        outcome = self.connections.change(bt_device, bluez, False, generation)
+        self._report_connection(bt_device, False, outcome)
+        return outcome
 
-        # Parse to Boolean
-        if b'NO' in raw_is_connected:
-            logging.debug("Wireless device is not connected.")
-            is_connected = False
-        elif b'YES' in raw_is_connected:
-            logging.debug("Wireless device is connected.")
-            is_connected = True
-        else:
-            logging.error("Could not determine connected state.")
+    def _report_connection(self, bt_device, connected, outcome):
+        """
+        Log and notify how a connect or disconnect went.
+        :param bt_device: BluetoothDevice
+        :param connected: True for a connect, False for a disconnect.
+        :param outcome: ConnectionScheduler outcome.
+        :return: None
+        """
+        name = bt_device.output_device
+        if outcome == ConnectionScheduler.OUTCOME_UNCHANGED:
+            logging.debug("Device was already %s. Not doing anything...",
+                          "connected" if connected is True else "disconnected")
+            return
+        if outcome == ConnectionScheduler.OUTCOME_CANCELLED:
+            logging.info("Gave up on %s \"%s\" for a newer command.",
+                         "connecting to" if connected is True else "disconnecting from", name)
             return
 
-        # Connect
-        if is_connected is False:
-            bluez.connect(mac_address=bt_device.mac)
-            logging.info("Connected to \"%s\" at \"%s\"" % (bt_device.output_device, bt_device.mac))
-            DBusHelper.send_notification("Connected to %s." % bt_device.output_device, icon=DBusHelper.ICON_WIRELESS)
+        if outcome == ConnectionScheduler.OUTCOME_FAILED:
+            logging.error("Failed to %s \"%s\" at \"%s\" after %s attempt(s)",
+                          "connect to" if connected is True else "disconnect from", name, bt_device.mac,
+                          self.connections.attempts)
+            message = "Could not %s %s." % ("connect to" if connected is True else "disconnect from", name)
+        elif connected is True:
+            logging.info("Connected to \"%s\" at \"%s\"", name, bt_device.mac)
+            message = "Connected to %s." % name
+        else:
+            logging.info("Disconnected from \"%s\" at \"%s\"", name, bt_device.mac)
+            message = "Disconnected from %s." % name
+        DBusHelper.send_notification(message, icon=DBusHelper.ICON_WIRELESS, tag=DBusHelper.TAG_CONNECTION)
 
-        logging.debug("Device was already connected. Not doing anything...")
+    @staticmethod
+    def prepare_bluetooth_backend(bt_device):
+        """
+        Open whatever the backend of a device talks over, so that the first
+        command does not have to wait for it.
+        :param bt_device: BluetoothDevice
+        :return: None
+        """
+        if bt_device.backend == BluetoothDevice.BACKEND_BLUETOOTHCTL:
+            Bluetoothctl.shared()
+        else:
+            bt_device.setup_dbus()
 
-    def disconnect(self, bt_device):
+    @staticmethod
+    def _get_bluetooth_backend(bt_device):
         """
-        Disconnect to a Bluetooth device
-        :param bt_device: 
-        :return: 
+        Return the object that manages the connection of a Bluetooth device.
+        BlueZ is spoken to directly over DBus unless the config asks for
+        bluetoothctl instead.
+        :param bt_device: BluetoothDevice
+        :return: Object with is_connected(), connect() and disconnect().
         """
-        logging.debug("Disconnecting \"%s\" at \"%s\"" % (bt_device.output_device, bt_device.mac))
-        bluez = Bluetoothctl()
-        bluez.disconnect(mac_address=bt_device.mac, prompt=bt_device.output_device)
-        logging.info("Disconnected from \"%s\" at \"%s\"" % (bt_device.output_device, bt_device.mac))
-        DBusHelper.send_notification("Disconnected from %s." % bt_device.output_device, icon=DBusHelper.ICON_WIRELESS)
+        if bt_device.backend == BluetoothDevice.BACKEND_BLUETOOTHCTL:
+            return BluetoothctlBackend(bt_device)
+        return bt_device
 
     def resync(self, pulse):
         """
@@ -436,19 +855,30 @@ class Maxime:
         :return: 
         """
         logging.debug("Resyncing wireless")
-        pulse.resync_wireless()
+        with Metrics.shared().span("resync"):
+            pulse.resync_wireless()
 
-    def reconnect(self, bt_device):
+    def reconnect(self, bt_device, generation=None):
         """
         Reconnect
         :param bt_device: 
-        :return: 
+        :param generation: ConnectionScheduler generation, if the command
+                           began when it came in rather than now.
+        :return: ConnectionScheduler outcome of the last step.
         """
-        logging.debug("Reconnecting to \"%s\" at \"%s\"" % (bt_device.output_device, bt_device.mac))
-        self.disconnect(bt_device)
-        # Dunno if this will actually be needed. Will see how it behaves
-        # time.sleep(1)
-        self.connect(bt_device)
+        logging.debug("Reconnecting to \"%s\" at \"%s\"", bt_device.output_device, bt_device.mac)
+        bluez = self._get_bluetooth_backend(bt_device)
+        # One command: the connect only starts once Connected says the
+        # disconnect is done, and a newer command cancels either half.
+        if generation is None:
+            generation = self.connections.begin()
+        outcome = self.connections.change(bt_device, bluez, False, generation)
+        self._report_connection(bt_device, False, outcome)
+        if outcome in (ConnectionScheduler.OUTCOME_FAILED, ConnectionScheduler.OUTCOME_CANCELLED):
+            return outcome
+        outcome = self.connections.change(bt_device, bluez, True, generation)
+        self._report_connection(bt_device, True, outcome)
+        return outcome
 
 class DBusHelper:
     """
@@ -465,255 +895,3304 @@ class DBusHelper:
     ICON_SPEAKERS = "audio-speakers"
     ICON_HEADSET = "audio-headset"
 
+    # Notifications with the same tag update one bubble instead of stacking.
+    TAG_ROUTE = "route"
+    TAG_CONNECTION = "connection"
+    TAG_STATUS = "status"
+
     @staticmethod
-    def send_notification(text, icon='audio-card', time=5000, actions_list=''):
+    def send_notification(text, icon='audio-card', time=5000, actions_list='', tag=None):
         """
-        Send an OS notification to the user.
+        Send an OS notification to the user. This only queues the notification,
+        it is sent from a background thread so that a slow notification daemon
+        never holds up routing.
         :param text: Text to display.
         :param icon: Name of the icon to use.
         :param time: Time the notification should live.
+        :param tag: One of the TAG_* constants to replace the last bubble with that tag.
         :return: None
         """
+        NotificationQueue.shared().put(text, icon, time, actions_list, tag)
 
-        # This blog post has a lot of good examples on how to do this.
-        # http://cheesehead-techblog.blogspot.com/2009/02/five-ways-to-make-notification-pop-up.html
-        app_name = "Maxime"
-        id_num_to_replace = 0
-        title = app_name
-        hint = ''
 
-        # Create the objects and send!
-        bus = dbus.SessionBus()
-        dbus_notify_proxy = bus.get_object(DBusHelper.SERVICE_NOTIFICATIONS, DBusHelper.PATH_NOTIFICATIONS)
-        dbus_notify_interface = dbus.Interface(dbus_notify_proxy, DBusHelper.INTERFACE_NOTIFICATIONS)
-        dbus_notify_interface.Notify(app_name, id_num_to_replace, icon,
-                                     title, text, actions_list, hint, time)
-        bus.close()
-        logging.debug("Sent notification to DBus: %s" % text)
+class NotificationQueue:
+    """
+    Sends queued notifications over one long lived session bus connection.
+    Pending notifications that share a tag are collapsed to the newest one,
+    and a sent one replaces the last bubble with its tag.
+    """
+    APP_NAME = "Maxime"
+    # Seconds we wait at exit for queued notifications to go out.
+    FLUSH_TIMEOUT = 2
 
+    _shared = None
+    _shared_lock = threading.Lock()
 
-class GenericAudioDevice:
-    def __init__(self, config, mode):
-        self.input_device = config.get(mode, 'input_device')
-        self.output_device = config.get(mode, 'output_device')
-        
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._pending = collections.deque()
+        self._sending = False
+        self._replaces_ids = {}
+        self._interface = None
+        self._connect_lock = threading.Lock()
+        self._start()
 
-class BluetoothDevice:
-    """
-    Bluetooth specific crap.
-    """
-    DBUS_SERVICE = "org.bluez"
-    DBUS_INTERFACE_DEVICE = "org.bluez.Device1"
+    def _start(self):
+        """Start sending whatever gets queued."""
+        self._thread = threading.Thread(target=self._send_loop,
+                                        name="maxime-notifications",
+                                        daemon=True)
+        self._thread.start()
 
-    def __init__(self, config):
+    @classmethod
+    def shared(cls):
         """
-        Constructor
-        :param config: Validated configparser object 
+        Return the notification queue for this process, starting it if needed.
+        :return: NotificationQueue
         """
-        self.adapter = config.get('bluetooth', 'adapter')
-        self.mac = config.get('bluetooth', 'device_mac')
-        self.dbus_object_path = self._get_dbus_device_object_path(self.adapter, self.mac)
-        self.proxy = None
-        self.properties = None
-        self.output_device = config.get('bluetooth', 'output_device')
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+                # One-shot modes exit right after queueing.
+                atexit.register(cls._shared.flush)
+            return cls._shared
 
-    @staticmethod
-    def _get_normal_mac(mac):
+    @classmethod
+    def set_shared(cls, queue):
         """
-        Return a DBus-normalized MAC address.
-        :param mac: MAC address to normalize
-        :return: A DBus/BlueZ compatible MAC address
+        Make a queue the one for this process, such as one that sends from an
+        event loop instead of a thread.
+        :param queue: NotificationQueue
+        :return: None
         """
-        return mac.replace(':','_')
+        with cls._shared_lock:
+            cls._shared = queue
 
-    def _get_dbus_device_object_path(self, adapter, mac):
+    def put(self, text, icon, time, actions_list, tag):
         """
-        Return the DBus object path of a particular device.
-        :param adapter: The Bluetooth interface.
-        :param mac: The normalized MAC address.
-        :return: A string of the device path.
+        Queue a notification.
+        :return: None
         """
-        mac = self._get_normal_mac(mac)
-        service = self.DBUS_SERVICE.replace('.', '/')
-        obj_path = "/%s/%s/dev_%s" % (service, adapter, mac)
-
-        return obj_path
+        with self._changed:
+            if tag is not None:
+                superseded = [n for n in self._pending if n[4] == tag]
+                for notification in superseded:
+                    self._pending.remove(notification)
+                    logging.debug("Dropped superseded notification: %s", notification[0])
+            self._pending.append((text, icon, time, actions_list, tag))
+            self._changed.notify_all()
 
-    def get_property(self, key):
+    def flush(self, timeout=FLUSH_TIMEOUT):
         """
-        Return a device property from DBus.
-        :param key: 
-        :return: 
+        Wait for queued notifications to be sent.
+        :param timeout: Seconds to wait at most.
+        :return: None
         """
-        try:
-            return self.properties.Get(self.DBUS_INTERFACE_DEVICE, key)
-        except Exception as e:
-            logging.error("Could not retrieve property '%s' on '%s'. Error \"%s\"" % (key, self.DBUS_INTERFACE_DEVICE, e))
-
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self._pending or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.debug("Gave up on %s queued notification(s).", len(self._pending))
+                    return
+                self._changed.wait(remaining)
 
-class DBusListener:
-    """
-    Class to deal with DBus events.
-    """
-    # Static vars for DBus properties and interfaces
-    INTERFACE_PROPERTIES = "org.freedesktop.DBus.Properties"
-    SIGNAL_PROPERTIESCHANGED = "PropertiesChanged"
+    def _send_loop(self):
+        """Send notifications as they are queued, forever."""
+        while True:
+            with self._changed:
+                while not self._pending:
+                    self._changed.wait()
+                notification = self._pending.popleft()
+                self._sending = True
 
-    def __init__(self, device, pulse):
-        """
-        Constructor
-        """
-        DBusGMainLoop(set_as_default=True)
-        proxy, properties = self._setup_dbus(device)
-        device.proxy = proxy
-        device.properties = properties
-        self.device = device
-        self.pulse = pulse
+            try:
+                with Metrics.shared().span("notification"):
+                    self._send(*notification)
+            except Exception as e:
+                logging.error("Could not send notification \"%s\": %s", notification[0], e)
+                # Start over with a new connection next time.
+                self._interface = None
+            finally:
+                with self._changed:
+                    self._sending = False
+                    self._changed.notify_all()
 
-    def _setup_dbus(self, device):
+    def _get_interface(self):
         """
-        Setup our DBus proxy object and properties interface. The proxy object
-        is used to perform operations against a specific DBus object.
-        The properties interface is our templated way into viewing properties
-        about the device we just (dis)connected.
-        :return: None
+        Return the notification interface, connecting to the session bus if needed.
+        The connection is private so that its blocking calls from our thread never
+        contend with the main loop's connection.
+        :return: dbus.Interface
         """
-        bus = dbus.SystemBus()
-        bt_dev_proxy = bus.get_object(BluetoothDevice.DBUS_SERVICE, device.dbus_object_path)
-        bt_dev_proxy.connect_to_signal(self.SIGNAL_PROPERTIESCHANGED,
-                                       self._bluetooth_signal_handler,
-                                       dbus_interface=self.INTERFACE_PROPERTIES)
-        bt_dev_properties = dbus.Interface(bt_dev_proxy,
-                                           dbus_interface=self.INTERFACE_PROPERTIES)
+        import dbus
 
-        return bt_dev_proxy, bt_dev_properties
+        with self._connect_lock:
+            if self._interface is None:
+                # This blog post has a lot of good examples on how to do this.
+                # http://cheesehead-techblog.blogspot.com/2009/02/five-ways-to-make-notification-pop-up.html
+                bus = dbus.SessionBus(private=True)
+                dbus_notify_proxy = bus.get_object(DBusHelper.SERVICE_NOTIFICATIONS, DBusHelper.PATH_NOTIFICATIONS)
+                self._interface = dbus.Interface(dbus_notify_proxy, DBusHelper.INTERFACE_NOTIFICATIONS)
+            return self._interface
 
-    def listen(self):
+    def connect(self):
         """
-        Listen for events and do stuff when they happen!
-        :return: 
+        Connect to the session bus ahead of the first notification.
+        :return: None
         """
-        loop_msg = "Started listening for BT audio devices."
-        DBusHelper.send_notification(text=loop_msg, icon="audio-card")
-        dbus_loop = GLib.MainLoop()
-        dbus_loop.run()
+        self._get_interface()
 
-    def _bluetooth_signal_handler(self, interface, changed_properties, signature):
+    def _send(self, text, icon, time, actions_list, tag):
         """
-        Event handler for a change in a Bluetooth device state.
-        :param interface: String of the DBus interface.
-        :param changed_properties: Dictionary of the properties that changed.
-        :param signature: String of something that I don't care about.
+        Send one notification.
         :return: None
         """
-        logging.debug("%s: Change detected." % interface)
+        title = self.APP_NAME
+        hint = ''
+        id_num_to_replace = self._replaces_ids.get(tag, 0)
 
-        # Right now I only care about device connectivity
-        if interface != BluetoothDevice.DBUS_INTERFACE_DEVICE:
-            logging.debug("%s: Ignoring change." % interface)
-            return
+        notification_id = self._get_interface().Notify(self.APP_NAME, id_num_to_replace, icon,
+                                                       title, text, actions_list, hint, time)
+        if tag is not None:
+            self._replaces_ids[tag] = int(notification_id)
+        logging.debug("Sent notification to DBus: %s", text)
 
-        # Test for the appropriate key in the messages we will get
-        try:
-            connected = bool(changed_properties['Connected'])
-        except KeyError:
-            # Ignore a ServicesResolved message
-            try:
-                bool(changed_properties['ServicesResolved'])
-                logging.debug("%s: Ignoring ServicesResolved." % interface)
-                return
-            except Exception:
-                logging.error("%s: Some weird error occurred "
-                              "(and it wasnt ServicesResolved)." % interface)
-                return
-        except Exception:
-            logging.error("%s: Some weird error occurred." % interface)
-            return
 
-        # Deal with the connection state
-        logging.info("%s: Connected -> %s" % (interface, connected))
-        self.pulse.manage_connection(connected)
+class MetricsSpan:
+    """
+    Times one stage of work for Metrics. Use it as a context manager.
+    """
+    __slots__ = ("metrics", "stage", "started")
 
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.started = None
 
-class PulseAudio:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class NullSpan:
     """
-    PulseAudio connection
+    What Metrics.span() hands out while metrics are off. Does nothing.
     """
-    BT_CARD_PREFIX = "bluez_card"
-    BT_PROFILE_A2DP = "a2dp_sink"
-    BT_PROFILE_HSP = "headset_head_unit"
+    __slots__ = ()
 
-    def __init__(self, config, bt_device, sp_device, hs_device):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Metrics:
+    """
+    Latency histograms for the stages of routing, such as waiting for a
+    sink, moving streams or talking to bluetoothctl. Spans are timed only
+    when metrics are enabled in [metrics], otherwise span() returns a
+    shared object that does nothing. A daemon hands the histograms out over
+    --stats and can write them to a Prometheus textfile every so often.
+    """
+    CONFIG_SECTION = "metrics"
+    METRIC_NAME = "maxime_stage_duration_seconds"
+    # Upper bounds in seconds, from a cache hit to a slow Bluetooth connect.
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    DEFAULT_TEXTFILE_INTERVAL = 15
+
+    NULL_SPAN = NullSpan()
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # Stage name to [count per bucket (and one past the last), count, sum].
+        self._histograms = {}
+        # Name to current value, for things that are levels rather than durations.
+        self._gauges = {}
+        self._writer_thread = None
+
+    @classmethod
+    def shared(cls):
         """
-        Constructor for PulseAudio connection.
-        :param config: 
+        Return the metrics of this process.
+        :return: Metrics
         """
-        self.config = config
-        self.pulse_conn = PulseLib('maxime-manage_connection')
-        self.ladspa_device = self._lookup_sink_input_device("LADSPA Stream")
-        self.bt_device = bt_device
-        self.hs_device = hs_device
-        self.sp_device = sp_device
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
 
-    def activate_wireless(self, conn_event=True):
+    def configure(self, config):
         """
-        Activate the wireless device. If it's a (dis)connect event,
-        also mute the speakers so we don't blast audio.
-        :param conn_event:
-        :return:
+        Turn metrics on if the config asks for them, and start writing the
+        textfile if there is one.
+        :param config: Validated configparser object
+        :return: None
         """
-        logging.debug("Activating wireless.")
+        textfile = config.get(self.CONFIG_SECTION, 'textfile', fallback=None)
+        self.enabled = config.getboolean(self.CONFIG_SECTION, 'enabled', fallback=bool(textfile))
+        if self.enabled is True and textfile:
+            interval = config.getfloat(self.CONFIG_SECTION, 'textfile_interval',
+                                       fallback=self.DEFAULT_TEXTFILE_INTERVAL)
+            self.start_textfile_writer(os.path.expanduser(textfile), interval)
 
-        device_name = self.bt_device.output_device
+    def span(self, stage):
+        """
+        Time a stage of work.
+        :param stage: Name of the stage.
+        :return: Context manager.
+        """
+        if self.enabled is False:
+            return self.NULL_SPAN
+        return MetricsSpan(self, stage)
 
-        # We need to a wait a few seconds for Pulse to catch up
-        first_run = True
-        while True:
-            try:
-                target_device = self._lookup_sink_output_device(device_name)
+    def observe(self, stage, seconds):
+        """
+        Record how long a stage took.
+        :param stage: Name of the stage.
+        :param seconds: Duration.
+        :return: None
+        """
+        bucket = len(self.BUCKETS)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = [[0] * (len(self.BUCKETS) + 1), 0, 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def set_gauge(self, name, value):
+        """
+        Record the current value of a level, such as a queue depth.
+        :param name: Name of the gauge.
+        :param value: Number.
+        :return: None
+        """
+        if self.enabled is False:
+            return
+        with self._lock:
+            self._gauges[name] = value
+
+    def _gauge_snapshot(self):
+        with self._lock:
+            return sorted(self._gauges.items())
+
+    def _snapshot(self):
+        with self._lock:
+            return dict((stage, (list(h[0]), h[1], h[2])) for stage, h in sorted(self._histograms.items()))
+
+    def _quantile(self, buckets, count, q):
+        """
+        Estimate a quantile from bucket counts, as the upper bound of the
+        bucket it falls in.
+        :return: Seconds, or infinity if it is past the last bucket.
+        """
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float("inf")
+        return float("inf")
+
+    def format_summary(self):
+        """
+        Return the histograms as a table for people.
+        :return: String
+        """
+        if self.enabled is False:
+            return "Metrics are disabled. Set enabled=true in [%s]." % self.CONFIG_SECTION
+        snapshot = self._snapshot()
+        gauges = self._gauge_snapshot()
+        if not snapshot and not gauges:
+            return "Nothing has been timed yet."
+
+        lines = ["%-28s %8s %10s %10s %10s %10s" % ("stage", "count", "mean", "p50<=", "p95<=", "p99<=")]
+        for stage, (buckets, count, total) in snapshot.items():
+            lines.append("%-28s %8d %8.1fms %8.1fms %8.1fms %8.1fms"
+                         % (stage, count, total / count * 1000,
+                            self._quantile(buckets, count, 0.5) * 1000,
+                            self._quantile(buckets, count, 0.95) * 1000,
+                            self._quantile(buckets, count, 0.99) * 1000))
+        for name, value in gauges:
+            lines.append("%-28s %8s" % (name, value))
+        return "\n".join(lines)
+
+    def format_prometheus(self):
+        """
+        Return the histograms in the Prometheus text exposition format.
+        :return: String
+        """
+        lines = ["# HELP %s Time spent in each stage of routing." % self.METRIC_NAME,
+                 "# TYPE %s histogram" % self.METRIC_NAME]
+        for stage, (buckets, count, total) in self._snapshot().items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket_count
+                lines.append("%s_bucket{stage=\"%s\",le=\"%s\"} %d" % (self.METRIC_NAME, stage, bound, cumulative))
+            lines.append("%s_sum{stage=\"%s\"} %f" % (self.METRIC_NAME, stage, total))
+            lines.append("%s_count{stage=\"%s\"} %d" % (self.METRIC_NAME, stage, count))
+        for name, value in self._gauge_snapshot():
+            lines.append("# TYPE maxime_%s gauge" % name)
+            lines.append("maxime_%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Write the histograms for the node exporter's textfile collector. The
+        file is replaced in one go so a scrape never sees half of it.
+        :param path: Path of the .prom file.
+        :return: None
+        """
+        temp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(self.format_prometheus())
+        os.replace(temp_path, path)
+
+    def start_textfile_writer(self, path, interval):
+        """
+        Write the textfile every interval seconds from a background thread.
+        :return: None
+        """
+        if self._writer_thread is not None:
+            return
+
+        def write_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_textfile(path)
+                except OSError as e:
+                    logging.error("Could not write metrics to \"%s\": %s", path, e)
+
+        logging.debug("Writing metrics to \"%s\" every %s seconds.", path, interval)
+        self._writer_thread = threading.Thread(target=write_loop, name="maxime-metrics", daemon=True)
+        self._writer_thread.start()
+
+
+class Profiler:
+    """
+    Profiling of a live process, turned on and off from outside. Before
+    Python 3.12 cProfile only sees the thread it was enabled in, so while a
+    capture runs the main loop is profiled from the thread that started it
+    and every routing job wraps itself in a profile of its own (see job()).
+    When the capture stops they are merged into one pstats file. From 3.12
+    one profile sees every thread, and only one may be enabled at a time, so
+    the capture is all there is. Memory snapshots use tracemalloc,
+    which starts on the first one, so every later one can say what grew.
+    Everything is written to the runtime directory.
+    """
+    # Lines of allocations in a memory snapshot.
+    MEMORY_TOP = 25
+    PROFILE_FILE_NAME = "maxime-profile-%s-%s.prof"
+    MEMORY_FILE_NAME = "maxime-memory-%s-%s.txt"
+    # Whether one cProfile profile sees every thread of the interpreter.
+    PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Profile of the thread that started the capture, None when not capturing.
+        self._profile = None
+        self._finished = []
+        self._last_snapshot = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Return the profiler of this process.
+        :return: Profiler
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @property
+    def capturing(self):
+        """
+        Whether a CPU profile is being captured.
+        :return: Boolean
+        """
+        return self._profile is not None
+
+    @staticmethod
+    def _get_path(file_name):
+        """
+        Return a new file path in the runtime directory.
+        :param file_name: One of the *_FILE_NAME constants.
+        :return: String of the path.
+        """
+        now = time.time()
+        stamp = "%s%03d" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), now % 1 * 1000)
+        return Maxime.get_runtime_path(file_name % (os.getpid(), stamp))
+
+    def start(self):
+        """
+        Start a CPU profile capture. Call this from the thread to profile.
+        :return: None
+        """
+        import cProfile
+        with self._lock:
+            if self._profile is not None:
+                return
+            self._finished = []
+            self._profile = cProfile.Profile()
+        self._profile.enable()
+        logging.info("Started capturing a CPU profile.")
+
+    def stop(self):
+        """
+        Stop the capture and write it out. Call this from the thread that started it.
+        :return: Path of the pstats file, or None if we were not capturing.
+        """
+        import pstats
+        with self._lock:
+            profile, self._profile = self._profile, None
+            finished, self._finished = self._finished, []
+        if profile is None:
+            return None
+        profile.disable()
+
+        stats = pstats.Stats(profile)
+        for job_profile in finished:
+            stats.add(job_profile)
+        path = self._get_path(self.PROFILE_FILE_NAME)
+        stats.dump_stats(path)
+        logging.info("Wrote a CPU profile to \"%s\" (%s worker job(s) merged in)", path, len(finished))
+        return path
+
+    def toggle(self):
+        """
+        Start a capture, or stop the one that is running.
+        :return: None
+        """
+        if self.capturing is True:
+            self.stop()
+        else:
+            self.start()
+
+    def handle_signal(self, signum):
+        """
+        SIGUSR1 starts or stops a CPU profile, SIGUSR2 dumps memory. Run this
+        from the main loop rather than as a Python signal handler, which
+        would not run until the main loop returns to Python.
+        :param signum: Signal number.
+        :return: None
+        """
+        import signal
+        try:
+            if signum == signal.SIGUSR1:
+                self.toggle()
+            elif signum == signal.SIGUSR2:
+                self.dump_memory()
+        except Exception as e:
+            logging.error("Could not profile: %s", e)
+
+    def watch_signals(self):
+        """
+        Act on SIGUSR1 and SIGUSR2 from the GLib main loop.
+        :return: None
+        """
+        import signal
+        from gi.repository import GLib
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum,
+                                 lambda signum: self.handle_signal(signum) or True, signum)
+
+    def job(self, function, *args):
+        """
+        Run a function, profiling it if a capture is running and the
+        capture does not see this thread already.
+        :return: Whatever the function returned.
+        """
+        if self._profile is None or self.PROFILES_ALL_THREADS is True:
+            return function(*args)
+
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Something else is profiling. The job matters more than its profile.
+            logging.debug("Not profiling %s: %s", function.__name__, e)
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self._lock:
+                if self._profile is not None:
+                    self._finished.append(profile)
+
+    def dump_memory(self):
+        """
+        Write the biggest allocations, along with counts of open files,
+        sockets and threads. The first call starts tracing allocations, so
+        it only has the counts.
+        :return: Path of the file.
+        """
+        import tracemalloc
+        fds, sockets = self.count_fds()
+        lines = ["pid %s at %s" % (os.getpid(), time.strftime("%Y-%m-%d %H:%M:%S")),
+                 "open fds: %s" % fds,
+                 # Each D-Bus and Pulse connection is one of these.
+                 "open sockets: %s" % sockets,
+                 "threads: %s" % threading.active_count(),
+                 ""]
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            lines.append("Started tracing allocations. Dump again for a snapshot.")
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append("traced: %s KiB (peak %s KiB)" % (current // 1024, peak // 1024))
+            lines.append("")
+            lines.append("Top %s allocations by line:" % self.MEMORY_TOP)
+            lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:self.MEMORY_TOP])
+            if self._last_snapshot is not None:
+                lines.append("")
+                lines.append("Top %s changes since the last dump:" % self.MEMORY_TOP)
+                lines.extend(str(stat) for stat in snapshot.compare_to(self._last_snapshot, 'lineno')[:self.MEMORY_TOP])
+            self._last_snapshot = snapshot
+
+        path = self._get_path(self.MEMORY_FILE_NAME)
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        logging.info("Wrote a memory snapshot to \"%s\"", path)
+        return path
+
+    @staticmethod
+    def count_fds():
+        """
+        Return how many file descriptors we have open, and how many of them
+        are sockets. This only reads /proc, so counting does not open any
+        connections of its own.
+        :return: Tuple of integers, or of None if we could not tell.
+        """
+        try:
+            fds = os.listdir("/proc/self/fd")
+        except OSError:
+            return None, None
+        sockets = 0
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join("/proc/self/fd", fd)).startswith("socket:"):
+                    sockets += 1
+            except OSError:
+                # Closed while we were counting, like the one listdir used.
+                pass
+        return len(fds), sockets
+
+
+class TraceRecorder:
+    """
+    Append-only trace of what the daemon was told and what it did about it,
+    to replay later against fakes (see bench/replay.py). Each line is a JSON
+    list of the seconds since recording started, by time.monotonic(), the
+    kind of record and its fields:
+
+    * start: trace version, wall clock time and the config.
+    * bluez_objects: the BlueZ objects as GetManagedObjects listed them.
+    * bluez: member, object path and arguments of a BlueZ signal.
+    * pulse_objects: a facility and every object in it, as listed.
+    * pulse: facility, event type, index and the object (null if removed).
+    * command: control interface command and its arguments.
+    * route: sink name and description that streams were moved to, the
+      names of the streams and why (route or follow).
+
+    Pulse objects keep only the attributes that routing looks at. Records
+    are queued and written by a background thread, like the log, so the
+    main loop and the routing worker never wait on the file. Recording is
+    off unless the daemon runs with --record, and record() then does nothing.
+    """
+    VERSION = 1
+
+    KIND_START = "start"
+    KIND_BLUEZ_OBJECTS = "bluez_objects"
+    KIND_BLUEZ = "bluez"
+    KIND_PULSE_OBJECTS = "pulse_objects"
+    KIND_PULSE = "pulse"
+    KIND_COMMAND = "command"
+    KIND_ROUTE = "route"
+
+    # Why streams were moved.
+    REASON_ROUTE = "route"
+    REASON_FOLLOW = "follow"
+
+    # Attributes of Pulse objects that routing looks at, by facility.
+    PULSE_FIELDS = {
+        "sink": ("name", "description", "card", "state", "port_active"),
+        "source": ("name", "description", "monitor_of_sink"),
+        "card": ("name", "description", "profile_active", "profile_list", "port_list"),
+        "sink_input": ("name", "sink", "mute", "proplist"),
+    }
+    # Stream properties that StreamRules matches on, and the stream name.
+    PROPLIST_KEYS = ("media.name", "application.process.binary", "media.role")
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer_thread = None
+        self._started = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Return the trace recorder of this process.
+        :return: TraceRecorder
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def open(self, path, config):
+        """
+        Start recording to the end of a trace file.
+        :param path: Path of the trace file.
+        :param config: Validated configparser object, recorded for replay.
+        :return: None
+        """
+        import queue
+        with self._lock:
+            if self.enabled is True:
+                return
+            self.path = path
+            self._queue = queue.SimpleQueue()
+            self._writer_thread = threading.Thread(target=self._write_loop, args=(open(path, 'a'),),
+                                                   name="maxime-trace", daemon=True)
+            self._writer_thread.start()
+            self._started = time.monotonic()
+            self.enabled = True
+        atexit.register(self.close)
+        self.record(self.KIND_START, self.VERSION, time.time(),
+                    dict((section, dict(config.items(section))) for section in config.sections()))
+        logging.info("Recording a trace to \"%s\"", path)
+
+    def close(self):
+        """
+        Stop recording and wait for what is queued to be written.
+        :return: None
+        """
+        with self._lock:
+            if self.enabled is False:
+                return
+            self.enabled = False
+            self._queue.put(None)
+        self._writer_thread.join()
+
+    def _write_loop(self, trace_file):
+        import json
+        with trace_file:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    return
+                trace_file.write(json.dumps(record, separators=(',', ':')) + "\n")
+                # Flushing once the queue is drained keeps bursts cheap and
+                # leaves little behind if we crash.
+                if self._queue.empty():
+                    trace_file.flush()
+
+    def record(self, kind, *fields):
+        """
+        Add a record to the trace. Fields are made plain (see plain()).
+        :param kind: One of the KIND_* constants.
+        :param fields: What the kind records.
+        :return: None
+        """
+        if self.enabled is False:
+            return
+        fields = [self.plain(field) for field in fields]
+        # Taking the time under the lock keeps the trace in order across threads.
+        with self._lock:
+            if self.enabled is True:
+                self._queue.put([round(time.monotonic() - self._started, 6), kind] + fields)
+
+    def record_pulse(self, facility, event_type, index, obj):
+        """
+        Record a Pulse event.
+        :param facility: One of the PulseCache.FACILITY_* constants.
+        :param event_type: One of the PulseCache.EVENT_* constants.
+        :param index: Pulse index of the object.
+        :param obj: pulsectl info object, or None if it was removed.
+        :return: None
+        """
+        if self.enabled is False:
+            return
+        self.record(self.KIND_PULSE, facility, event_type, index, self._pulse_object(facility, obj))
+
+    def record_pulse_objects(self, facility, objects):
+        """
+        Record every object of a facility, as listed.
+        :return: None
+        """
+        if self.enabled is False:
+            return
+        self.record(self.KIND_PULSE_OBJECTS, facility, [self._pulse_object(facility, obj) for obj in objects])
+
+    def record_command(self, function, args):
+        """
+        Record a control interface command. Only arguments that came from
+        the caller (strings) are kept, not our own objects.
+        :param function: Maxime method that runs the command.
+        :param args: Arguments it is called with.
+        :return: None
+        """
+        if self.enabled is False:
+            return
+        self.record(self.KIND_COMMAND, function.__name__, [arg for arg in args if isinstance(arg, str)])
+
+    def _pulse_object(self, facility, obj):
+        """
+        Return the attributes of a Pulse object that routing looks at.
+        :return: Dictionary, or None for no object.
+        """
+        if obj is None:
+            return None
+        fields = {"index": obj.index}
+        for field in self.PULSE_FIELDS[facility]:
+            value = getattr(obj, field, None)
+            if field in ("profile_active", "port_active"):
+                value = getattr(value, "name", None)
+            elif field in ("profile_list", "port_list"):
+                value = [item.name for item in value or []]
+            elif field == "proplist":
+                value = dict((key, value[key]) for key in self.PROPLIST_KEYS if key in (value or {}))
+            fields[field] = value
+        return self.plain(fields)
+
+    @classmethod
+    def plain(cls, value):
+        """
+        Turn dbus-python and pulsectl values (however deeply nested) into
+        what JSON can hold.
+        :param value: Anything.
+        :return: The same as None, bool, int, float, str, list or dict.
+        """
+        if value is None or isinstance(value, (str, float)):
+            return value
+        # dbus.Boolean is an int, not a bool.
+        if isinstance(value, bool) or type(value).__name__ == "Boolean":
+            return bool(value)
+        if isinstance(value, int):
+            return int(value)
+        if isinstance(value, dict):
+            return dict((str(k), cls.plain(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [cls.plain(v) for v in value]
+        return str(value)
+
+
+class RouteState:
+    """
+    What the daemon routed to last and what is connected. The daemon keeps
+    it current and publishes it to a small memory-mapped file, so --status
+    can answer with one file read instead of a Pulse connection. Writes
+    follow a sequence lock: the sequence number is odd while the payload is
+    being written, so readers retry instead of seeing half of it. The
+    daemon re-stamps the file every HEARTBEAT_INTERVAL seconds, and readers
+    ignore it once the stamp is older than MAX_AGE.
+    """
+    FILE_NAME = "maxime.state"
+    SIZE = 4096
+    # Sequence number, heartbeat (time.time()) and payload length.
+    HEADER_FORMAT = "=QdI"
+    HEARTBEAT_INTERVAL = 5
+    MAX_AGE = 15
+    READ_ATTEMPTS = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+        self._mmap = None
+        self._seq = 0
+
+    def get(self, key, default=None):
+        """
+        Return one value of the state.
+        :param key: Name of the value.
+        :param default: What to return if it is not known.
+        :return: The value.
+        """
+        with self._lock:
+            return self._state.get(key, default)
+
+    def snapshot(self):
+        """
+        Return a copy of the whole state.
+        :return: Dictionary
+        """
+        with self._lock:
+            return dict(self._state)
+
+    def update(self, **changes):
+        """
+        Change some values, and publish them if we are publishing.
+        :param changes: Names and new values.
+        :return: None
+        """
+        with self._lock:
+            self._state.update(changes)
+            self._write()
+
+    def publish(self, path):
+        """
+        Start publishing the state to a file, and keep its stamp fresh from a
+        background thread.
+        :param path: Path of the file, normally in $XDG_RUNTIME_DIR.
+        :return: None
+        """
+        import mmap
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, self.SIZE)
+            with self._lock:
+                self._mmap = mmap.mmap(fd, self.SIZE)
+                self._state['pid'] = os.getpid()
+                self._write()
+        finally:
+            os.close(fd)
+        logging.debug("Publishing route state to \"%s\".", path)
+
+        def heartbeat_loop():
+            while True:
+                time.sleep(self.HEARTBEAT_INTERVAL)
+                with self._lock:
+                    self._write()
+
+        threading.Thread(target=heartbeat_loop, name="maxime-state", daemon=True).start()
+        # Readers should not trust us once we are gone.
+        atexit.register(self._retract)
+
+    def _write(self, heartbeat=None):
+        """
+        Write the state to the file. Call with the lock held.
+        :param heartbeat: Stamp to write, defaults to now.
+        :return: None
+        """
+        if self._mmap is None:
+            return
+        import json
+        import struct
+        payload = json.dumps(self._state).encode()
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        if header_size + len(payload) > self.SIZE:
+            logging.error("Route state is too big to publish (%s bytes).", len(payload))
+            return
+
+        if heartbeat is None:
+            heartbeat = time.time()
+        self._seq += 1
+        struct.pack_into("=Q", self._mmap, 0, self._seq)
+        self._mmap[header_size:header_size + len(payload)] = payload
+        self._seq += 1
+        struct.pack_into(self.HEADER_FORMAT, self._mmap, 0, self._seq, heartbeat, len(payload))
+
+    def _retract(self):
+        with self._lock:
+            self._write(heartbeat=0)
+
+    @classmethod
+    def read(cls, path, max_age=MAX_AGE):
+        """
+        Read the state a daemon published.
+        :param path: Path of the file.
+        :param max_age: Seconds after which a stamp is too old to trust.
+        :return: Dictionary of the state, or None if there is no fresh one.
+        """
+        import json
+        import mmap
+        import struct
+        try:
+            with open(path, 'rb') as f:
+                state_map = mmap.mmap(f.fileno(), cls.SIZE, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        header_size = struct.calcsize(cls.HEADER_FORMAT)
+        with state_map:
+            for _ in range(cls.READ_ATTEMPTS):
+                seq, heartbeat, length = struct.unpack_from(cls.HEADER_FORMAT, state_map, 0)
+                if seq % 2 == 1:
+                    continue
+                payload = state_map[header_size:header_size + length]
+                if struct.unpack_from("=Q", state_map, 0)[0] != seq:
+                    continue
+                break
+            else:
+                return None
+
+        if seq == 0 or time.time() - heartbeat > max_age:
+            logging.debug("Published route state is stale.")
+            return None
+        try:
+            return json.loads(payload.decode())
+        except ValueError:
+            return None
+
+
+class StreamRules:
+    """
+    Decides which playback streams (sink inputs) we route. A stream is ours
+    if its name, application binary or media role is listed in [streams].
+    Without that section we route the LADSPA EQ stream.
+    """
+    CONFIG_SECTION = "streams"
+    DEFAULT_NAMES = "LADSPA Stream"
+
+    PROPERTY_BINARY = "application.process.binary"
+    PROPERTY_ROLE = "media.role"
+
+    def __init__(self, config):
+        """
+        Constructor
+        :param config: Validated configparser object
+        """
+        self.names = self._get_list(config, 'names', self.DEFAULT_NAMES)
+        self.binaries = self._get_list(config, 'binaries', '')
+        self.roles = self._get_list(config, 'roles', '')
+
+    def _get_list(self, config, key, default):
+        value = config.get(self.CONFIG_SECTION, key, fallback=default)
+        return frozenset(item.strip() for item in value.split(',') if item.strip())
+
+    def __str__(self):
+        return "names=%s binaries=%s roles=%s" % (sorted(self.names), sorted(self.binaries), sorted(self.roles))
+
+    def matches(self, stream):
+        """
+        Return whether a sink input should be routed.
+        :param stream: Pulse sink input.
+        :return: Boolean
+        """
+        if stream.name in self.names:
+            return True
+        proplist = getattr(stream, 'proplist', {})
+        return (proplist.get(self.PROPERTY_BINARY) in self.binaries
+                or proplist.get(self.PROPERTY_ROLE) in self.roles)
+
+
+class GenericAudioDevice:
+    def __init__(self, config, mode):
+        self.input_device = config.get(mode, 'input_device')
+        self.output_device = config.get(mode, 'output_device')
+        
+
+class BluetoothDevice:
+    """
+    Bluetooth specific crap.
+    """
+    DBUS_SERVICE = "org.bluez"
+    DBUS_INTERFACE_DEVICE = "org.bluez.Device1"
+    DBUS_INTERFACE_PROPERTIES = "org.freedesktop.DBus.Properties"
+
+    # How we talk to BlueZ to (dis)connect.
+    BACKEND_DBUS = "dbus"
+    BACKEND_BLUETOOTHCTL = "bluetoothctl"
+
+    # Seconds BlueZ gets to finish a Connect/Disconnect before we give up.
+    DBUS_CALL_TIMEOUT = 30
+
+    # Seconds to wait for Pulse to register the device's sink after it connects.
+    DEFAULT_SINK_TIMEOUT = 10
+
+    LATENCY_OFFSET_KEY = "latency_offset"
+
+    # The primary device lives in [bluetooth], any others in [bluetooth:<name>].
+    CONFIG_SECTION = "bluetooth"
+    CONFIG_SECTION_PREFIX = "bluetooth:"
+
+    # Object paths of devices look like /org/bluez/hci0/dev_DE_AD_BE_EF_CA_FE.
+    DBUS_DEVICE_PATH_RE = re.compile(r"^/org/bluez/[^/]+/dev_(?P<mac>[0-9A-Fa-f_]{17})$")
+
+    def __init__(self, config, section=CONFIG_SECTION):
+        """
+        Constructor
+        :param config: Validated configparser object 
+        :param section: Config section describing the device.
+        """
+        # Settings that are not per-device come from [bluetooth].
+        defaults = self.CONFIG_SECTION
+
+        self.name = section
+        # Only looked up in [bluetooth] if the device has no adapter of its own.
+        self.adapter = config.get(section, 'adapter', fallback=None) or config.get(defaults, 'adapter')
+        self.mac = config.get(section, 'device_mac').upper()
+        self.dbus_object_path = self._get_dbus_device_object_path(self.adapter, self.mac)
+        self.proxy = None
+        self.properties = None
+        self.interface = None
+        self.output_device = config.get(section, 'output_device')
+        self.priority = config.getint(section, 'priority', fallback=0)
+        self.order = 0
+        self.backend = config.get(defaults, 'backend', fallback=self.BACKEND_DBUS)
+        self.sink_timeout = config.getfloat(section, 'sink_timeout',
+                                            fallback=config.getfloat(defaults, 'sink_timeout',
+                                                                     fallback=self.DEFAULT_SINK_TIMEOUT))
+        # Milliseconds by card profile, from latency_offset_<profile>. None
+        # is latency_offset, for profiles without one of their own.
+        self.latency_offsets = {}
+        for key, value in config.items(section):
+            if key == self.LATENCY_OFFSET_KEY:
+                self.latency_offsets[None] = float(value)
+            elif key.startswith(self.LATENCY_OFFSET_KEY + "_"):
+                self.latency_offsets[key[len(self.LATENCY_OFFSET_KEY) + 1:]] = float(value)
+
+    def __str__(self):
+        return self.output_device
+
+    def get_latency_offset(self, profile):
+        """
+        Return the latency offset configured for a card profile.
+        :param profile: Name of the card profile.
+        :return: Milliseconds, or None if there is none.
+        """
+        return self.latency_offsets.get(profile, self.latency_offsets.get(None))
+
+    @classmethod
+    def get_devices(cls, config):
+        """
+        Return every configured Bluetooth device, the primary one first.
+        :param config: Validated configparser object
+        :return: List of BluetoothDevice
+        """
+        devices = [cls(config)]
+        for section in config.sections():
+            if section.startswith(cls.CONFIG_SECTION_PREFIX):
+                devices.append(cls(config, section))
+        for order, device in enumerate(devices):
+            device.order = order
+        return devices
+
+    @classmethod
+    def get_mac_from_object_path(cls, path):
+        """
+        Return the MAC address of a device from its DBus object path.
+        :param path: DBus object path.
+        :return: MAC address, or None if this is not a device path.
+        """
+        match = cls.DBUS_DEVICE_PATH_RE.match(path)
+        if match is None:
+            return None
+        return match.group('mac').replace('_', ':').upper()
+
+    def set_dbus_object_path(self, path):
+        """
+        Point at a different object path, such as when the device shows up
+        on another adapter.
+        :param path: DBus object path.
+        :return: None
+        """
+        if path == self.dbus_object_path:
+            return
+        logging.debug("\"%s\" is now at %s", self.output_device, path)
+        self.dbus_object_path = path
+        self.proxy = None
+        self.properties = None
+        self.interface = None
+
+    @staticmethod
+    def _get_normal_mac(mac):
+        """
+        Return a DBus-normalized MAC address.
+        :param mac: MAC address to normalize
+        :return: A DBus/BlueZ compatible MAC address
+        """
+        return mac.replace(':','_')
+
+    def _get_dbus_device_object_path(self, adapter, mac):
+        """
+        Return the DBus object path of a particular device.
+        :param adapter: The Bluetooth interface.
+        :param mac: The normalized MAC address.
+        :return: A string of the device path.
+        """
+        mac = self._get_normal_mac(mac)
+        service = self.DBUS_SERVICE.replace('.', '/')
+        obj_path = "/%s/%s/dev_%s" % (service, adapter, mac)
+
+        return obj_path
+
+    def setup_dbus(self, bus=None):
+        """
+        Setup our DBus proxy object, properties interface and device interface.
+        The proxy object is used to perform operations against this device.
+        :param bus: DBus system bus to use. One is opened if not given.
+        :return: None
+        """
+        import dbus
+        if self.proxy is not None:
+            return
+        if bus is None:
+            bus = dbus.SystemBus()
+
+        self.proxy = bus.get_object(self.DBUS_SERVICE, self.dbus_object_path)
+        self.properties = dbus.Interface(self.proxy, dbus_interface=self.DBUS_INTERFACE_PROPERTIES)
+        self.interface = dbus.Interface(self.proxy, dbus_interface=self.DBUS_INTERFACE_DEVICE)
+
+    def get_property(self, key):
+        """
+        Return a device property from DBus.
+        :param key: 
+        :return: 
+        """
+        try:
+            self.setup_dbus()
+            return self.properties.Get(self.DBUS_INTERFACE_DEVICE, key)
+        except Exception as e:
+            logging.error("Could not retrieve property '%s' on '%s'. Error \"%s\"", key, self.DBUS_INTERFACE_DEVICE, e)
+
+    def is_connected(self):
+        """
+        Return whether BlueZ says the device is connected.
+        :return: Boolean, or None if we could not tell.
+        """
+        connected = self.get_property('Connected')
+        if connected is None:
+            return None
+        return bool(connected)
+
+    def connect(self, reply_handler=None, error_handler=None):
+        """
+        Connect the device through BlueZ.
+        :param reply_handler: Callable to make the call asynchronously.
+        :param error_handler: Callable taking a DBusException when asynchronous.
+        :return: Boolean of success, or None when asynchronous.
+        """
+        return self._call_device_method('Connect', reply_handler, error_handler)
+
+    def disconnect(self, reply_handler=None, error_handler=None):
+        """
+        Disconnect the device through BlueZ.
+        :param reply_handler: Callable to make the call asynchronously.
+        :param error_handler: Callable taking a DBusException when asynchronous.
+        :return: Boolean of success, or None when asynchronous.
+        """
+        return self._call_device_method('Disconnect', reply_handler, error_handler)
+
+    def _call_device_method(self, method, reply_handler=None, error_handler=None):
+        """
+        Call a method on the org.bluez.Device1 interface. BlueZ only replies
+        once the operation is done, so there is nothing to sleep or poll for.
+        Given handlers, the call is made without blocking and the reply is
+        delivered by the main loop.
+        :param method: Name of the method.
+        :param reply_handler: Callable taking no arguments.
+        :param error_handler: Callable taking a DBusException.
+        :return: Boolean of success, or None when asynchronous.
+        """
+        import dbus
+        self.setup_dbus()
+        call = getattr(self.interface, method)
+
+        if reply_handler is not None or error_handler is not None:
+            if reply_handler is None:
+                reply_handler = lambda: None
+            if error_handler is None:
+                error_handler = lambda e: logging.error("%s on \"%s\" failed: %s", method, self.mac, e)
+            call(reply_handler=reply_handler, error_handler=error_handler, timeout=self.DBUS_CALL_TIMEOUT)
+            return None
+
+        try:
+            with Metrics.shared().span("bluez_%s" % method.lower()):
+                call(timeout=self.DBUS_CALL_TIMEOUT)
+        except dbus.exceptions.DBusException as e:
+            logging.error("%s on \"%s\" failed: %s", method, self.mac, e)
+            return False
+        return True
+
+
+class BluetoothctlBackend:
+    """
+    Connection management through bluetoothctl, for systems where we are
+    not allowed to call BlueZ over DBus.
+    """
+    def __init__(self, bt_device):
+        """
+        Constructor
+        :param bt_device: BluetoothDevice to manage.
+        """
+        self.bt_device = bt_device
+        self.bluez = Bluetoothctl.shared()
+
+    def is_connected(self):
+        """
+        Return whether bluetoothctl says the device is connected.
+        :return: Boolean, or None if we could not tell.
+        """
+        return self.bluez.is_connected(self.bt_device.mac)
+
+    def connect(self):
+        """
+        Connect the device.
+        :return: Boolean of success, or None on error.
+        """
+        return self.bluez.connect(mac_address=self.bt_device.mac)
+
+    def disconnect(self):
+        """
+        Disconnect the device.
+        :return: Boolean of success, or None on error.
+        """
+        return self.bluez.disconnect(mac_address=self.bt_device.mac)
+
+
+class ConnectionScheduler:
+    """
+    Connects and disconnects Bluetooth devices until the Connected property
+    says it worked. Failed attempts are retried a bounded number of times,
+    backing off exponentially with jitter so that we do not keep hitting the
+    radio in lockstep with the headphones. Every command supersedes the ones
+    before it: a connect still retrying gives up as soon as a disconnect
+    comes in.
+
+    In the daemon the DBusListener tells us when the property changes. The
+    one-shot modes have no main loop, so there we read the property instead.
+    """
+    OUTCOME_CONNECTED = "connected"
+    OUTCOME_DISCONNECTED = "disconnected"
+    OUTCOME_UNCHANGED = "unchanged"
+    OUTCOME_FAILED = "failed"
+    OUTCOME_CANCELLED = "cancelled"
+
+    DEFAULT_ATTEMPTS = 5
+    # Seconds. The delay doubles after every failed attempt, up to the max.
+    DEFAULT_RETRY_DELAY = 0.5
+    DEFAULT_RETRY_MAX_DELAY = 8.0
+    # Seconds for Connected to change after BlueZ accepted the call.
+    DEFAULT_STATE_TIMEOUT = 10.0
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, config):
+        """
+        Constructor
+        :param config: Validated configparser object
+        """
+        self.attempts = max(config.getint('bluetooth', 'connect_attempts', fallback=self.DEFAULT_ATTEMPTS), 1)
+        self.retry_delay = config.getfloat('bluetooth', 'retry_delay', fallback=self.DEFAULT_RETRY_DELAY)
+        self.retry_max_delay = config.getfloat('bluetooth', 'retry_max_delay', fallback=self.DEFAULT_RETRY_MAX_DELAY)
+        self.state_timeout = config.getfloat('bluetooth', 'connect_timeout', fallback=self.DEFAULT_STATE_TIMEOUT)
+        self._changed = threading.Condition()
+        self._generation = 0
+        # Connected state by mac, as told by a DBusListener. None until attached.
+        self._known = None
+
+    def attach(self, listener):
+        """
+        Follow connection changes seen by a DBusListener instead of reading
+        the Connected property.
+        :param listener: DBusListener
+        :return: None
+        """
+        with self._changed:
+            self._known = dict((mac, True) for mac in listener.connected)
+        listener.add_connection_listener(self._connection_changed)
+
+    def _connection_changed(self, device, connected):
+        """
+        DBusListener callback for a change of the Connected property.
+        :return: None
+        """
+        with self._changed:
+            self._known[device.mac] = connected
+            self._changed.notify_all()
+
+    def begin(self):
+        """
+        Start a new command, cancelling any that is still running.
+        :return: Generation of the command, to pass to change().
+        """
+        with self._changed:
+            self._generation += 1
+            self._changed.notify_all()
+            return self._generation
+
+    def change(self, bt_device, bluez, connected, generation):
+        """
+        Connect or disconnect a device, retrying until it is done, the
+        attempts run out or a newer command comes in.
+        :param bt_device: BluetoothDevice
+        :param bluez: Connection backend of the device (see Maxime._get_bluetooth_backend).
+        :param connected: True to connect, False to disconnect.
+        :param generation: Generation from begin().
+        :return: One of the OUTCOME_* constants.
+        """
+        verb = "connect to" if connected is True else "disconnect from"
+        done = self.OUTCOME_CONNECTED if connected is True else self.OUTCOME_DISCONNECTED
+
+        is_connected = bluez.is_connected()
+        logging.debug("Wireless device connected state is %s.", is_connected)
+        if is_connected is connected:
+            return self.OUTCOME_UNCHANGED
+        # An unknown state is worth an attempt. BlueZ knows better than we do.
+
+        for attempt in range(1, self.attempts + 1):
+            if self._cancelled(generation):
+                return self.OUTCOME_CANCELLED
+            result = bluez.connect() if connected is True else bluez.disconnect()
+            if result is not False and self._wait_for_state(bt_device, bluez, connected, generation):
+                logging.debug("Took %s attempt(s) to %s \"%s\".", attempt, verb, bt_device.output_device)
+                return done
+            if self._cancelled(generation):
+                return self.OUTCOME_CANCELLED
+            if attempt == self.attempts:
                 break
+
+            delay = self._backoff(attempt)
+            logging.warning("Attempt %s of %s to %s \"%s\" failed. Trying again in %.2f seconds.",
+                            attempt, self.attempts, verb, bt_device.output_device, delay)
+            if self._sleep(delay, generation) is False:
+                return self.OUTCOME_CANCELLED
+
+        return self.OUTCOME_FAILED
+
+    def _backoff(self, attempt):
+        """
+        Delay before the next attempt. Half of it is fixed, the other half random.
+        :param attempt: Number of the attempt that just failed, from 1.
+        :return: Seconds
+        """
+        import random
+        delay = min(self.retry_delay * 2 ** (attempt - 1), self.retry_max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _cancelled(self, generation):
+        """
+        Whether a newer command came in.
+        :return: Boolean
+        """
+        with self._changed:
+            return generation != self._generation
+
+    def _sleep(self, seconds, generation):
+        """
+        Wait, unless a newer command comes in.
+        :return: Boolean of whether we waited the whole time.
+        """
+        deadline = time.monotonic() + seconds
+        with self._changed:
+            while generation == self._generation:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self._changed.wait(remaining)
+        return False
+
+    def _wait_for_state(self, bt_device, bluez, connected, generation):
+        """
+        Wait for the Connected property of a device to change.
+        :return: Boolean of whether it did.
+        """
+        deadline = time.monotonic() + self.state_timeout
+        with self._changed:
+            if self._known is not None:
+                while self._known.get(bt_device.mac, False) is not connected:
+                    remaining = deadline - time.monotonic()
+                    if generation != self._generation or remaining <= 0:
+                        return False
+                    self._changed.wait(remaining)
+                return True
+
+        while bluez.is_connected() is not connected:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._sleep(min(self.POLL_INTERVAL, remaining), generation) is False:
+                return False
+        return True
+
+
+class ConnectionDebouncer:
+    """
+    Sits between Bluetooth signals and routing. A new connection state has to
+    hold for a while before it is acted on, so a link flapping at the edge of
+    range settles into one reroute instead of a storm of them. Disconnects
+    get a shorter window than connects by default, since the speakers must
+    be muted quickly.
+    """
+    DEFAULT_CONNECT_WINDOW = 0.5
+    DEFAULT_DISCONNECT_WINDOW = 0.0
+
+    def __init__(self, config, callback):
+        """
+        Constructor
+        :param config: Validated configparser object
+        :param callback: Called with the settled state and a callable that
+                         says whether a newer state has arrived since. A state
+                         is anything, where falsy means disconnected.
+        """
+        self.connect_window = config.getfloat('daemon', 'debounce_connect',
+                                              fallback=self.DEFAULT_CONNECT_WINDOW)
+        self.disconnect_window = config.getfloat('daemon', 'debounce_disconnect',
+                                                 fallback=self.DEFAULT_DISCONNECT_WINDOW)
+        self.callback = callback
+
+        self.generation = 0
+        self.received = 0
+        self.suppressed = 0
+        self._applied_state = None
+        self._pending_state = None
+        self._pending_timer = None
+
+    def prime(self, state):
+        """
+        Set the state we start out in, without acting on it.
+        :param state: The current state.
+        :return: None
+        """
+        self._applied_state = state
+
+    def submit(self, state):
+        """
+        Take a new connection state.
+        :param state: The new state.
+        :return: None
+        """
+        self.received += 1
+        self.generation += 1
+        if self._pending_timer is not None:
+            self._cancel_timer(self._pending_timer)
+            self._pending_timer = None
+            self._suppress("\"%s\" superseded by \"%s\"." % (self._pending_state, state))
+
+        self._pending_state = state
+        window = self.connect_window if state else self.disconnect_window
+        if window <= 0:
+            self._settle()
+            return
+        logging.debug("Waiting %s seconds for \"%s\" to settle.", window, state)
+        self._pending_timer = self._start_timer(window, self._settle)
+
+    def _start_timer(self, seconds, callback):
+        """
+        Run callback once after a delay on the main loop.
+        :return: Handle for _cancel_timer().
+        """
+        from gi.repository import GLib
+        return GLib.timeout_add(int(seconds * 1000), callback)
+
+    def _cancel_timer(self, handle):
+        from gi.repository import GLib
+        GLib.source_remove(handle)
+
+    def _settle(self):
+        """
+        Act on the pending state now that it has held for its window.
+        :return: False, so GLib does not run us again.
+        """
+        self._pending_timer = None
+        state = self._pending_state
+        if state == self._applied_state:
+            self._suppress("\"%s\" is what we already routed for." % state)
+            return False
+
+        self._applied_state = state
+        generation = self.generation
+        self.callback(state, lambda: self.generation != generation)
+        return False
+
+    def _suppress(self, reason):
+        self.suppressed += 1
+        logging.debug("Suppressed connection event (%s of %s so far): %s", self.suppressed, self.received, reason)
+
+
+class JobCancelledError(Exception):
+    """This exception is handed to the callback of a routing job that never ran."""
+    pass
+
+
+class RoutingJob:
+    """
+    One piece of work for the RoutingWorker.
+    """
+    def __init__(self, function, args, key, callback):
+        """
+        Constructor
+        :param function: Callable to run.
+        :param args: Arguments to call it with.
+        :param key: Jobs with the same key supersede each other, or None.
+        :param callback: Called with the result and exception (one is None) when done.
+        """
+        self.function = function
+        self.args = args
+        self.key = key
+        self.callback = callback
+        self.queued_at = time.monotonic()
+
+    def __str__(self):
+        return getattr(self.function, '__name__', str(self.function))
+
+    def finish(self, result, error):
+        """
+        Hand the outcome to the callback, if there is one.
+        :return: None
+        """
+        if self.callback is None:
+            return
+        try:
+            self.callback(result, error)
+        except Exception as e:
+            logging.error("Callback of %s failed: %s", self, e)
+
+
+class RoutingWorker:
+    """
+    Runs blocking Pulse and BlueZ work on a thread of its own, one job at a
+    time in the order it came in, so the main loop keeps taking signals
+    while a reroute waits on a sink. Jobs with the same key supersede each
+    other: only the newest connection change is worth acting on, so older
+    pending ones are cancelled. The queue is bounded. When it is full, the
+    oldest job that nobody waits for is dropped. Commands, which have a
+    callback to reply with, are never dropped: if only commands are
+    waiting, a new command is turned away with an error instead. Queue
+    depth and wait time go to Metrics.
+    """
+    DEFAULT_QUEUE_SIZE = 32
+    KEY_CONNECTION = "connection"
+
+    def __init__(self, config, name="routing"):
+        """
+        Constructor. Starts the worker thread.
+        :param config: Validated configparser object
+        :param name: Name of the queue, for its thread and metrics.
+        """
+        self.name = name
+        self.queue_size = max(config.getint('daemon', 'queue_size', fallback=self.DEFAULT_QUEUE_SIZE), 1)
+        self._changed = threading.Condition()
+        self._pending = collections.deque()
+        self.completed = 0
+        self.cancelled = 0
+        self.last_wait = 0.0
+        self._thread = threading.Thread(target=self._work_loop, name="maxime-%s" % name, daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """
+        Number of jobs waiting to run.
+        :return: Integer
+        """
+        with self._changed:
+            return len(self._pending)
+
+    def submit(self, function, *args, key=None, callback=None):
+        """
+        Queue a job.
+        :param function: Callable to run on the worker thread.
+        :param args: Arguments to call it with.
+        :param key: Cancel pending jobs with this key, and be cancelled by later ones.
+        :param callback: Called on the worker thread with the result and exception.
+                         A job with one is a command, which is never dropped.
+        :return: RoutingJob
+        """
+        job = RoutingJob(function, args, key, callback)
+        cancelled = []
+        with self._changed:
+            if key is not None:
+                cancelled = [pending for pending in self._pending if pending.key == key]
+                for pending in cancelled:
+                    self._pending.remove(pending)
+                    logging.debug("Cancelled %s, superseded by a newer one.", pending)
+            rejected = False
+            if len(self._pending) >= self.queue_size:
+                # Work that nobody waits for goes first, oldest first.
+                dropped = next((pending for pending in self._pending if pending.callback is None), None)
+                if dropped is not None:
+                    logging.error("The %s queue is full (%s jobs). Dropped %s.", self.name, self.queue_size, dropped)
+                    self._pending.remove(dropped)
+                    cancelled.append(dropped)
+                else:
+                    logging.error("The %s queue is full of commands (%s jobs). Turned away %s.",
+                                  self.name, self.queue_size, job)
+                    rejected = True
+            if rejected is False:
+                self._pending.append(job)
+            self.cancelled += len(cancelled) + int(rejected)
+            self._report()
+            self._changed.notify_all()
+
+        for pending in cancelled:
+            pending.finish(None, JobCancelledError("%s was cancelled before it ran." % pending))
+        if rejected is True:
+            job.finish(None, JobCancelledError("The %s queue is full." % self.name))
+        return job
+
+    def _report(self):
+        """Update the queue gauges. Call with the lock held."""
+        metrics = Metrics.shared()
+        metrics.set_gauge("%s_queue_depth" % self.name, len(self._pending))
+        metrics.set_gauge("%s_queue_wait_seconds" % self.name, round(self.last_wait, 6))
+
+    def _work_loop(self):
+        """Run jobs as they are queued, forever."""
+        while True:
+            with self._changed:
+                while not self._pending:
+                    self._changed.wait()
+                job = self._pending.popleft()
+                self.last_wait = time.monotonic() - job.queued_at
+                self._report()
+
+            metrics = Metrics.shared()
+            if metrics.enabled is True:
+                metrics.observe("%s_queue_wait" % self.name, self.last_wait)
+            logging.debug("Running %s after %.3f seconds in the queue.", job, self.last_wait)
+
+            result = None
+            error = None
+            try:
+                result = Profiler.shared().job(job.function, *job.args)
+            except Exception as e:
+                logging.error("%s failed: %s", job, e)
+                error = e
+            with self._changed:
+                self.completed += 1
+            job.finish(result, error)
+
+
+class BluezSubscription:
+    """
+    Subscription to every signal BlueZ sends, with a single match rule, and
+    the BlueZ objects as they were right after subscribing. This does not
+    need a DBusListener, so it can be made on another thread while other
+    backends start up. Signals are only dispatched once the main loop runs,
+    by which time a DBusListener has set the handler.
+    """
+    def __init__(self):
+        """
+        Constructor. Connects to the system bus.
+        """
+        import dbus
+        DBusListener.setup_main_loop()
+        self.handler = None
+        self.bus = dbus.SystemBus()
+        self.bus.add_signal_receiver(self._dispatch,
+                                     bus_name=BluetoothDevice.DBUS_SERVICE,
+                                     path_keyword='path',
+                                     member_keyword='member')
+
+        # Listing after subscribing, so that nothing that changes in between is missed.
+        try:
+            manager = dbus.Interface(self.bus.get_object(BluetoothDevice.DBUS_SERVICE, "/"),
+                                     dbus_interface=DBusListener.INTERFACE_OBJECTMANAGER)
+            self.managed_objects = manager.GetManagedObjects()
+        except dbus.exceptions.DBusException as e:
+            logging.error("Could not list BlueZ objects: %s", e)
+            self.managed_objects = {}
+
+    def _dispatch(self, *args, **kwargs):
+        """Pass a signal on to the handler."""
+        if self.handler is not None:
+            self.handler(*args, **kwargs)
+
+
+class DBusListener:
+    """
+    Class to deal with DBus events.
+    """
+    # Static vars for DBus properties and interfaces
+    INTERFACE_PROPERTIES = "org.freedesktop.DBus.Properties"
+    INTERFACE_OBJECTMANAGER = "org.freedesktop.DBus.ObjectManager"
+    SIGNAL_PROPERTIESCHANGED = "PropertiesChanged"
+    SIGNAL_INTERFACESADDED = "InterfacesAdded"
+    SIGNAL_INTERFACESREMOVED = "InterfacesRemoved"
+
+    DEBOUNCER_CLASS = ConnectionDebouncer
+
+    def __init__(self, devices, pulse, config, worker=None, subscription=None):
+        """
+        Constructor
+        :param devices: List of BluetoothDevice to watch.
+        :param pulse: PulseAudio
+        :param config: Validated configparser object
+        :param worker: RoutingWorker to route on. One is made if not given.
+        :param subscription: BluezSubscription made ahead of time, if any.
+        """
+        self.devices = dict((device.mac, device) for device in devices)
+        self.connected = set()
+        self.pulse = pulse
+        self.worker = worker if worker is not None else self._make_worker(config)
+        self._connection_listeners = []
+        self.debouncer = self.DEBOUNCER_CLASS(config, self._route_to)
+        self._setup_dbus(subscription)
+
+    @staticmethod
+    def _make_worker(config):
+        """
+        Make the worker to route on. Routing never runs on the main loop:
+        the debouncer runs there, and could not tell routing that is
+        waiting on Pulse about a newer event until it was done.
+        :param config: Validated configparser object
+        :return: RoutingWorker
+        """
+        return RoutingWorker(config)
+
+    @staticmethod
+    def setup_main_loop():
+        """
+        Make GLib the main loop of dbus-python. This has to happen before we
+        connect to a bus.
+        :return: None
+        """
+        from dbus.mainloop.glib import DBusGMainLoop, threads_init
+        # Notifications (and more) are sent from other threads.
+        threads_init()
+        DBusGMainLoop(set_as_default=True)
+
+    def _setup_dbus(self, subscription=None):
+        """
+        Take over a subscription to BlueZ, making one if we were not handed
+        one, and find out where our devices are and which are already
+        connected.
+        :param subscription: BluezSubscription, or None.
+        :return: None
+        """
+        if subscription is None:
+            subscription = BluezSubscription()
+        subscription.handler = self._bluez_signal_handler
+        self._load_managed_objects(subscription.managed_objects)
+
+    def _load_managed_objects(self, managed_objects):
+        """
+        Find our devices in the result of ObjectManager.GetManagedObjects.
+        :param managed_objects: Dictionary of object paths to their interfaces.
+        :return: None
+        """
+        TraceRecorder.shared().record(TraceRecorder.KIND_BLUEZ_OBJECTS, managed_objects)
+        for path, interfaces in managed_objects.items():
+            self._device_added(str(path), interfaces)
+
+        self.debouncer.prime(self._get_preferred_device())
+
+    def _bluez_signal_handler(self, *args, **kwargs):
+        """
+        Dispatch a signal from BlueZ to the configured device it is about.
+        :param args: Signal arguments.
+        :param kwargs: path and member of the signal.
+        :return: None
+        """
+        member = kwargs['member']
+        TraceRecorder.shared().record(TraceRecorder.KIND_BLUEZ, member, kwargs['path'], args)
+        if member == self.SIGNAL_PROPERTIESCHANGED:
+            mac = BluetoothDevice.get_mac_from_object_path(kwargs['path'])
+            device = self.devices.get(mac)
+            if device is not None:
+                self._bluetooth_signal_handler(device, *args)
+        elif member == self.SIGNAL_INTERFACESADDED:
+            self._device_added(str(args[0]), args[1])
+        elif member == self.SIGNAL_INTERFACESREMOVED:
+            self._device_removed(str(args[0]), args[1])
+
+    def _device_added(self, path, interfaces):
+        """
+        Take note of a BlueZ device showing up.
+        :param path: DBus object path of the device.
+        :param interfaces: Dictionary of interfaces to their properties.
+        :return: None
+        """
+        properties = interfaces.get(BluetoothDevice.DBUS_INTERFACE_DEVICE)
+        if properties is None:
+            return
+        device = self.devices.get(str(properties.get('Address', '')).upper())
+        if device is None:
+            return
+
+        device.set_dbus_object_path(path)
+        if bool(properties.get('Connected', False)) is True:
+            self._set_connected(device, True)
+
+    def _device_removed(self, path, interfaces):
+        """
+        Take note of a BlueZ device going away.
+        :param path: DBus object path of the device.
+        :param interfaces: List of interfaces removed.
+        :return: None
+        """
+        if BluetoothDevice.DBUS_INTERFACE_DEVICE not in interfaces:
+            return
+        device = self.devices.get(BluetoothDevice.get_mac_from_object_path(path))
+        if device is not None and device.dbus_object_path == path:
+            logging.info("\"%s\" was removed from BlueZ.", device.output_device)
+            self._set_connected(device, False)
+            self.debouncer.submit(self._get_preferred_device())
+
+    def _set_connected(self, device, connected):
+        """
+        Record the connection state of a device.
+        :return: None
+        """
+        if connected is True:
+            self.connected.add(device.mac)
+        else:
+            self.connected.discard(device.mac)
+        self.pulse.state.update(connected=[self.devices[mac].output_device for mac in sorted(self.connected)])
+        for callback in self._connection_listeners:
+            callback(device, connected)
+
+    def add_connection_listener(self, callback):
+        """
+        Have a callable run whenever a device connects or disconnects. It runs
+        on the main loop.
+        :param callback: Callable taking the BluetoothDevice and a Boolean.
+        :return: None
+        """
+        if callback not in self._connection_listeners:
+            self._connection_listeners.append(callback)
+
+    def _get_preferred_device(self):
+        """
+        Return the connected device we should route to, if any. Higher
+        priorities win, then whichever is listed first.
+        :return: BluetoothDevice or None
+        """
+        preferred = None
+        for mac in self.connected:
+            device = self.devices[mac]
+            if preferred is None or (device.priority, -device.order) > (preferred.priority, -preferred.order):
+                preferred = device
+        return preferred
+
+    def _route_to(self, device, superseded):
+        """
+        Route to a wireless device, or away from wireless if there is none.
+        The work goes to the worker, so the main loop can take the next
+        signal right away. A newer connection change cancels this one if it
+        has not started yet.
+        :param device: BluetoothDevice or None
+        :param superseded: Callable saying whether a newer event has come in.
+        :return: None
+        """
+        self.worker.submit(self._route, device, superseded, key=RoutingWorker.KEY_CONNECTION)
+
+    def _route(self, device, superseded):
+        """
+        Do the routing for _route_to().
+        :return: None
+        """
+        if device is None:
+            self.pulse.manage_connection(False, superseded)
+        else:
+            self.pulse.manage_connection(True, superseded, bt_device=device)
+
+    def listen(self):
+        """
+        Listen for events and do stuff when they happen!
+        :return: 
+        """
+        loop_msg = "Started listening for BT audio devices."
+        DBusHelper.send_notification(text=loop_msg, icon="audio-card")
+        from gi.repository import GLib
+        dbus_loop = GLib.MainLoop()
+        dbus_loop.run()
+
+    def _bluetooth_signal_handler(self, device, interface, changed_properties, signature):
+        """
+        Event handler for a change in a Bluetooth device state.
+        :param device: BluetoothDevice that changed.
+        :param interface: String of the DBus interface.
+        :param changed_properties: Dictionary of the properties that changed.
+        :param signature: String of something that I don't care about.
+        :return: None
+        """
+        logging.debug("%s: Change detected.", interface)
+
+        # Right now I only care about device connectivity
+        if interface != BluetoothDevice.DBUS_INTERFACE_DEVICE:
+            logging.debug("%s: Ignoring change.", interface)
+            return
+
+        # Test for the appropriate key in the messages we will get
+        try:
+            connected = bool(changed_properties['Connected'])
+        except KeyError:
+            # Ignore a ServicesResolved message
+            try:
+                bool(changed_properties['ServicesResolved'])
+                logging.debug("%s: Ignoring ServicesResolved.", interface)
+                return
+            except Exception:
+                logging.error("%s: Some weird error occurred "
+                              "(and it wasnt ServicesResolved).", interface)
+                return
+        except Exception:
+            logging.error("%s: Some weird error occurred.", interface)
+            return
+
+        # Deal with the connection state
+        logging.info("%s: \"%s\" Connected -> %s", interface, device.output_device, connected)
+        self._set_connected(device, connected)
+        self.debouncer.submit(self._get_preferred_device())
+        # Anything waiting on Pulse for the old state should notice.
+        self.pulse.cache.wake()
+
+
+class AsyncConnectionDebouncer(ConnectionDebouncer):
+    """
+    ConnectionDebouncer whose timers run on the asyncio event loop.
+    """
+    def _start_timer(self, seconds, callback):
+        import asyncio
+        return asyncio.get_event_loop().call_later(seconds, callback)
+
+    def _cancel_timer(self, handle):
+        handle.cancel()
+
+
+class AsyncDBusListener(DBusListener):
+    """
+    DBusListener for the asyncio engine. Signals come in over an async BlueZ
+    connection and routing is handed to the engine's worker, so the event
+    loop never waits on Pulse.
+    """
+    DEBOUNCER_CLASS = AsyncConnectionDebouncer
+
+    def __init__(self, devices, pulse, config, engine):
+        """
+        Constructor
+        :param engine: AsyncEngine to run routing on.
+        """
+        self.engine = engine
+        DBusListener.__init__(self, devices, pulse, config, engine.worker)
+
+    def _setup_dbus(self, subscription=None):
+        """Nothing to do until start() runs on the event loop."""
+        pass
+
+    async def start(self):
+        """
+        Connect to the system bus, subscribe to BlueZ with a single match rule
+        and find our devices.
+        :return: None
+        """
+        from dbus_next import BusType, Message, MessageType
+        from dbus_next.aio import MessageBus
+
+        self.bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        self.bus.add_message_handler(self._message_handler)
+        await self.bus.call(Message(destination="org.freedesktop.DBus",
+                                    path="/org/freedesktop/DBus",
+                                    interface="org.freedesktop.DBus",
+                                    member="AddMatch",
+                                    signature="s",
+                                    body=["type='signal',sender='%s'" % BluetoothDevice.DBUS_SERVICE]))
+
+        reply = await self.bus.call(Message(destination=BluetoothDevice.DBUS_SERVICE,
+                                            path="/",
+                                            interface=self.INTERFACE_OBJECTMANAGER,
+                                            member="GetManagedObjects"))
+        if reply.message_type == MessageType.ERROR:
+            logging.error("Could not list BlueZ objects: %s", reply.error_name)
+            self._load_managed_objects({})
+        else:
+            self._load_managed_objects(AsyncEngine.unwrap(reply.body[0]))
+
+    def _message_handler(self, message):
+        """
+        Pass BlueZ signals on like the GLib listener would.
+        :param message: dbus_next Message
+        :return: None
+        """
+        from dbus_next import MessageType
+        if message.message_type != MessageType.SIGNAL:
+            return None
+        self._bluez_signal_handler(*AsyncEngine.unwrap(message.body), path=message.path, member=message.member)
+        return None
+
+
+class AsyncNotificationQueue(NotificationQueue):
+    """
+    NotificationQueue that sends from the asyncio event loop over an async
+    session bus connection.
+    """
+    def __init__(self, loop):
+        """
+        Constructor. Must be called on the event loop. Notifications are
+        queued right away, and sent once set_bus() is called.
+        :param loop: asyncio event loop.
+        """
+        import asyncio
+        self.loop = loop
+        self.bus = None
+        self._bus_ready = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        NotificationQueue.__init__(self)
+
+    def set_bus(self, bus):
+        """
+        Start sending over a session bus connection.
+        :param bus: dbus_next session MessageBus.
+        :return: None
+        """
+        self.bus = bus
+        self._bus_ready.set()
+
+    def _start(self):
+        self.loop.create_task(self._send_loop_async())
+
+    def put(self, text, icon, time, actions_list, tag):
+        """
+        Queue a notification and wake the sender on the event loop.
+        :return: None
+        """
+        NotificationQueue.put(self, text, icon, time, actions_list, tag)
+        self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _send_loop_async(self):
+        """Send notifications as they are queued, forever."""
+        await self._bus_ready.wait()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._changed:
+                    if not self._pending:
+                        break
+                    notification = self._pending.popleft()
+                    self._sending = True
+                try:
+                    await self._send_async(*notification)
+                except Exception as e:
+                    logging.error("Could not send notification \"%s\": %s", notification[0], e)
+                finally:
+                    with self._changed:
+                        self._sending = False
+                        self._changed.notify_all()
+
+    async def _send_async(self, text, icon, time, actions_list, tag):
+        """
+        Send one notification.
+        :return: None
+        """
+        from dbus_next import Message, MessageType
+
+        id_num_to_replace = self._replaces_ids.get(tag, 0)
+        reply = await self.bus.call(Message(destination=DBusHelper.SERVICE_NOTIFICATIONS,
+                                            path=DBusHelper.PATH_NOTIFICATIONS,
+                                            interface=DBusHelper.INTERFACE_NOTIFICATIONS,
+                                            member="Notify",
+                                            signature="susssasa{sv}i",
+                                            body=[self.APP_NAME, id_num_to_replace, icon, self.APP_NAME, text,
+                                                  list(actions_list), {}, time]))
+        if reply.message_type == MessageType.ERROR:
+            raise Exception(reply.error_name)
+        if tag is not None:
+            self._replaces_ids[tag] = reply.body[0]
+        logging.debug("Sent notification to DBus: %s", text)
+
+
+class AsyncEngine:
+    """
+    asyncio based daemon, used with [daemon] engine=asyncio. BlueZ signals,
+    Pulse events, notifications and the control interface are all served
+    from one event loop, so none of them can stall the others. Routing
+    still uses the blocking Pulse connection, so it runs in order on a
+    RoutingWorker, like with the GLib engine. Connects, disconnects and
+    reconnects get a RoutingWorker of their own, so their retries never
+    hold up routing.
+    """
+    def __init__(self, maxime, devices, pulse, startup=None):
+        """
+        Constructor
+        :param maxime: Maxime application.
+        :param devices: List of BluetoothDevice, the primary one first.
+        :param pulse: PulseAudio
+        :param startup: Startup to report time to ready with.
+        """
+        self.maxime = maxime
+        self.devices = devices
+        self.pulse = pulse
+        self.startup = startup if startup is not None else Startup()
+        self.loop = None
+        self._pulse_ready = None
+        self.worker = RoutingWorker(maxime.config)
+        self.connection_worker = RoutingWorker(maxime.config, name="connection")
+        # Whether the Pulse watcher has a working connection.
+        self._pulse_connected = False
+
+    @staticmethod
+    def unwrap(value):
+        """
+        Turn dbus_next Variants (however deeply nested) into plain values.
+        :param value: Anything from a dbus_next message body.
+        :return: The same, without Variants.
+        """
+        from dbus_next import Variant
+        if isinstance(value, Variant):
+            return AsyncEngine.unwrap(value.value)
+        if isinstance(value, dict):
+            return dict((k, AsyncEngine.unwrap(v)) for k, v in value.items())
+        if isinstance(value, list):
+            return [AsyncEngine.unwrap(v) for v in value]
+        return value
+
+    def run(self):
+        """
+        Run the daemon until we are killed.
+        :return: None
+        """
+        import asyncio
+        asyncio.run(self._run())
+
+    def run_blocking(self, worker, function, *args, key=None):
+        """
+        Queue blocking work on a worker and let the event loop wait for it.
+        Failures are logged by the worker.
+        :param worker: RoutingWorker to run it on.
+        :param key: RoutingWorker key of the job, if any.
+        :return: asyncio Future of the result.
+        """
+        future = self.loop.create_future()
+
+        def done(result, error):
+            self.loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+        worker.submit(function, *args, key=key, callback=done)
+        return future
+
+    @staticmethod
+    def _resolve(future, result, error):
+        """
+        Hand the outcome of a job to the future waiting for it.
+        :return: None
+        """
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run_command(self, function, *args):
+        """
+        Queue a control interface command on the routing worker.
+        :return: asyncio Future of the result.
+        """
+        TraceRecorder.shared().record_command(function, args)
+        return self.run_blocking(self.worker, function, *args)
+
+    async def run_connection(self, function):
+        """
+        Run a connect, disconnect or reconnect of our device on the
+        connection worker. One that is still retrying, or waiting to, is
+        cancelled.
+        :param function: Maxime method taking the BluetoothDevice.
+        :return: One of the ConnectionScheduler.OUTCOME_* constants.
+        """
+        TraceRecorder.shared().record_command(function, ())
+        # The command begins now, not when the worker gets to it, so that it
+        # cancels one that is still retrying.
+        generation = self.maxime.connections.begin()
+        try:
+            return await self.run_blocking(self.connection_worker, function, self.devices[0], generation,
+                                           key=ControlService.JOB_CONNECTION)
+        except JobCancelledError:
+            return ConnectionScheduler.OUTCOME_CANCELLED
+
+    def run_in_background(self, function, *args, key=None):
+        """
+        Queue blocking work on the routing worker that nobody waits for.
+        Failures are logged by the worker.
+        :param key: RoutingWorker key of the job, if any.
+        :return: None
+        """
+        self.worker.submit(function, *args, key=key)
+
+    async def _run(self):
+        import asyncio
+        import signal
+        from dbus_next import BusType
+        from dbus_next.aio import MessageBus
+
+        self.loop = asyncio.get_running_loop()
+        # Before anything can notify, so no threaded queue is ever made.
+        notifications = AsyncNotificationQueue(self.loop)
+        NotificationQueue.set_shared(notifications)
+        self._pulse_ready = asyncio.Event()
+        profiler = Profiler.shared()
+        self.loop.add_signal_handler(signal.SIGUSR1, profiler.toggle)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.run_in_background, profiler.dump_memory)
+
+        # Pulse, the system bus and the session bus all come up at the same time.
+        pulse_task = self.loop.create_task(self._watch_pulse())
+        listener = AsyncDBusListener(self.devices, self.pulse, self.maxime.config, self)
+        session_bus, _ = await asyncio.gather(self._timed(Startup.SESSION_BUS,
+                                                          MessageBus(bus_type=BusType.SESSION).connect()),
+                                              self._timed(Startup.SYSTEM_BUS, listener.start()))
+        notifications.set_bus(session_bus)
+        self.maxime.connections.attach(listener)
+        LatencyMonitor(self.pulse, self.maxime.config,
+                       lambda: self.run_in_background(self.pulse.resync_wireless, key=PulseAudio.JOB_RESYNC)).start()
+        await self._serve_control(session_bus)
+        await self._pulse_ready.wait()
+        self.startup.report()
+
+        DBusHelper.send_notification(text="Started listening for BT audio devices.", icon="audio-card")
+        await pulse_task
+
+    async def _timed(self, name, awaitable):
+        """
+        Await a backend coming up, and tell Startup how long it took.
+        :param name: One of the Startup constants.
+        :param awaitable: What brings it up.
+        :return: Whatever it returned.
+        """
+        started = time.monotonic()
+        result = await awaitable
+        self.startup.record(name, time.monotonic() - started)
+        return result
+
+    async def _watch_pulse(self):
+        """
+        Keep the Pulse cache current from an async Pulse connection. Listeners
+        use the blocking connection, so they run on the worker thread. When
+        the server goes away we connect again as soon as it is back.
+        :return: None
+        """
+        import asyncio
+        from pulsectl import PulseError, PulseDisconnected
+
+        cache = self.pulse.cache
+        cache.add_listener(self.pulse._follow_new_stream)
+        cache.add_listener(self.pulse._track_output)
+
+        delay = PulseCache.RECONNECT_DELAY
+        while True:
+            try:
+                await self._watch_pulse_connection(cache)
+            except (PulseError, PulseDisconnected) as e:
+                if self._pulse_connected is True:
+                    self._pulse_connected = False
+                    logging.warning("Lost the Pulse server (%s). Reconnecting.", type(e).__name__)
+                    self.pulse.server_changed(False)
+                    delay = PulseCache.RECONNECT_DELAY
+                else:
+                    logging.debug("No Pulse server yet (%s). Trying again in %s seconds.", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, PulseCache.RECONNECT_MAX_DELAY)
+
+    async def _watch_pulse_connection(self, cache):
+        """
+        Load the cache and apply events to it until the connection is lost.
+        :param cache: PulseCache
+        :return: None
+        """
+        import asyncio
+        from pulsectl import PulseIndexError, PulseDisconnected
+        from pulsectl_asyncio import PulseAsync
+
+        async with PulseAsync(PulseCache.WATCH_CLIENT_NAME) as conn:
+            events = asyncio.Queue()
+
+            async def pump():
+                try:
+                    async for event in conn.subscribe_events(*PulseCache.FACILITIES):
+                        events.put_nowait(event)
+                finally:
+                    # Wake the loop below, the connection is gone.
+                    events.put_nowait(None)
+            pump_task = self.loop.create_task(pump())
+            # Let the subscription get going before we list, anything that
+            # changes in between then shows up as an event on top of the list.
+            await asyncio.sleep(0)
+
+            try:
+                recovered = cache.watching
+                for facility in PulseCache.FACILITIES:
+                    cache.replace(facility, await getattr(conn, "%s_list" % facility)())
+                cache.set_watching()
+                self._pulse_connected = True
+                if not self._pulse_ready.is_set():
+                    self.startup.record(Startup.PULSE, time.monotonic() - self.startup.started)
+                    self._pulse_ready.set()
+                logging.debug("Pulse cache is watching for events.")
+                if recovered is True:
+                    self.run_in_background(self.pulse.recover, key=PulseAudio.JOB_RECOVER)
+
+                while True:
+                    event = await events.get()
+                    if event is None:
+                        raise PulseDisconnected()
+                    facility = str(event.facility)
+                    if facility not in PulseCache.FACILITIES:
+                        continue
+
+                    event_type = str(event.t)
+                    obj = None
+                    if event_type != PulseCache.EVENT_REMOVE:
+                        try:
+                            obj = await getattr(conn, "%s_info" % facility)(event.index)
+                        except PulseIndexError:
+                            event_type = PulseCache.EVENT_REMOVE
+                    cache.apply(facility, event_type, event.index, obj)
+                    self.run_in_background(cache.notify_listeners, self.pulse.pulse_conn, facility, event_type, obj)
+            finally:
+                pump_task.cancel()
+
+    async def _serve_control(self, bus):
+        """
+        Export the control interface on the session bus. Commands run one at
+        a time on the routing worker, in the order they came in, and
+        connection commands on the connection worker.
+        :param bus: dbus_next session MessageBus.
+        :return: None
+        """
+        from dbus_next import DBusError, RequestNameReply, NameFlag
+        from dbus_next.service import ServiceInterface, method
+
+        engine = self
+        maxime = self.maxime
+        pulse = self.pulse
+
+        class ControlInterface(ServiceInterface):
+            @method()
+            async def Status(self) -> 's':
+                return await engine.run_command(maxime.status, pulse)
+
+            @method()
+            async def Route(self, destination: 's'):
+                if destination.lower() not in Maxime.ROUTES:
+                    raise DBusError(ControlService.ERROR_INVALID_ARGS,
+                                    "Routing destination must be speakers|wireless|headset")
+                await engine.run_command(maxime.route, pulse, destination)
+
+            @method()
+            async def Toggle(self) -> 's':
+                return await engine.run_command(maxime.toggle, pulse)
+
+            @method()
+            async def Connect(self) -> 's':
+                return await engine.run_connection(maxime.connect)
+
+            @method()
+            async def Disconnect(self) -> 's':
+                return await engine.run_connection(maxime.disconnect)
+
+            @method()
+            async def Resync(self):
+                await engine.run_command(maxime.resync, pulse)
+
+            @method()
+            async def Reconnect(self) -> 's':
+                return await engine.run_connection(maxime.reconnect)
+
+            @method()
+            async def Stats(self) -> 's':
+                return Metrics.shared().format_summary()
+
+        bus.export(ControlService.OBJECT_PATH, ControlInterface(ControlService.INTERFACE))
+        reply = await bus.request_name(ControlService.BUS_NAME, NameFlag.DO_NOT_QUEUE)
+        if reply != RequestNameReply.PRIMARY_OWNER:
+            self.maxime.exit_err("Another daemon is already running.")
+        logging.debug("Exported control interface as %s", ControlService.BUS_NAME)
+
+
+class DeviceNotFoundError(Exception):
+    """This exception is raised, when a Pulse device we need does not exist."""
+    pass
+
+
+class ControlService:
+    """
+    Session bus interface of a running daemon. One-shot modes forward to it
+    so that they are served from the daemon's warm connections and caches.
+    Commands run on the routing worker, in order with connection changes, so
+    they cannot race each other and the main loop stays free meanwhile.
+    """
+    BUS_NAME = "com.grantcohoe.Maxime"
+    OBJECT_PATH = "/com/grantcohoe/Maxime"
+    INTERFACE = "com.grantcohoe.Maxime1"
+    ERROR_INVALID_ARGS = "org.freedesktop.DBus.Error.InvalidArgs"
+
+    # Connection commands all cancel each other.
+    JOB_CONNECTION = "bluetooth"
+
+    def __init__(self, maxime, bt_device, pulse, worker, connection_worker=None):
+        """
+        Constructor. Claims our bus name, which fails if a daemon is already running.
+        :param maxime: Maxime application.
+        :param bt_device: BluetoothDevice
+        :param pulse: PulseAudio
+        :param worker: RoutingWorker to run commands on.
+        :param connection_worker: RoutingWorker to run connects and disconnects
+                                  on, so that their retries do not hold up
+                                  routing. Defaults to worker.
+        """
+        import dbus
+        import dbus.service
+
+        self.maxime = maxime
+        self.bt_device = bt_device
+        self.pulse = pulse
+        self.worker = worker
+        self.connection_worker = connection_worker if connection_worker is not None else worker
+        bus_name = dbus.service.BusName(self.BUS_NAME, bus=dbus.SessionBus(), do_not_queue=True)
+        self.dbus_object = self._get_dbus_object_class()(self, bus_name)
+        logging.debug("Exported control interface as %s", self.BUS_NAME)
+
+    def run(self, function, args, reply_handler, error_handler):
+        """
+        Run a command on the worker and reply from the main loop once it is done.
+        :param function: Callable to run.
+        :param args: Tuple of arguments to call it with.
+        :param reply_handler: dbus-python reply callback.
+        :param error_handler: dbus-python error callback.
+        :return: None
+        """
+        from gi.repository import GLib
+
+        def done(result, error):
+            if error is not None:
+                GLib.idle_add(error_handler, error)
+            elif result is None:
+                GLib.idle_add(reply_handler)
+            else:
+                GLib.idle_add(reply_handler, result)
+
+        TraceRecorder.shared().record_command(function, args)
+        self.worker.submit(function, *args, callback=done)
+
+    def run_connection(self, function, reply_handler, error_handler):
+        """
+        Run a connect, disconnect or reconnect of our device. One that is
+        still retrying, or waiting to, is cancelled.
+        :param function: Maxime method taking the BluetoothDevice.
+        :param reply_handler: dbus-python reply callback.
+        :param error_handler: dbus-python error callback.
+        :return: None
+        """
+        from gi.repository import GLib
+
+        def done(result, error):
+            if isinstance(error, JobCancelledError):
+                GLib.idle_add(reply_handler, ConnectionScheduler.OUTCOME_CANCELLED)
+            elif error is not None:
+                GLib.idle_add(error_handler, error)
+            else:
+                GLib.idle_add(reply_handler, result)
+
+        TraceRecorder.shared().record_command(function, ())
+        # The command begins now, not when the worker gets to it, so that it
+        # cancels one that is still retrying.
+        generation = self.maxime.connections.begin()
+        self.connection_worker.submit(function, self.bt_device, generation, key=self.JOB_CONNECTION,
+                                      callback=done)
+
+    @staticmethod
+    def _get_dbus_object_class():
+        """
+        Build the exported object class. This is done here rather than at
+        module level so that only the daemon has to import dbus.
+        :return: dbus.service.Object subclass.
+        """
+        import dbus
+        import dbus.service
+
+        class ControlObject(dbus.service.Object):
+            def __init__(self, service, bus_name):
+                self.service = service
+                dbus.service.Object.__init__(self, bus_name, ControlService.OBJECT_PATH)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='s',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Status(self, reply_handler, error_handler):
+                self.service.run(self.service.maxime.status, (self.service.pulse,), reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='s', out_signature='',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Route(self, destination, reply_handler, error_handler):
+                if destination.lower() not in Maxime.ROUTES:
+                    raise dbus.exceptions.DBusException("Routing destination must be speakers|wireless|headset",
+                                                        name=ControlService.ERROR_INVALID_ARGS)
+                self.service.run(self.service.maxime.route, (self.service.pulse, destination),
+                                 reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='s',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Toggle(self, reply_handler, error_handler):
+                self.service.run(self.service.maxime.toggle, (self.service.pulse,), reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='s',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Connect(self, reply_handler, error_handler):
+                self.service.run_connection(self.service.maxime.connect, reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='s',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Disconnect(self, reply_handler, error_handler):
+                self.service.run_connection(self.service.maxime.disconnect, reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Resync(self, reply_handler, error_handler):
+                self.service.run(self.service.maxime.resync, (self.service.pulse,), reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='s',
+                                 async_callbacks=('reply_handler', 'error_handler'))
+            def Reconnect(self, reply_handler, error_handler):
+                self.service.run_connection(self.service.maxime.reconnect, reply_handler, error_handler)
+
+            @dbus.service.method(ControlService.INTERFACE, in_signature='', out_signature='s')
+            def Stats(self):
+                return Metrics.shared().format_summary()
+
+        return ControlObject
+
+
+class ControlClient:
+    """
+    Shell class for calling into a running daemon.
+    """
+    # Seconds to wait for the daemon to finish a command. Connects can be slow.
+    CALL_TIMEOUT = 120
+
+    @staticmethod
+    def call(method, *args):
+        """
+        Call a method of the daemon's control interface.
+        :param method: Name of the method.
+        :param args: Arguments of the method.
+        :return: Tuple of whether a daemon handled it and what it returned.
+        """
+        import dbus
+        try:
+            bus = dbus.SessionBus()
+            if not bus.name_has_owner(ControlService.BUS_NAME):
+                logging.debug("No daemon is running.")
+                return False, None
+        except dbus.exceptions.DBusException as e:
+            logging.debug("Could not look for a daemon: %s", e)
+            return False, None
+
+        logging.debug("Forwarding %s to the daemon.", method)
+        proxy = bus.get_object(ControlService.BUS_NAME, ControlService.OBJECT_PATH)
+        result = proxy.get_dbus_method(method, ControlService.INTERFACE)(*args, timeout=ControlClient.CALL_TIMEOUT)
+        return True, result
+
+
+class PulseCache:
+    """
+    In-process copy of the Pulse objects that we route with. Objects are
+    indexed by server index, name and description so that lookups do not
+    need a list round trip to the server. Once watch() is called a separate
+    Pulse connection subscribes to change events and keeps the copy current.
+    """
+    FACILITY_SINK = "sink"
+    FACILITY_SOURCE = "source"
+    FACILITY_CARD = "card"
+    FACILITY_SINK_INPUT = "sink_input"
+    FACILITIES = (FACILITY_SINK, FACILITY_SOURCE, FACILITY_CARD, FACILITY_SINK_INPUT)
+
+    FIELD_NAME = "name"
+    FIELD_DESCRIPTION = "description"
+    FIELDS = (FIELD_NAME, FIELD_DESCRIPTION)
+
+    EVENT_NEW = "new"
+    EVENT_CHANGE = "change"
+    EVENT_REMOVE = "remove"
+
+    WATCH_CLIENT_NAME = "maxime-cache"
+    WATCH_READY_TIMEOUT = 5
+    # Seconds between attempts to reach the server. Doubles up to the max.
+    RECONNECT_DELAY = 0.05
+    RECONNECT_MAX_DELAY = 1
+
+    def __init__(self, pulse_conn):
+        """
+        Constructor
+        :param pulse_conn: Pulse connection used to load objects until we are watching.
+        """
+        self.pulse_conn = pulse_conn
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._by_index = dict((facility, {}) for facility in self.FACILITIES)
+        self._by_field = dict((facility, dict((field, {}) for field in self.FIELDS))
+                              for facility in self.FACILITIES)
+        # Substring search results, dropped whenever a facility changes.
+        self._search_memo = dict((facility, {}) for facility in self.FACILITIES)
+        self._loaded = set()
+
+        self._listeners = []
+        self._server_listeners = []
+        self._watch_thread = None
+        self._watch_ready = threading.Event()
+        self._listening = False
+        self._pending_events = []
+
+    @property
+    def watching(self):
+        """
+        Whether an event subscription is keeping this cache current.
+        :return: Boolean
+        """
+        return self._watch_ready.is_set()
+
+    def add_listener(self, callback):
+        """
+        Have a callable run for every event we apply while watching. It runs
+        on the watcher thread and gets the watcher's connection, which is the
+        only connection it may use from there.
+        :param callback: Callable taking the connection, facility, event type
+                         and the object (None if it was removed).
+        :return: None
+        """
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def watch(self):
+        """
+        Start keeping the cache current from Pulse change events. This opens a
+        second Pulse connection in a background thread, since a connection
+        that is listening for events cannot be used for anything else.
+        :return: None
+        """
+        if self._watch_thread is not None or self.watching is True:
+            return
+
+        self._watch_thread = threading.Thread(target=self._watch_loop,
+                                              name="maxime-pulse-cache",
+                                              daemon=True)
+        self._watch_thread.start()
+        if self._watch_ready.wait(self.WATCH_READY_TIMEOUT) is False:
+            logging.error("Pulse cache did not become ready within %s seconds.", self.WATCH_READY_TIMEOUT)
+
+    def _watch_loop(self):
+        """
+        Subscribe to Pulse events and apply them to the cache forever. When
+        the server goes away (a restart, or pipewire-pulse crashing) we
+        connect again as soon as it is back and reload everything.
+        :return: None
+        """
+        from pulsectl import PulseError, PulseDisconnected
+        conn = None
+        while True:
+            try:
+                if conn is None:
+                    conn = self._connect()
+                self._subscribe(conn)
+                while True:
+                    self._listen(conn)
+            except (PulseError, PulseDisconnected) as e:
+                logging.warning("Lost the Pulse server (%s). Reconnecting.", type(e).__name__)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = None
+            self._pending_events = []
+            self._notify_server_listeners(False)
+
+    def _connect(self):
+        """
+        Connect to the Pulse server, waiting for it to be there. The delay
+        between attempts doubles, but stays short so that a restarting
+        server is picked up right away.
+        :return: pulsectl.Pulse
+        """
+        from pulsectl import PulseError
+        delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                return PulseAudio.open_connection(self.WATCH_CLIENT_NAME)
+            except PulseError as e:
+                logging.debug("No Pulse server yet (%s). Trying again in %s seconds.", e, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+    def _subscribe(self, conn):
+        """
+        Subscribe to events and load everything. Loading happens after
+        subscribing so that nothing that changes in between is missed. Those
+        events get replayed on top of the load.
+        :param conn: Pulse connection of the watcher.
+        :return: None
+        """
+        conn.event_mask_set(*self.FACILITIES)
+        conn.event_callback_set(self._queue_event)
+        for facility in self.FACILITIES:
+            self._load(conn, facility)
+        if self.watching is True:
+            # We have been here before, so the server came back.
+            self._notify_server_listeners(True)
+        self._watch_ready.set()
+        logging.debug("Pulse cache is watching for events.")
+
+    def _listen(self, conn):
+        """
+        Wait for events and apply them.
+        :param conn: Pulse connection of the watcher.
+        :return: None
+        """
+        if not self._pending_events:
+            self._listening = True
+            try:
+                conn.event_listen()
+            finally:
+                self._listening = False
+
+        events, self._pending_events = self._pending_events, []
+        for event in events:
+            self._apply_event(conn, event)
+
+    def add_server_listener(self, callback):
+        """
+        Have a callable run when we lose the Pulse server, and when it is back
+        and the cache has been reloaded. It runs on the watcher thread.
+        :param callback: Callable taking a Boolean of whether the server is there.
+        :return: None
+        """
+        if callback not in self._server_listeners:
+            self._server_listeners.append(callback)
+
+    def _notify_server_listeners(self, available):
+        """
+        Run the server listeners.
+        :param available: Boolean of whether the server is there.
+        :return: None
+        """
+        for listener in self._server_listeners:
+            try:
+                listener(available)
+            except Exception as e:
+                logging.error("Pulse server listener failed: %s", e)
+
+    def _queue_event(self, event):
+        """
+        Pulse event callback. Pulse does not allow calls from inside of the
+        callback, so stash the event and stop listening if we are.
+        :param event: pulsectl PulseEventInfo
+        :return: None
+        """
+        from pulsectl import PulseLoopStop
+        self._pending_events.append(event)
+        # Stopping the loop while an info call is waiting on the same
+        # connection would abort that call, so only stop a listen.
+        if self._listening is True:
+            raise PulseLoopStop
+
+    def _apply_event(self, conn, event):
+        """
+        Update the cache for one Pulse event.
+        :param conn: Pulse connection to fetch changed objects with.
+        :param event: pulsectl PulseEventInfo
+        :return: None
+        """
+        from pulsectl import PulseIndexError
+        facility = str(event.facility)
+        if facility not in self.FACILITIES:
+            return
+
+        event_type = str(event.t)
+        obj = None
+        if event_type != self.EVENT_REMOVE:
+            try:
+                obj = getattr(conn, "%s_info" % facility)(event.index)
+            except PulseIndexError:
+                # It went away before we could ask about it.
+                self.apply(facility, self.EVENT_REMOVE, event.index, None)
+                return
+
+        self.apply(facility, event_type, event.index, obj)
+        self.notify_listeners(conn, facility, event_type, obj)
+
+    def apply(self, facility, event_type, index, obj):
+        """
+        Update the cache for one Pulse event whose object has been fetched.
+        :param facility: One of the FACILITY_* constants.
+        :param event_type: One of the EVENT_* constants.
+        :param index: Pulse index of the object.
+        :param obj: pulsectl info object, or None if it was removed.
+        :return: None
+        """
+        logging.debug("Pulse event: %s %s #%s", event_type, facility, index)
+        TraceRecorder.shared().record_pulse(facility, event_type, index, obj)
+        if event_type == self.EVENT_REMOVE or obj is None:
+            self._drop(facility, index)
+        else:
+            self._store(facility, obj)
+
+    def notify_listeners(self, conn, facility, event_type, obj):
+        """
+        Run the listeners for an applied event.
+        :param conn: Pulse connection that the listeners may use.
+        :return: None
+        """
+        for listener in self._listeners:
+            try:
+                listener(conn, facility, event_type, obj)
             except Exception as e:
-                if "not found" in e.message:
-                    if first_run is True:
-                        DBusHelper.send_notification("Routing to %s..." % device_name, DBusHelper.ICON_WIRELESS)
-                        first_run = False
-                    logging.debug("Sleeping for 1 second so that Pulse can sort itself out.")
-                    time.sleep(1)
+                logging.error("Pulse event listener failed on %s %s: %s", event_type, facility, e)
+
+    def set_watching(self):
+        """
+        Declare that something else is feeding us events through apply().
+        :return: None
+        """
+        self._watch_ready.set()
+
+    def _load(self, conn, facility):
+        """
+        Replace everything we know about a facility with a fresh list.
+        :param conn: Pulse connection to list with.
+        :param facility: One of the FACILITY_* constants.
+        :return: None
+        """
+        self.replace(facility, getattr(conn, "%s_list" % facility)())
+
+    def replace(self, facility, objects):
+        """
+        Replace everything we know about a facility.
+        :param facility: One of the FACILITY_* constants.
+        :param objects: Every object of the facility.
+        :return: None
+        """
+        TraceRecorder.shared().record_pulse_objects(facility, objects)
+        with self._lock:
+            self._by_index[facility].clear()
+            for field in self.FIELDS:
+                self._by_field[facility][field].clear()
+            for obj in objects:
+                self._store(facility, obj)
+            self._loaded.add(facility)
+
+    def _ensure_loaded(self, facility, reload=False):
+        """
+        Make sure a facility has been listed at least once. Without an event
+        subscription nothing else keeps it current, so callers that missed
+        can ask for a reload.
+        :param facility: One of the FACILITY_* constants.
+        :param reload: Force a new list even if we have one.
+        :return: None
+        """
+        if self.watching is True:
+            return
+        if reload is True or facility not in self._loaded:
+            self._load(self.pulse_conn, facility)
+
+    def _store(self, facility, obj):
+        """
+        Add or replace an object in every index.
+        :param facility: One of the FACILITY_* constants.
+        :param obj: pulsectl info object.
+        :return: None
+        """
+        with self._lock:
+            self._drop(facility, obj.index)
+            self._by_index[facility][obj.index] = obj
+            for field in self.FIELDS:
+                value = getattr(obj, field, None)
+                if value is not None:
+                    self._by_field[facility][field].setdefault(value, obj)
+            self._search_memo[facility].clear()
+            self._changed.notify_all()
+
+    def _drop(self, facility, index):
+        """
+        Remove an object from every index.
+        :param facility: One of the FACILITY_* constants.
+        :param index: Pulse index of the object.
+        :return: None
+        """
+        with self._lock:
+            obj = self._by_index[facility].pop(index, None)
+            if obj is None:
+                return
+            for field in self.FIELDS:
+                value = getattr(obj, field, None)
+                if self._by_field[facility][field].get(value) is obj:
+                    del self._by_field[facility][field][value]
+                    # Another object might share the value. Let it take over.
+                    for other in self._by_index[facility].values():
+                        if getattr(other, field, None) == value:
+                            self._by_field[facility][field][value] = other
+                            break
+            self._search_memo[facility].clear()
+            self._changed.notify_all()
+
+    def get(self, facility, index):
+        """
+        Return an object by its Pulse index.
+        :param facility: One of the FACILITY_* constants.
+        :param index: Pulse index of the object.
+        :return: pulsectl info object or None.
+        """
+        self._ensure_loaded(facility)
+        with self._lock:
+            return self._by_index[facility].get(index)
+
+    def objects(self, facility):
+        """
+        Return every object of a facility in index order.
+        :param facility: One of the FACILITY_* constants.
+        :return: List of pulsectl info objects.
+        """
+        self._ensure_loaded(facility)
+        with self._lock:
+            return [self._by_index[facility][i] for i in sorted(self._by_index[facility])]
+
+    def lookup(self, facility, field, value):
+        """
+        Return the object whose field is exactly the given value.
+        :param facility: One of the FACILITY_* constants.
+        :param field: One of the FIELD_* constants.
+        :param value: Value to match.
+        :return: pulsectl info object or None.
+        """
+        obj = self._lookup(facility, field, value)
+        if obj is None and self.watching is False:
+            self._ensure_loaded(facility, reload=True)
+            obj = self._lookup(facility, field, value)
+        return obj
+
+    def _lookup(self, facility, field, value):
+        self._ensure_loaded(facility)
+        with self._lock:
+            return self._by_field[facility][field].get(value)
+
+    def search(self, facility, field, fragment):
+        """
+        Return the first object (by index) whose field contains the fragment.
+        Exact matches win, and results are remembered until the facility
+        changes, so repeated searches do not scan.
+        :param facility: One of the FACILITY_* constants.
+        :param field: One of the FIELD_* constants.
+        :param fragment: Substring to look for.
+        :return: pulsectl info object or None.
+        """
+        obj = self._search(facility, field, fragment)
+        if obj is None and self.watching is False:
+            self._ensure_loaded(facility, reload=True)
+            obj = self._search(facility, field, fragment)
+        return obj
+
+    def _search(self, facility, field, fragment):
+        self._ensure_loaded(facility)
+        with self._lock:
+            memo = self._search_memo[facility]
+            key = (field, fragment)
+            if key in memo:
+                return self._by_index[facility].get(memo[key])
+
+            obj = self._by_field[facility][field].get(fragment)
+            if obj is None:
+                for index in sorted(self._by_index[facility]):
+                    candidate = self._by_index[facility][index]
+                    if fragment in (getattr(candidate, field, None) or ""):
+                        obj = candidate
+                        break
+
+            # Misses are not remembered, the object may be about to show up.
+            if obj is not None:
+                memo[key] = obj.index
+            return obj
+
+    def wake(self):
+        """
+        Make anyone in wait_for re-check, even though nothing changed.
+        :return: None
+        """
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait_for(self, predicate, timeout, cancelled=None):
+        """
+        Block until predicate returns something truthy, re-checking it every
+        time the cache changes. Only useful while watching.
+        :param predicate: Callable taking no arguments.
+        :param timeout: Seconds to wait before giving up.
+        :param cancelled: Callable saying whether to stop waiting. Checked on wake().
+        :return: Whatever predicate returned, or None if we ran out of time.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                if cancelled is not None and cancelled():
+                    return None
+                result = predicate()
+                if result:
+                    return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+
+class PulseAudio:
+    """
+    PulseAudio connection
+    """
+    BT_CARD_PREFIX = "bluez_card"
+    BT_PROFILE_A2DP = "a2dp_sink"
+    BT_PROFILE_HSP = "headset_head_unit"
+    BT_PROFILE_OFF = "off"
+    SINK_STATE_SUSPENDED = "suspended"
+
+    # Ways to resync, set with resync_strategy in [bluetooth].
+    RESYNC_HSP_BOUNCE = "hsp"
+    RESYNC_A2DP_OFF = "off"
+    RESYNC_SUSPEND = "suspend"
+    RESYNC_STRATEGIES = (RESYNC_HSP_BOUNCE, RESYNC_A2DP_OFF, RESYNC_SUSPEND)
+    DEFAULT_RESYNC_TIMEOUT = 5
+    # RoutingWorker key of automatic resyncs, so they do not pile up.
+    JOB_RESYNC = "resync"
+    # RoutingWorker key of recovering from a Pulse server restart.
+    JOB_RECOVER = "recover"
+
+    # Seconds that pactl gets to set a latency offset.
+    PACTL_TIMEOUT = 5
+
+    def __init__(self, config, bt_device, sp_device, hs_device):
+        """
+        Constructor for PulseAudio connection.
+        :param config: 
+        """
+        self.config = config
+        self.pulse_conn = self.open_connection('maxime-manage_connection')
+        self.cache = PulseCache(self.pulse_conn)
+        self.stream_rules = StreamRules(config)
+        # Name of the sink we last routed to. New streams follow it.
+        self.target_sink_name = None
+        self._target_lock = threading.Lock()
+        self.state = RouteState()
+        self.bt_device = bt_device
+        self.hs_device = hs_device
+        self.sp_device = sp_device
+        self.resync_strategy = config.get('bluetooth', 'resync_strategy', fallback=self.RESYNC_HSP_BOUNCE)
+        self.resync_timeout = config.getfloat('bluetooth', 'resync_timeout', fallback=self.DEFAULT_RESYNC_TIMEOUT)
+        # Callable that queues work for the thread that uses pulse_conn. The
+        # daemon sets it. Without one, work runs on whatever thread asks.
+        self.schedule = None
+        # When we lost the Pulse server and which route we had then.
+        self._lost_at = None
+        self._lost_route = None
+
+    def activate_wireless(self, conn_event=True, superseded=None, bt_device=None, sink=None):
+        """
+        Activate the wireless device. If it's a (dis)connect event,
+        also mute the speakers so we don't blast audio.
+        :param conn_event:
+        :param superseded: Callable saying whether this work is no longer wanted.
+        :param bt_device: BluetoothDevice to switch to. It stays our wireless
+                          device for later routes.
+        :param sink: Sink of the wireless device, if the caller already has it.
+        :return:
+        """
+        logging.debug("Activating wireless.")
+        if bt_device is not None:
+            self.bt_device = bt_device
+
+        device_name = self.bt_device.output_device
+
+        # Pulse registers the sink a little while after the device connects.
+        target_device = sink
+        if target_device is None:
+            with Metrics.shared().span("lookup_sink"):
+                target_device = self.cache.search(PulseCache.FACILITY_SINK, PulseCache.FIELD_DESCRIPTION,
+                                                  device_name)
+        if target_device is None:
+            DBusHelper.send_notification("Routing to %s..." % device_name, DBusHelper.ICON_WIRELESS,
+                                         tag=DBusHelper.TAG_ROUTE)
+            try:
+                with Metrics.shared().span("wait_for_sink"):
+                    target_device = self._wait_for_sink_output_device(device_name, self.bt_device.sink_timeout,
+                                                                      superseded)
+            except DeviceNotFoundError:
                 logging.error("Unable to find wireless device.")
+                DBusHelper.send_notification("Could not find %s." % device_name, DBusHelper.ICON_WIRELESS,
+                                             tag=DBusHelper.TAG_ROUTE)
+                return
+            if target_device is None:
+                logging.info("Stopped waiting for \"%s\", a newer event took over.", device_name)
+                return
 
-        logging.debug("Target device is \"%s\"" % target_device.description)
+        logging.debug("Target device is \"%s\"", target_device.description)
+        # Before any stream moves there, so A/V sync is right from the start.
+        problem = None
+        if not self._apply_latency_offset(target_device):
+            problem = "could not set its latency offset"
 
         # This event check is used to make sure the headphones being
         # (un)intentionally disconnected don't suddenly blast loud noises
         # out of the speakers.
+        streams = self._set_target(target_device)
         if conn_event is True:
             logging.debug("This is a connection event. Unmuting wireless.")
-            self._unmute(self.ladspa_device)
-        self._move_output(self.ladspa_device, target_device, DBusHelper.ICON_WIRELESS)
+            self._unmute(streams)
+        self._move_output(streams, target_device, DBusHelper.ICON_WIRELESS, problem)
 
     def resync_wireless(self):
         """
-        Resync a wireless stream.
+        Resync a wireless stream. Each step waits for Pulse to report that it
+        happened instead of sleeping, so this takes as long as Pulse does and
+        no longer than resync_timeout.
         :return: 
         """
-        # This uses a card identifer rather than a device. No idea if that matters.
-        card_dev = self._lookup_card(self.BT_CARD_PREFIX)
+        strategy = self.resync_strategy
+        if strategy not in self.RESYNC_STRATEGIES:
+            logging.error("Unknown resync strategy \"%s\", using \"%s\".", strategy, self.RESYNC_HSP_BOUNCE)
+            strategy = self.RESYNC_HSP_BOUNCE
+
+        # Pulse names the card after the device, so we resync the right one.
+        self.watch()
+        with Metrics.shared().span("lookup_card"):
+            card_dev = self._lookup_card("%s.%s" % (self.BT_CARD_PREFIX, self.bt_device.mac.replace(':', '_')))
 
         # There is no direct way to resync a stream to the wireless
         # device, but the folks on this here forum have found a
         # way to make it sorta work.
         # https://askubuntu.com/questions/145935/get-rid-of-0-5s-latency-when-playing-audio-over-bluetooth-with-a2dp
-        logging.debug("Setting profile of \"%s\" to \"%s\"" % (card_dev.name, self.BT_PROFILE_HSP))
-        DBusHelper.send_notification("Resyncing Bluetooth audio stream.", icon=DBusHelper.ICON_GENERIC)
-        self.pulse_conn.card_profile_set(card_dev, self.BT_PROFILE_HSP)
-        # We need to let Pulse catch its breath.
-        time.sleep(1)
-        logging.debug("Setting profile of \"%s\" to \"%s\"" % (card_dev.name, self.BT_PROFILE_A2DP))
-        self.pulse_conn.card_profile_set(card_dev, self.BT_PROFILE_A2DP)
+        DBusHelper.send_notification("Resyncing Bluetooth audio stream.", icon=DBusHelper.ICON_GENERIC,
+                                     tag=DBusHelper.TAG_ROUTE)
+        started = time.monotonic()
+        deadline = started + self.resync_timeout
+        try:
+            with Metrics.shared().span("resync_%s" % strategy):
+                if strategy == self.RESYNC_SUSPEND:
+                    sink = self._bounce_suspend(card_dev, deadline)
+                else:
+                    away = self.BT_PROFILE_HSP if strategy == self.RESYNC_HSP_BOUNCE else self.BT_PROFILE_OFF
+                    self._switch_card_profile(card_dev, away, deadline)
+                    sink = self._switch_card_profile(card_dev, self.BT_PROFILE_A2DP, deadline)
+        except DeviceNotFoundError as e:
+            logging.error("Resync with \"%s\" failed after %.3f seconds: %s",
+                          strategy, time.monotonic() - started, e)
+            DBusHelper.send_notification("Could not resync %s." % self.bt_device.output_device,
+                                         icon=DBusHelper.ICON_GENERIC, tag=DBusHelper.TAG_ROUTE)
+            return
+        logging.info("Resync with \"%s\" took %.3f seconds.", strategy, time.monotonic() - started)
+        self.state.update(last_resync=time.time(), last_resync_strategy=strategy,
+                          last_resync_seconds=time.monotonic() - started)
 
         # Switching profiles makes the sinks change, so we need to reroute.
         # @TODO might need to switch conn_even to true if there are mute issues
-        self.activate_wireless(conn_event=False)
+        self.activate_wireless(conn_event=False, sink=sink)
+
+    def _apply_latency_offset(self, sink):
+        """
+        Set the configured latency offset of the wireless device's current
+        card profile on the card port that its sink plays through. It is
+        compared with the offset Pulse reports for that port, so it is set
+        again after a profile switch, a new card, or a change in pavucontrol.
+        :param sink: Sink of the wireless device.
+        :return: False if the port should have an offset and we could not
+                 set it, True otherwise.
+        """
+        card = self.cache.get(PulseCache.FACILITY_CARD, getattr(sink, 'card', None))
+        if card is None or card.profile_active is None:
+            return True
+        profile = card.profile_active.name
+        offset = self.bt_device.get_latency_offset(profile)
+        if offset is None:
+            return True
+        sink_port = getattr(sink, 'port_active', None)
+        port = None
+        if sink_port is not None:
+            port = next((port for port in card.port_list if port.name == sink_port.name), None)
+        if port is None:
+            logging.error("Could not set latency offset of \"%s\": it has no active port.", sink.description)
+            return False
+        # Pulse keeps port offsets in microseconds.
+        usec = int(offset * 1000)
+        if port.latency_offset == usec:
+            return True
+
+        logging.info("Setting latency offset of \"%s\" (%s) to %s ms", sink.description, profile, offset)
+        try:
+            with Metrics.shared().span("latency_offset"):
+                self.set_port_latency_offset(card.name, port.name, usec)
+        except Exception as e:
+            logging.error("Could not set latency offset of \"%s\": %s", sink.description, e)
+            return False
+        return True
+
+    def _card_sinks(self, card):
+        """
+        Return the sinks that belong to a card.
+        :param card: Pulse card.
+        :return: List of sinks.
+        """
+        return [sink for sink in self.cache.objects(PulseCache.FACILITY_SINK)
+                if getattr(sink, 'card', None) == card.index]
+
+    def _switch_card_profile(self, card, profile, deadline):
+        """
+        Set the profile of a card and wait until Pulse has switched it and,
+        unless it is off, made a new sink for it.
+        :param card: Pulse card.
+        :param profile: Name of the profile.
+        :param deadline: time.monotonic() by which it has to be done.
+        :return: The new sink, or the card for the off profile.
+        """
+        old_sinks = set(sink.index for sink in self._card_sinks(card))
+
+        def switched():
+            current = self.cache.get(PulseCache.FACILITY_CARD, card.index)
+            if current is None or current.profile_active is None or current.profile_active.name != profile:
+                return None
+            if profile == self.BT_PROFILE_OFF:
+                return current
+            new_sinks = [sink for sink in self._card_sinks(card) if sink.index not in old_sinks]
+            return new_sinks[0] if new_sinks else None
+
+        logging.debug("Setting profile of \"%s\" to \"%s\"", card.name, profile)
+        started = time.monotonic()
+        with Metrics.shared().span("card_profile_set"):
+            self.pulse_conn.card_profile_set(card, profile)
+        result = self.cache.wait_for(switched, deadline - time.monotonic())
+        if result is None:
+            raise DeviceNotFoundError("\"%s\" did not switch to \"%s\" in time." % (card.name, profile))
+        logging.debug("\"%s\" switched to \"%s\" after %.3f seconds.",
+                      card.name, profile, time.monotonic() - started)
+        return result
+
+    def _bounce_suspend(self, card, deadline):
+        """
+        Suspend the card's sink, which closes the Bluetooth transport, and
+        resume it, waiting for Pulse to report each.
+        :param card: Pulse card.
+        :param deadline: time.monotonic() by which it has to be done.
+        :return: The sink.
+        """
+        sinks = self._card_sinks(card)
+        if not sinks:
+            raise DeviceNotFoundError("\"%s\" has no sink to suspend." % card.name)
+        index = sinks[0].index
+
+        def in_state(suspended):
+            sink = self.cache.get(PulseCache.FACILITY_SINK, index)
+            if sink is not None and (str(sink.state) == self.SINK_STATE_SUSPENDED) is suspended:
+                return sink
+            return None
+
+        for suspended in (True, False):
+            logging.debug("%s \"%s\"", "Suspending" if suspended else "Resuming", sinks[0].name)
+            self.pulse_conn.sink_suspend(index, suspended)
+            sink = self.cache.wait_for(lambda: in_state(suspended), deadline - time.monotonic())
+            if sink is None:
+                raise DeviceNotFoundError("\"%s\" was not %s in time."
+                                          % (sinks[0].name, "suspended" if suspended else "resumed"))
+        return sink
 
     def activate_headset(self, conn_event=True):
         """
@@ -726,29 +4205,246 @@ class PulseAudio:
         out_device_name = self.hs_device.output_device
         in_device_name = self.hs_device.input_device
         try:
-            target_output_device = self._lookup_sink_output_device(out_device_name)
-            target_input_device = self._lookup_source_device(in_device_name)
+            with Metrics.shared().span("lookup_sink"):
+                target_output_device = self._lookup_sink_output_device(out_device_name)
+                target_input_device = self._lookup_source_device(in_device_name)
         except:
             return
 
-        logging.debug("Target output device is \"%s\"" % target_output_device.description)
-        self._move_output(self.ladspa_device, target_output_device, DBusHelper.ICON_HEADSET)
+        logging.debug("Target output device is \"%s\"", target_output_device.description)
+        streams = self._set_target(target_output_device)
+        self._move_output(streams, target_output_device, DBusHelper.ICON_HEADSET)
         self._set_input(target_input_device)
 
     def activate_speakers(self, conn_event=True):
         logging.debug("Activating speakers.")
 
         device_name = self.sp_device.output_device
-        target_device = self._lookup_sink_output_device(device_name)
-        logging.debug("Target device is \"%s\"" % target_device.description)
+        with Metrics.shared().span("lookup_sink"):
+            target_device = self._lookup_sink_output_device(device_name)
+        logging.debug("Target device is \"%s\"", target_device.description)
 
         # This event check is used to make sure the headphones being
         # (un)intentionally disconnected don't suddenly blast loud noises
         # out of the speakers.
+        streams = self._set_target(target_device)
         if conn_event is True:
             logging.debug("This is a connection event. Muting speakers.")
-            self._mute(self.ladspa_device)
-        self._move_output(self.ladspa_device, target_device, DBusHelper.ICON_SPEAKERS)
+            self._mute(streams)
+        self._move_output(streams, target_device, DBusHelper.ICON_SPEAKERS)
+
+    @staticmethod
+    def open_connection(client_name):
+        """
+        Open a connection to the Pulse server.
+        :param client_name: Name we show up as in Pulse.
+        :return: pulsectl.Pulse
+        """
+        from pulsectl import Pulse as PulseLib
+        return PulseLib(client_name)
+
+    @staticmethod
+    def set_port_latency_offset(card_name, port_name, offset):
+        """
+        Set the latency offset of a card port. pulsectl has no call for
+        this, so it goes through pactl.
+        :param card_name: Name of the card.
+        :param port_name: Name of the port on the card.
+        :param offset: Offset in microseconds.
+        :return: None
+        """
+        import subprocess
+        try:
+            subprocess.run(['pactl', 'set-port-latency-offset', card_name, port_name, str(offset)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                           timeout=PulseAudio.PACTL_TIMEOUT, check=True)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(e.stderr.strip() or str(e))
+
+    def watch(self):
+        """
+        Keep our device cache current from Pulse events rather than listing
+        devices on every lookup. Meant for long running modes. While watching,
+        new streams that match our rules are moved to the current target.
+        :return: None
+        """
+        self.cache.add_listener(self._follow_new_stream)
+        self.cache.add_listener(self._track_output)
+        self.cache.add_server_listener(self.server_changed)
+        self.cache.watch()
+
+    def server_changed(self, available):
+        """
+        Take note of the Pulse server going away or coming back. What we
+        were routing to is remembered before any of our streams show up
+        again somewhere else, and restored once the server is back.
+        :param available: Boolean of whether the server is there.
+        :return: None
+        """
+        if available is False:
+            if self._lost_at is None:
+                self._lost_at = time.monotonic()
+                self._lost_route = self.state.get('route')
+            return
+
+        if self.schedule is not None:
+            self.schedule(self.recover)
+        else:
+            self.recover()
+
+    def recover(self):
+        """
+        Pick up after a Pulse server restart: connect again and send our
+        streams back to where they were going.
+        :return: None
+        """
+        with Metrics.shared().span("pulse_recovery"):
+            try:
+                self.pulse_conn.close()
+            except Exception:
+                pass
+            self.pulse_conn = self.open_connection('maxime-manage_connection')
+            self.cache.pulse_conn = self.pulse_conn
+
+            route = self._lost_route
+            if route == Maxime.ROUTE_WIRELESS:
+                self.activate_wireless(conn_event=False)
+            elif route == Maxime.ROUTE_HEADSET:
+                self.activate_headset(conn_event=False)
+            elif route == Maxime.ROUTE_SPEAKERS:
+                self.activate_speakers(conn_event=False)
+
+        if self._lost_at is not None:
+            logging.info("Recovered from losing the Pulse server in %.3f seconds (route: %s).",
+                         time.monotonic() - self._lost_at, route)
+        self._lost_at = None
+        self._lost_route = None
+
+    def publish_state(self, path):
+        """
+        Find out where our streams are going and start publishing the route
+        state for one-shot modes to read.
+        :param path: Path of the state file.
+        :return: None
+        """
+        streams = self._get_streams()
+        if streams:
+            sink = self.cache.get(PulseCache.FACILITY_SINK, streams[0].sink)
+            if sink is not None:
+                self._record_route(sink, streams)
+        self.state.publish(path)
+
+    def _route_of(self, sink):
+        """
+        Return which of our routes a sink belongs to.
+        :param sink: Pulse sink.
+        :return: One of Maxime.ROUTES, or None if it is none of ours.
+        """
+        for route, device in ((Maxime.ROUTE_WIRELESS, self.bt_device), (Maxime.ROUTE_SPEAKERS, self.sp_device),
+                              (Maxime.ROUTE_HEADSET, self.hs_device)):
+            if device.output_device in sink.description:
+                return route
+        return None
+
+    def _record_route(self, sink, streams):
+        """
+        Remember where our streams are going.
+        :param sink: Pulse sink they go to.
+        :param streams: Sink inputs that go there.
+        :return: None
+        """
+        self.state.update(output=sink.description, sink=sink.name, route=self._route_of(sink),
+                          streams=[stream.index for stream in streams], routed_at=time.time())
+
+    def _track_output(self, conn, facility, event_type, stream):
+        """
+        Cache listener that keeps the route state right when our streams
+        come, go, or are moved by something other than us.
+        :param conn: Pulse connection that is safe to use here.
+        :param facility: One of the PulseCache.FACILITY_* constants.
+        :param event_type: One of the PulseCache.EVENT_* constants.
+        :param stream: The sink input, or None if it was removed.
+        :return: None
+        """
+        if facility != PulseCache.FACILITY_SINK_INPUT:
+            return
+        if stream is not None and not self.stream_rules.matches(stream):
+            return
+
+        streams = [s for s in self.cache.objects(PulseCache.FACILITY_SINK_INPUT) if self.stream_rules.matches(s)]
+        if stream is not None:
+            sink = self.cache.get(PulseCache.FACILITY_SINK, stream.sink)
+        else:
+            # A removed stream tells us nothing about where the others go, so
+            # keep the sink we had, or take it from a stream that is left.
+            sink = None
+            if self.state.get('sink') is not None:
+                sink = self.cache.lookup(PulseCache.FACILITY_SINK, PulseCache.FIELD_NAME, self.state.get('sink'))
+            if sink is None and streams:
+                sink = self.cache.get(PulseCache.FACILITY_SINK, streams[0].sink)
+            if sink is None:
+                if [s.index for s in streams] != self.state.get('streams'):
+                    self.state.update(streams=[s.index for s in streams])
+                return
+        if sink is None:
+            return
+        if sink.name != self.state.get('sink') or [s.index for s in streams] != self.state.get('streams'):
+            self._record_route(sink, streams)
+
+    def _get_streams(self):
+        """
+        Return every sink input that our stream rules say we should route.
+        :return: List of sink inputs.
+        """
+        streams = [stream for stream in self.cache.objects(PulseCache.FACILITY_SINK_INPUT)
+                   if self.stream_rules.matches(stream)]
+        if not streams:
+            logging.error("No streams to route! (Was searching for %s)", self.stream_rules)
+        return streams
+
+    def _set_target(self, destination):
+        """
+        Make a sink the target for our streams. This happens before we look
+        for the streams to move, so that one appearing in between is moved
+        either by us or by _follow_new_stream.
+        :param destination: Sink that streams should go to.
+        :return: List of sink inputs to move.
+        """
+        with self._target_lock:
+            self.target_sink_name = destination.name
+        with Metrics.shared().span("list_streams"):
+            streams = self._get_streams()
+        self._record_route(destination, streams)
+        return streams
+
+    def _follow_new_stream(self, conn, facility, event_type, stream):
+        """
+        Cache listener that moves a new stream matching our rules to the
+        current target. This runs on the cache's thread, so it uses the
+        cache's connection rather than ours.
+        :param conn: Pulse connection that is safe to use here.
+        :param facility: One of the PulseCache.FACILITY_* constants.
+        :param event_type: One of the PulseCache.EVENT_* constants.
+        :param stream: The sink input, or None if it was removed.
+        :return: None
+        """
+        if facility != PulseCache.FACILITY_SINK_INPUT or event_type != PulseCache.EVENT_NEW:
+            return
+        if not self.stream_rules.matches(stream):
+            return
+
+        with self._target_lock:
+            target_sink_name = self.target_sink_name
+        if target_sink_name is None:
+            return
+        target = self.cache.lookup(PulseCache.FACILITY_SINK, PulseCache.FIELD_NAME, target_sink_name)
+        if target is None or stream.sink == target.index:
+            return
+
+        logging.info("Moving new stream \"%s\" to \"%s\"", stream.name, target.description)
+        conn.sink_input_move(stream.index, target.index)
+        TraceRecorder.shared().record(TraceRecorder.KIND_ROUTE, target.name, target.description, [stream.name],
+                                      TraceRecorder.REASON_FOLLOW)
 
     def _lookup_sink_input_device(self, name):
         """
@@ -757,11 +4453,11 @@ class PulseAudio:
         :param name: 
         :return: 
         """
-        for device in self.pulse_conn.sink_input_list():
-            if device.name == name:
-                return device
+        device = self.cache.lookup(PulseCache.FACILITY_SINK_INPUT, PulseCache.FIELD_NAME, name)
+        if device is not None:
+            return device
 
-        logging.error("Sink Input device not found! (Was searching for \"%s\")" % name)
+        logging.error("Sink Input device not found! (Was searching for \"%s\")", name)
 
     def _lookup_sink_output_device(self, description):
         """
@@ -771,12 +4467,38 @@ class PulseAudio:
         :param description: 
         :return: 
         """
-        for device in self.pulse_conn.sink_list():
-            if description in device.description:
-                return device
+        device = self.cache.search(PulseCache.FACILITY_SINK, PulseCache.FIELD_DESCRIPTION, description)
+        if device is not None:
+            return device
+
+        logging.error("Sink Input device not found! (Was searching for \"%s\")", description)
+        raise DeviceNotFoundError("Sink Input device not found! (Was searching for \"%s\")" % description)
+
+    def _wait_for_sink_output_device(self, description, timeout, superseded=None):
+        """
+        Wait for a Pulse Sink device to show up. This wakes up on Pulse sink
+        events instead of polling, so we return as soon as it registers.
+        :param description: The string to search for in the sink description.
+        :param timeout: Seconds to wait before giving up.
+        :param superseded: Callable saying whether we should stop waiting.
+        :return: The sink device, or None if we were superseded.
+        """
+        logging.debug("Waiting up to %s seconds for \"%s\" to show up.", timeout, description)
+        self.watch()
+
+        started = time.monotonic()
+        device = self.cache.wait_for(lambda: self.cache.search(PulseCache.FACILITY_SINK,
+                                                               PulseCache.FIELD_DESCRIPTION,
+                                                               description),
+                                     timeout, superseded)
+        if superseded is not None and superseded():
+            return None
+        if device is None:
+            raise DeviceNotFoundError("Sink device did not show up within %s seconds! (Was waiting for \"%s\")"
+                                      % (timeout, description))
 
-        logging.error("Sink Input device not found! (Was searching for \"%s\")" % description)
-        raise Exception("Sink Input device not found! (Was searching for \"%s\")" % description)
+        logging.debug("Sink \"%s\" showed up after %.3f seconds.", description, time.monotonic() - started)
+        return device
 
     def _lookup_source_device(self, description):
         """
@@ -786,12 +4508,12 @@ class PulseAudio:
         :param description: 
         :return: 
         """
-        for device in self.pulse_conn.source_list():
-            if device.description == description:
-                return device
+        device = self.cache.lookup(PulseCache.FACILITY_SOURCE, PulseCache.FIELD_DESCRIPTION, description)
+        if device is not None:
+            return device
 
-        logging.error("Source device not found! (Was searching for \"%s\")" % description)
-        raise Exception("Source device not found! (Was searching for \"%s\")" % description)
+        logging.error("Source device not found! (Was searching for \"%s\")", description)
+        raise DeviceNotFoundError("Source device not found! (Was searching for \"%s\")" % description)
 
     def _lookup_card(self, name):
         """
@@ -799,24 +4521,38 @@ class PulseAudio:
         :param name: The string to search for in the name of the card.
         :return: 
         """
-        for device in self.pulse_conn.card_list():
-            if name in device.name:
-                return device
-        logging.error("Card \"%s\" not found!" % name)
-        raise Exception("Card \"%s\" not found!" % name)
+        device = self.cache.search(PulseCache.FACILITY_CARD, PulseCache.FIELD_NAME, name)
+        if device is not None:
+            return device
+        logging.error("Card \"%s\" not found!", name)
+        raise DeviceNotFoundError("Card \"%s\" not found!" % name)
 
-    def _move_output(self, source, destination, icon):
+    def _move_output(self, sources, destination, icon, problem=None):
         """
-        Move a Pulse stream
-        :param source: Source device that we want to redirect.
+        Move Pulse streams
+        :param sources: Sink inputs that we want to redirect.
         :param destination: Target device that we want to hear from.
+        :param problem: What went wrong while getting the destination ready,
+                        to tell the user along with the route.
         :return: None
         """
-        logging.info("Moving stream of \"%s\" to \"%s\"" % (source.name, destination.description))
-        self.pulse_conn.sink_input_move(source.index, destination.index)
+        if not sources:
+            if problem is not None:
+                DBusHelper.send_notification("%s: %s" % (destination.description, problem), icon,
+                                             tag=DBusHelper.TAG_ROUTE)
+            return
+
+        with Metrics.shared().span("move_streams"):
+            for source in sources:
+                logging.info("Moving stream of \"%s\" to \"%s\"", source.name, destination.description)
+                self.pulse_conn.sink_input_move(source.index, destination.index)
+        TraceRecorder.shared().record(TraceRecorder.KIND_ROUTE, destination.name, destination.description,
+                                      [source.name for source in sources], TraceRecorder.REASON_ROUTE)
 
-        text = "Routed %s to %s" % (source.name, destination.description)
-        DBusHelper.send_notification(text, icon)
+        text = "Routed %s to %s" % (", ".join(source.name for source in sources), destination.description)
+        if problem is not None:
+            text = "%s, but %s" % (text, problem)
+        DBusHelper.send_notification(text, icon, tag=DBusHelper.TAG_ROUTE)
 
     def _set_input(self, device):
         """
@@ -824,39 +4560,341 @@ class PulseAudio:
         :param device: 
         :return: 
         """
-        logging.info("Setting default source device to \"%s\"" % device.description)
-        self.pulse_conn.source_default_set(device.name)
+        logging.info("Setting default source device to \"%s\"", device.description)
+        with Metrics.shared().span("set_input"):
+            self.pulse_conn.source_default_set(device.name)
 
-    def manage_connection(self, conn_state):
+    def manage_connection(self, conn_state, superseded=None, bt_device=None):
         """
         Decide what to activate based on connection event
         :param conn_state: Boolean of whether the device was connected or not.
+        :param superseded: Callable saying whether a newer event has come in.
+        :param bt_device: BluetoothDevice that connected, if not our current one.
         :return: None
         """
-        if conn_state is True:
-            # Connection
-            self.activate_wireless(conn_event=True)
-        elif conn_state is False:
-            # Disconnection
-            self.activate_speakers(conn_event=True)
+        with Metrics.shared().span("manage_connection"):
+            if conn_state is True:
+                # Connection
+                self.activate_wireless(conn_event=True, superseded=superseded, bt_device=bt_device)
+            elif conn_state is False:
+                # Disconnection
+                self.activate_speakers(conn_event=True)
 
-    def _mute(self, device):
+    def _mute(self, devices):
         """
-        Mute a sink device
-        :param device:
+        Mute sink input devices
+        :param devices:
         :return:
         """
-        logging.debug("Muting device \"%s\"" % device.name)
-        self.pulse_conn.sink_input_mute(device.index, True)
+        with Metrics.shared().span("mute"):
+            for device in devices:
+                logging.debug("Muting device \"%s\"", device.name)
+                self.pulse_conn.sink_input_mute(device.index, True)
 
-    def _unmute(self, device):
+    def _unmute(self, devices):
         """
-        Unmute a sink input device.
-        :param device:
+        Unmute sink input devices.
+        :param devices:
         :return:
         """
-        logging.debug("Unmuting device \"%s\"" % device.name)
-        self.pulse_conn.sink_input_mute(device.index, False)
+        with Metrics.shared().span("unmute"):
+            for device in devices:
+                logging.debug("Unmuting device \"%s\"", device.name)
+                self.pulse_conn.sink_input_mute(device.index, False)
+
+
+class LatencyMonitor:
+    """
+    Watches the latency of the wireless sink while we route to it, and
+    resyncs on its own when it gets too high or keeps growing. Samples go
+    into a rolling window of NumPy arrays, which a line is fitted to for
+    drift (the slope) and jitter (what the line does not explain). Sampling
+    uses a Pulse connection of its own, since latency changes do not come
+    with events. Needs NumPy, and [monitor] enabled=true.
+    """
+    CONFIG_SECTION = "monitor"
+    CLIENT_NAME = "maxime-monitor"
+
+    DEFAULT_INTERVAL = 1.0
+    DEFAULT_WINDOW = 60
+    # Milliseconds, and milliseconds per minute.
+    DEFAULT_MAX_LATENCY = 250.0
+    DEFAULT_MAX_DRIFT = 30.0
+    # Seconds to leave the sink alone after a resync.
+    DEFAULT_COOLDOWN = 60.0
+
+    # Samples needed before we trust a fit.
+    MIN_SAMPLES = 10
+    # Samples the current latency is the median of.
+    RECENT_SAMPLES = 5
+
+    def __init__(self, pulse, config, resync):
+        """
+        Constructor
+        :param pulse: PulseAudio whose route state we follow.
+        :param config: Validated configparser object
+        :param resync: Callable that queues a resync.
+        """
+        section = self.CONFIG_SECTION
+        self.pulse = pulse
+        self.resync = resync
+        self.enabled = config.getboolean(section, 'enabled', fallback=False)
+        self.interval = config.getfloat(section, 'interval', fallback=self.DEFAULT_INTERVAL)
+        self.window = max(config.getint(section, 'window', fallback=self.DEFAULT_WINDOW), self.MIN_SAMPLES)
+        self.max_latency = config.getfloat(section, 'max_latency', fallback=self.DEFAULT_MAX_LATENCY)
+        self.max_drift = config.getfloat(section, 'max_drift', fallback=self.DEFAULT_MAX_DRIFT)
+        self.cooldown = config.getfloat(section, 'cooldown', fallback=self.DEFAULT_COOLDOWN)
+
+        self._times = None
+        self._values = None
+        self._count = 0
+        self._last_resync = None
+
+    def start(self):
+        """
+        Start monitoring in a background thread, if enabled.
+        :return: Boolean of whether it started.
+        """
+        if self.enabled is False:
+            return False
+        try:
+            import numpy
+        except ImportError:
+            logging.error("The latency monitor needs NumPy. Not monitoring.")
+            return False
+
+        self._times = numpy.zeros(self.window)
+        self._values = numpy.zeros(self.window)
+        threading.Thread(target=self._monitor_loop, name="maxime-monitor", daemon=True).start()
+        logging.debug("Monitoring wireless latency every %s seconds.", self.interval)
+        return True
+
+    def _monitor_loop(self):
+        """Sample and check, forever."""
+        from pulsectl import PulseIndexError
+        conn = None
+        while True:
+            time.sleep(self.interval)
+            try:
+                if conn is None:
+                    conn = PulseAudio.open_connection(self.CLIENT_NAME)
+                latency = self._sample(conn)
+            except PulseIndexError as e:
+                # The sink went away between the lookup and the query. The
+                # connection is fine, and the next sample finds the new sink.
+                logging.debug("Latency monitor lost the sink it was sampling: %s", e)
+                continue
+            except Exception as e:
+                logging.error("Latency monitor could not sample: %s", e)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+                continue
+
+            if latency is None:
+                # Not on wireless, so there is nothing to watch.
+                self._count = 0
+                continue
+            self._add(time.monotonic(), latency)
+            self._check()
+
+    def _sample(self, conn):
+        """
+        Measure how far behind the wireless sink is.
+        :param conn: Pulse connection of our own.
+        :return: Latency in milliseconds, or None if we are not routing to wireless.
+        """
+        from pulsectl import PulseIndexError
+        if self.pulse.state.get('route') != Maxime.ROUTE_WIRELESS:
+            return None
+        sink = self.pulse.cache.lookup(PulseCache.FACILITY_SINK, PulseCache.FIELD_NAME, self.pulse.state.get('sink'))
+        if sink is None:
+            return None
+
+        latency = conn.sink_info(sink.index).latency
+        # Our streams buffer on top of what the sink reports.
+        for index in self.pulse.state.get('streams') or []:
+            try:
+                stream = conn.sink_input_info(index)
+            except PulseIndexError:
+                continue
+            if stream.sink == sink.index:
+                latency = max(latency, stream.sink_usec + stream.buffer_usec)
+        return latency / 1000.0
+
+    def _add(self, when, latency):
+        """
+        Put a sample in the rolling window, over the oldest one.
+        :return: None
+        """
+        slot = self._count % self.window
+        self._times[slot] = when
+        self._values[slot] = latency
+        self._count += 1
+
+    def fit(self):
+        """
+        Fit the window.
+        :return: Tuple of current latency (ms), drift (ms per minute) and
+                 jitter (ms), or None without enough samples.
+        """
+        import numpy
+        n = min(self._count, self.window)
+        if n < self.MIN_SAMPLES:
+            return None
+
+        times = self._times[:n] - self._times[:n].min()
+        values = self._values[:n]
+        slope, intercept = numpy.polyfit(times, values, 1)
+        jitter = float(numpy.std(values - (slope * times + intercept)))
+
+        recent = (self._count - 1 - numpy.arange(min(self.RECENT_SAMPLES, n))) % self.window
+        current = float(numpy.median(self._values[recent]))
+        return current, float(slope) * 60, jitter
+
+    def _check(self):
+        """
+        Resync if the latency is too high or growing too fast.
+        :return: None
+        """
+        result = self.fit()
+        if result is None:
+            return
+        current, drift, jitter = result
+
+        metrics = Metrics.shared()
+        metrics.set_gauge("wireless_latency_ms", round(current, 3))
+        metrics.set_gauge("wireless_drift_ms_per_minute", round(drift, 3))
+        metrics.set_gauge("wireless_jitter_ms", round(jitter, 3))
+
+        if current <= self.max_latency and drift <= self.max_drift:
+            return
+        now = time.monotonic()
+        if self._last_resync is not None and now - self._last_resync < self.cooldown:
+            return
+
+        logging.info("Wireless latency is %.0f ms, drifting %.1f ms/min with %.1f ms jitter. Resyncing.",
+                     current, drift, jitter)
+        self._last_resync = now
+        self._count = 0
+        self.resync()
+
+
+class StartupTask:
+    """
+    One backend being opened by Startup.
+    """
+    def __init__(self, name, function, args):
+        """
+        Constructor. Starts opening the backend.
+        :param name: What to call it in the report.
+        :param function: Callable that opens it.
+        :param args: Arguments to call it with.
+        """
+        self.name = name
+        self.result = None
+        self.error = None
+        self.seconds = None
+        self._function = function
+        self._args = args
+        self._thread = threading.Thread(target=self._run, name="maxime-startup-%s" % name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        started = time.monotonic()
+        try:
+            self.result = self._function(*self._args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.seconds = time.monotonic() - started
+
+    def wait(self):
+        """
+        Wait for the backend to be open.
+        :return: Whatever the function returned. Raises what it raised.
+        """
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Startup:
+    """
+    Opens backends that do not depend on each other (Pulse, the system bus,
+    the session bus) at the same time, each on a thread of its own, so that
+    getting ready takes as long as the slowest of them rather than all of
+    them added up. Reports how long each took and when we were ready.
+    """
+    PULSE = "pulse"
+    SYSTEM_BUS = "system bus"
+    SESSION_BUS = "session bus"
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._tasks = collections.OrderedDict()
+        # Seconds taken by backends that were opened some other way.
+        self._recorded = collections.OrderedDict()
+
+    def start(self, name, function, *args):
+        """
+        Start opening a backend.
+        :param name: One of the constants above.
+        :param function: Callable that opens it.
+        :param args: Arguments to call it with.
+        :return: None
+        """
+        self._tasks[name] = StartupTask(name, function, args)
+
+    def record(self, name, seconds):
+        """
+        Report on a backend that was opened without start(), such as on an
+        event loop.
+        :param name: One of the constants above.
+        :param seconds: How long it took.
+        :return: None
+        """
+        self._recorded[name] = seconds
+
+    def started_task(self, name):
+        """
+        Whether a backend is being opened.
+        :return: Boolean
+        """
+        return name in self._tasks
+
+    def result(self, name):
+        """
+        Wait for a backend to be open.
+        :param name: Name it was started with.
+        :return: Whatever its function returned. Raises what it raised.
+        """
+        return self._tasks[name].wait()
+
+    def report(self, level=logging.INFO):
+        """
+        Log how long each backend took and how long until we were ready.
+        Waits for any that are still opening, without raising their errors.
+        :param level: Logging level to report at.
+        :return: Seconds until ready.
+        """
+        timings = []
+        for task in self._tasks.values():
+            try:
+                task.wait()
+            except Exception:
+                pass
+            timings.append("%s %.3fs" % (task.name, task.seconds))
+        for name, seconds in self._recorded.items():
+            timings.append("%s %.3fs" % (name, seconds))
+        ready = time.monotonic() - self.started
+        logging.log(level, "Ready in %.3f seconds (%s).", ready, ", ".join(timings) or "nothing to open")
+        Metrics.shared().set_gauge("startup_seconds", round(ready, 6))
+        return ready
 
 
 def main():
@@ -864,14 +4902,65 @@ def main():
     Main program logic. Wait for dbus events and go from there.
     """
     max = Maxime()
-    logging.debug("Our mode is: %s" % max.mode)
+    logging.debug("Our mode is: %s", max.mode)
 
-    # @TODO This is hax
-    # Setup PulseAudio
-    bt_device = BluetoothDevice(max.config)
+    if max.args.profile is True:
+        if max.mode in (max.MODE_DAEMON, max.MODE_LISTEN):
+            max.exit_err("--profile is for one-shot modes. Send SIGUSR1 to a running daemon instead.")
+        Profiler.shared().start()
+        atexit.register(Profiler.shared().stop)
+
+    if max.args.record is not None:
+        if max.mode not in (max.MODE_DAEMON, max.MODE_LISTEN):
+            max.exit_err("--record is for the daemon.")
+        # Before anything is opened, so that the first listings are in the trace.
+        TraceRecorder.shared().open(os.path.abspath(os.path.expanduser(max.args.record)), max.config)
+
+    # Pulse, BlueZ and the notification daemon do not depend on each other,
+    # so they are opened at the same time.
+    startup = Startup()
+    bt_devices = BluetoothDevice.get_devices(max.config)
+    bt_device = bt_devices[0]
     sp_device = GenericAudioDevice(max.config, 'speakers')
     hs_device = GenericAudioDevice(max.config, 'headset')
-    pulse = PulseAudio(max.config, bt_device, sp_device, hs_device)
+
+    # A running daemon publishes where it routed to, and keeps it fresh.
+    snapshot = None
+    if max.mode in max.DAEMON_METHODS:
+        snapshot = RouteState.read(max.get_runtime_path(RouteState.FILE_NAME))
+
+    if max.mode == max.MODE_STATUS:
+        if snapshot is not None and snapshot.get('output') is not None:
+            logging.info(max.status(None, snapshot))
+            logging.debug("Exiting.")
+            return
+
+    if max.mode in max.DAEMON_METHODS:
+        if snapshot is None and max.mode != max.MODE_STATS:
+            # Most likely there is no daemon to hand this to, so get our own
+            # backends going while we ask.
+            if max.mode in max.BLUETOOTH_MODES:
+                startup.start(Startup.SYSTEM_BUS, max.prepare_bluetooth_backend, bt_device)
+            else:
+                startup.start(Startup.PULSE, PulseAudio, max.config, bt_device, sp_device, hs_device)
+            startup.start(Startup.SESSION_BUS, NotificationQueue.shared().connect)
+        if max.forward_to_daemon() is True:
+            logging.debug("Exiting.")
+            return
+        if max.mode == max.MODE_STATS:
+            max.exit_err("No daemon is running. Stats are only kept by the daemon.")
+        # No daemon, so do it ourselves. One at a time.
+        lock_file = max.lock_commands()
+
+    # Bluetooth-only modes never talk to Pulse.
+    pulse = None
+    if max.mode not in max.BLUETOOTH_MODES and max.mode not in (max.MODE_DAEMON, max.MODE_LISTEN):
+        if not startup.started_task(Startup.PULSE):
+            startup.start(Startup.PULSE, PulseAudio, max.config, bt_device, sp_device, hs_device)
+        pulse = startup.result(Startup.PULSE)
+        startup.report(logging.DEBUG)
+    elif max.mode in max.BLUETOOTH_MODES:
+        startup.report(logging.DEBUG)
 
     if max.mode == max.MODE_STATUS:
         max.status(pulse)
@@ -889,8 +4978,51 @@ def main():
         max.reconnect(bt_device)
     else:
         # Daemon Mode
-        dbus_listener = DBusListener(bt_device, pulse)
-        dbus_listener.listen()
+        Metrics.shared().configure(max.config)
+        engine = max.config.get('daemon', 'engine', fallback=max.ENGINE_GLIB)
+        state_path = max.get_runtime_path(RouteState.FILE_NAME)
+        if engine == max.ENGINE_ASYNCIO:
+            pulse = PulseAudio(max.config, bt_device, sp_device, hs_device)
+            pulse.publish_state(state_path)
+            AsyncEngine(max, bt_devices, pulse, startup).run()
+        else:
+            import dbus
+            worker = RoutingWorker(max.config)
+
+            def open_pulse():
+                pulse = PulseAudio(max.config, bt_device, sp_device, hs_device)
+                pulse.schedule = lambda function: worker.submit(function, key=PulseAudio.JOB_RECOVER)
+                pulse.watch()
+                return pulse
+
+            def open_session_bus():
+                dbus.SessionBus()
+                NotificationQueue.shared().connect()
+
+            DBusListener.setup_main_loop()
+            startup.start(Startup.PULSE, open_pulse)
+            startup.start(Startup.SYSTEM_BUS, BluezSubscription)
+            startup.start(Startup.SESSION_BUS, open_session_bus)
+
+            pulse = startup.result(Startup.PULSE)
+            pulse.publish_state(state_path)
+            LatencyMonitor(pulse, max.config,
+                           lambda: worker.submit(pulse.resync_wireless, key=PulseAudio.JOB_RESYNC)).start()
+            dbus_listener = DBusListener(bt_devices, pulse, max.config, worker,
+                                         startup.result(Startup.SYSTEM_BUS))
+            max.connections.attach(dbus_listener)
+            Profiler.shared().watch_signals()
+            try:
+                startup.result(Startup.SESSION_BUS)
+            except dbus.exceptions.DBusException as e:
+                logging.error("Could not connect to the session bus: %s", e)
+            try:
+                control_service = ControlService(max, bt_device, pulse, worker,
+                                                 RoutingWorker(max.config, name="connection"))
+            except dbus.exceptions.NameExistsException:
+                max.exit_err("Another daemon is already running.")
+            startup.report()
+            dbus_listener.listen()
 
     logging.debug("Exiting.")
 
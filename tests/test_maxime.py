@@ -0,0 +1,454 @@
+"""
+Unit tests for the parts of maxime.py that do not need Pulse, BlueZ or a
+bus: the route state file, stream rules, debouncing, the Pulse cache's
+indexes, bluetoothctl parsing and connection retries. The replay tests need
+bench/fakes.py, and so dbus-python and pulsectl, and are skipped without
+them.
+"""
+import configparser
+import os
+import struct
+import sys
+import types
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import maxime  # noqa: E402
+
+MAC = "DE:AD:BE:EF:CA:FE"
+DEVICE_PATH = "/org/bluez/hci0/dev_DE_AD_BE_EF_CA_FE"
+
+
+def make_config(text=""):
+    config = configparser.ConfigParser()
+    config.read_string(text)
+    return config
+
+
+def pulse_object(index, name, description=None, **attributes):
+    return types.SimpleNamespace(index=index, name=name, description=description, **attributes)
+
+
+# RouteState
+
+def test_route_state_round_trip(tmp_path):
+    """What the daemon publishes is what --status reads."""
+    path = str(tmp_path / maxime.RouteState.FILE_NAME)
+    state = maxime.RouteState()
+    state.publish(path)
+    state.update(output="Speakers", route=maxime.Maxime.ROUTE_SPEAKERS, streams=[3, 7])
+
+    snapshot = maxime.RouteState.read(path)
+    assert snapshot["output"] == "Speakers"
+    assert snapshot["route"] == maxime.Maxime.ROUTE_SPEAKERS
+    assert snapshot["streams"] == [3, 7]
+    assert snapshot["pid"] == os.getpid()
+
+
+def test_route_state_ignores_a_write_in_progress(tmp_path):
+    """An odd sequence number means the payload is half written."""
+    path = str(tmp_path / maxime.RouteState.FILE_NAME)
+    state = maxime.RouteState()
+    state.publish(path)
+    state.update(output="Speakers")
+
+    with open(path, "r+b") as f:
+        seq = struct.unpack_from("=Q", f.read(8))[0]
+        f.seek(0)
+        f.write(struct.pack("=Q", seq + 1))
+
+    assert maxime.RouteState.read(path) is None
+
+
+def test_route_state_ignores_a_stale_stamp(tmp_path):
+    path = str(tmp_path / maxime.RouteState.FILE_NAME)
+    state = maxime.RouteState()
+    state.publish(path)
+    state.update(output="Speakers")
+
+    assert maxime.RouteState.read(path, max_age=-1) is None
+    state._retract()
+    assert maxime.RouteState.read(path) is None
+
+
+def test_route_state_without_a_file(tmp_path):
+    assert maxime.RouteState.read(str(tmp_path / "missing")) is None
+
+
+# StreamRules
+
+def test_stream_rules_default_to_the_ladspa_stream():
+    rules = maxime.StreamRules(make_config())
+    assert rules.matches(pulse_object(1, "LADSPA Stream")) is True
+    assert rules.matches(pulse_object(2, "Playback", proplist={})) is False
+
+
+def test_stream_rules_match_names_binaries_and_roles():
+    rules = maxime.StreamRules(make_config("[streams]\nnames=Music, Video\nbinaries=mpv\nroles=phone\n"))
+    assert rules.matches(pulse_object(1, "Video")) is True
+    assert rules.matches(pulse_object(2, "Playback", proplist={"application.process.binary": "mpv"})) is True
+    assert rules.matches(pulse_object(3, "Call", proplist={"media.role": "phone"})) is True
+    assert rules.matches(pulse_object(4, "LADSPA Stream", proplist={})) is False
+    # Streams without a proplist are matched by name only.
+    assert rules.matches(types.SimpleNamespace(index=5, name="Other")) is False
+
+
+# ConnectionDebouncer
+
+class ManualDebouncer(maxime.ConnectionDebouncer):
+    """ConnectionDebouncer whose timers fire when the test says so."""
+    def __init__(self, config):
+        self.timers = []
+        self.calls = []
+        maxime.ConnectionDebouncer.__init__(self, config, self._record)
+
+    def _record(self, state, superseded):
+        self.calls.append((state, superseded))
+
+    def _start_timer(self, seconds, callback):
+        handle = [seconds, callback]
+        self.timers.append(handle)
+        return handle
+
+    def _cancel_timer(self, handle):
+        self.timers.remove(handle)
+
+    def fire(self):
+        handle = self.timers.pop(0)
+        handle[1]()
+
+
+def make_debouncer(connect=0.5, disconnect=0.0):
+    return ManualDebouncer(make_config("[daemon]\ndebounce_connect=%s\ndebounce_disconnect=%s\n"
+                                       % (connect, disconnect)))
+
+
+def test_debouncer_waits_for_connects_to_settle():
+    debouncer = make_debouncer()
+    debouncer.submit("headphones")
+    assert debouncer.calls == []
+    assert debouncer.timers[0][0] == 0.5
+
+    debouncer.fire()
+    assert [state for state, _ in debouncer.calls] == ["headphones"]
+
+
+def test_debouncer_acts_on_disconnects_at_once():
+    debouncer = make_debouncer()
+    debouncer.prime("headphones")
+    debouncer.submit(None)
+    assert [state for state, _ in debouncer.calls] == [None]
+    assert debouncer.timers == []
+
+
+def test_debouncer_collapses_a_flapping_link():
+    debouncer = make_debouncer(connect=0.5, disconnect=0.5)
+    debouncer.prime(None)
+    debouncer.submit("headphones")
+    debouncer.submit(None)
+    debouncer.submit("headphones")
+    assert len(debouncer.timers) == 1
+
+    debouncer.fire()
+    assert [state for state, _ in debouncer.calls] == ["headphones"]
+    assert debouncer.received == 3
+    assert debouncer.suppressed == 2
+
+
+def test_debouncer_suppresses_the_state_we_already_have():
+    debouncer = make_debouncer(connect=0.5, disconnect=0.5)
+    debouncer.prime("headphones")
+    debouncer.submit(None)
+    debouncer.submit("headphones")
+    debouncer.fire()
+    assert debouncer.calls == []
+    assert debouncer.suppressed == 2
+
+
+def test_debouncer_tells_routing_it_was_superseded():
+    debouncer = make_debouncer()
+    debouncer.prime("headphones")
+    debouncer.submit(None)
+    _, superseded = debouncer.calls[0]
+    assert superseded() is False
+    debouncer.submit("headphones")
+    assert superseded() is True
+
+
+# PulseCache
+
+def make_cache(sinks):
+    cache = maxime.PulseCache(None)
+    cache.replace(maxime.PulseCache.FACILITY_SINK, sinks)
+    # Nothing to reload from, so misses stay misses.
+    cache.set_watching()
+    return cache
+
+
+def test_pulse_cache_indexes_by_index_name_and_description():
+    speakers = pulse_object(1, "alsa_output.speakers", "Speakers")
+    headset = pulse_object(2, "alsa_output.headset", "Headset")
+    cache = make_cache([headset, speakers])
+    sink = maxime.PulseCache.FACILITY_SINK
+
+    assert cache.get(sink, 2) is headset
+    assert cache.objects(sink) == [speakers, headset]
+    assert cache.lookup(sink, maxime.PulseCache.FIELD_NAME, "alsa_output.speakers") is speakers
+    assert cache.lookup(sink, maxime.PulseCache.FIELD_DESCRIPTION, "Headset") is headset
+    assert cache.lookup(sink, maxime.PulseCache.FIELD_DESCRIPTION, "Head") is None
+
+
+def test_pulse_cache_search_prefers_exact_matches_then_lowest_index():
+    eq = pulse_object(1, "ladspa_output", "LADSPA Plugin on Bose QuietComfort 35")
+    bose = pulse_object(2, "bluez_sink", "Bose QuietComfort 35")
+    other = pulse_object(3, "bluez_sink.2", "Bose QuietComfort 35 II")
+    cache = make_cache([eq, bose, other])
+    sink = maxime.PulseCache.FACILITY_SINK
+    description = maxime.PulseCache.FIELD_DESCRIPTION
+
+    assert cache.search(sink, description, "Bose QuietComfort 35") is bose
+    assert cache.search(sink, description, "QuietComfort") is eq
+    assert cache.search(sink, description, "Sennheiser") is None
+
+
+def test_pulse_cache_search_forgets_results_when_objects_change():
+    sink = maxime.PulseCache.FACILITY_SINK
+    description = maxime.PulseCache.FIELD_DESCRIPTION
+    first = pulse_object(1, "bluez_sink", "Bose QuietComfort 35")
+    cache = make_cache([first])
+    assert cache.search(sink, description, "Bose") is first
+
+    cache.apply(sink, maxime.PulseCache.EVENT_REMOVE, 1, None)
+    assert cache.search(sink, description, "Bose") is None
+    second = pulse_object(4, "bluez_sink", "Bose QuietComfort 35")
+    cache.apply(sink, maxime.PulseCache.EVENT_NEW, 4, second)
+    assert cache.search(sink, description, "Bose") is second
+
+
+def test_pulse_cache_drop_hands_a_shared_value_to_another_object():
+    sink = maxime.PulseCache.FACILITY_SINK
+    description = maxime.PulseCache.FIELD_DESCRIPTION
+    first = pulse_object(1, "alsa_output.1", "USB Audio")
+    second = pulse_object(2, "alsa_output.2", "USB Audio")
+    cache = make_cache([first, second])
+    assert cache.lookup(sink, description, "USB Audio") is first
+
+    cache._drop(sink, 1)
+    assert cache.get(sink, 1) is None
+    assert cache.lookup(sink, maxime.PulseCache.FIELD_NAME, "alsa_output.1") is None
+    assert cache.lookup(sink, description, "USB Audio") is second
+    # Dropping what is not there does nothing.
+    cache._drop(sink, 1)
+    assert cache.objects(sink) == [second]
+
+
+def test_pulse_cache_change_replaces_every_index():
+    sink = maxime.PulseCache.FACILITY_SINK
+    cache = make_cache([pulse_object(1, "alsa_output.1", "Old Name")])
+    renamed = pulse_object(1, "alsa_output.1", "New Name")
+    cache.apply(sink, maxime.PulseCache.EVENT_CHANGE, 1, renamed)
+
+    assert cache.get(sink, 1) is renamed
+    assert cache.lookup(sink, maxime.PulseCache.FIELD_DESCRIPTION, "Old Name") is None
+    assert cache.lookup(sink, maxime.PulseCache.FIELD_DESCRIPTION, "New Name") is renamed
+
+
+# Bluetoothctl
+
+class ParsingBluetoothctl(maxime.Bluetoothctl):
+    """Bluetoothctl that is fed lines by the test instead of a child."""
+    def _spawn(self):
+        self.child = None
+
+    def _read_loop(self):
+        pass
+
+
+def test_bluetoothctl_parses_property_changes():
+    ctl = ParsingBluetoothctl()
+    ctl._parse_line("\x1b[0;93m[CHG]\x1b[0m Device %s Connected: yes\r\n" % MAC.lower())
+    assert ctl._property(MAC, "Connected") == "yes"
+
+
+def test_bluetoothctl_parses_info_behind_a_prompt():
+    ctl = ParsingBluetoothctl()
+    ctl._parse_line("[bluetooth]# Device %s (public)" % MAC)
+    ctl._parse_line("\tName: Bose QC35")
+    ctl._parse_line("\tConnected: no")
+    assert ctl._property(MAC, "Connected") == "no"
+    assert ctl._property(MAC, "Name") == "Bose QC35"
+
+    # Fields only count while the info block lasts.
+    ctl._parse_line("Connection successful")
+    ctl._parse_line("\tConnected: yes")
+    assert ctl._property(MAC, "Connected") == "no"
+
+
+def test_bluetoothctl_only_reports_properties_after_a_command():
+    ctl = ParsingBluetoothctl()
+    ctl._parse_line("[CHG] Device %s Connected: no" % MAC)
+    seq = ctl._seq
+    assert ctl._property_since(MAC, "Connected", seq) is None
+
+    ctl._parse_line("[CHG] Device %s Connected: yes" % MAC)
+    assert ctl._property_since(MAC, "Connected", seq) == "yes"
+
+
+def test_bluetoothctl_results():
+    ctl = ParsingBluetoothctl()
+    seq = ctl._seq
+    assert ctl._result_since(seq, ctl.RESULT_CONNECT, MAC) is None
+
+    ctl._parse_line("Failed to connect: org.bluez.Error.Failed")
+    assert ctl._result_since(seq, ctl.RESULT_CONNECT, MAC) is False
+    seq = ctl._seq
+    ctl._parse_line("Connection successful")
+    assert ctl._result_since(seq, ctl.RESULT_CONNECT, MAC) is True
+    assert ctl._result_since(seq, ctl.RESULT_DISCONNECT, MAC) is None
+
+    seq = ctl._seq
+    ctl._parse_line("Device %s not available" % MAC)
+    assert ctl._result_since(seq, ctl.RESULT_DISCONNECT, MAC) is False
+
+
+# ConnectionScheduler
+
+class FakeBackend:
+    """A headset that connects on the given attempt."""
+    def __init__(self, connects_on=1):
+        self.connected = False
+        self.attempts = 0
+        self.connects_on = connects_on
+
+    def is_connected(self):
+        return self.connected
+
+    def connect(self):
+        self.attempts += 1
+        if self.attempts >= self.connects_on:
+            self.connected = True
+        return True
+
+    def disconnect(self):
+        self.attempts += 1
+        self.connected = False
+        return True
+
+
+def make_scheduler(attempts=3):
+    return maxime.ConnectionScheduler(make_config(
+        "[bluetooth]\nconnect_attempts=%s\nretry_delay=0.001\nretry_max_delay=0.004\nconnect_timeout=0.05\n"
+        % attempts))
+
+
+def test_scheduler_backoff_doubles_with_jitter_up_to_the_max():
+    scheduler = maxime.ConnectionScheduler(make_config("[bluetooth]\nretry_delay=1\nretry_max_delay=4\n"))
+    for attempt, full in ((1, 1), (2, 2), (3, 4), (6, 4)):
+        for _ in range(20):
+            assert full / 2 <= scheduler._backoff(attempt) <= full
+
+
+def test_scheduler_generations_cancel_older_commands():
+    scheduler = make_scheduler()
+    first = scheduler.begin()
+    assert scheduler._cancelled(first) is False
+    second = scheduler.begin()
+    assert second == first + 1
+    assert scheduler._cancelled(first) is True
+    assert scheduler._sleep(1, first) is False
+
+
+def test_scheduler_retries_until_connected():
+    scheduler = make_scheduler(attempts=3)
+    bluez = FakeBackend(connects_on=2)
+    device = types.SimpleNamespace(mac=MAC, output_device="Headphones")
+    outcome = scheduler.change(device, bluez, True, scheduler.begin())
+    assert outcome == maxime.ConnectionScheduler.OUTCOME_CONNECTED
+    assert bluez.attempts == 2
+
+
+def test_scheduler_gives_up_after_its_attempts():
+    scheduler = make_scheduler(attempts=2)
+    bluez = FakeBackend(connects_on=5)
+    device = types.SimpleNamespace(mac=MAC, output_device="Headphones")
+    assert scheduler.change(device, bluez, True, scheduler.begin()) == maxime.ConnectionScheduler.OUTCOME_FAILED
+    assert bluez.attempts == 2
+
+
+def test_scheduler_leaves_a_device_in_the_right_state_alone():
+    scheduler = make_scheduler()
+    bluez = FakeBackend()
+    device = types.SimpleNamespace(mac=MAC, output_device="Headphones")
+    outcome = scheduler.change(device, bluez, False, scheduler.begin())
+    assert outcome == maxime.ConnectionScheduler.OUTCOME_UNCHANGED
+    assert bluez.attempts == 0
+
+
+def test_scheduler_stops_for_a_newer_command():
+    scheduler = make_scheduler()
+    bluez = FakeBackend(connects_on=5)
+    device = types.SimpleNamespace(mac=MAC, output_device="Headphones")
+    generation = scheduler.begin()
+    scheduler.begin()
+    assert scheduler.change(device, bluez, True, generation) == maxime.ConnectionScheduler.OUTCOME_CANCELLED
+    assert bluez.attempts == 0
+
+
+# bench/replay.py
+
+@pytest.fixture
+def replay():
+    pytest.importorskip("dbus")
+    pytest.importorskip("pulsectl")
+    sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+    import replay
+    return replay
+
+
+def bluez_record(when, connected):
+    return [when, maxime.TraceRecorder.KIND_BLUEZ, "PropertiesChanged", DEVICE_PATH,
+            [maxime.BluetoothDevice.DBUS_INTERFACE_DEVICE, {"Connected": connected}, []]]
+
+
+def route_record(when, output, streams, reason=maxime.TraceRecorder.REASON_ROUTE):
+    return [when, maxime.TraceRecorder.KIND_ROUTE, "sink." + output, output, streams, reason]
+
+
+def test_find_decisions_pairs_moves_with_their_cause(replay):
+    records = [
+        [0.0, maxime.TraceRecorder.KIND_START],
+        bluez_record(1.0, True),
+        route_record(1.25, "Headphones", ["LADSPA Stream"]),
+        [2.0, maxime.TraceRecorder.KIND_PULSE, maxime.PulseCache.FACILITY_SINK_INPUT,
+         maxime.PulseCache.EVENT_NEW, 9, {"name": "Music"}],
+        route_record(2.5, "Headphones", ["Music"], maxime.TraceRecorder.REASON_FOLLOW),
+        [3.0, maxime.TraceRecorder.KIND_COMMAND, "route", ["speakers"]],
+        route_record(3.1, "Speakers", ["LADSPA Stream", "Music"]),
+        # Nothing set this one off: the command was used up by the move before.
+        route_record(3.2, "Speakers", ["LADSPA Stream", "Music"]),
+    ]
+    decisions = replay.find_decisions(records)
+
+    assert [(d["cause"], d["output"], d["latency_ms"]) for d in decisions] == [
+        ("connect %s" % MAC, "Headphones", 250.0),
+        ("new stream Music", "Headphones", 500.0),
+        ("command route speakers", "Speakers", 100.0),
+        (None, "Speakers", None),
+    ]
+
+
+def test_compare_reports_changed_and_slower_decisions(replay):
+    before = replay.find_decisions([bluez_record(1.0, True), route_record(1.1, "Headphones", ["Music"])])
+    same = replay.find_decisions([bluez_record(5.0, True), route_record(5.1, "Headphones", ["Music"])])
+    slower = replay.find_decisions([bluez_record(5.0, True), route_record(5.5, "Headphones", ["Music"])])
+    elsewhere = replay.find_decisions([bluez_record(5.0, True), route_record(5.1, "Speakers", ["Music"])])
+
+    assert replay.compare(same, before, 0.25) == []
+    assert replay.compare(slower, before, 0.25) == ["p50_ms went from 100.0 to 500.0 ms",
+                                                    "p95_ms went from 100.0 to 500.0 ms"]
+    differences = replay.compare(elsewhere, before, 0.25)
+    assert "decision -connect %s -> Headphones (Music)" % MAC in differences
+    assert "decision +connect %s -> Speakers (Music)" % MAC in differences